@@ -0,0 +1,230 @@
+"""Time the TOM clients in this archive against a local fake TOM (fake_tom.py).
+
+Nothing here talks to the real TOM.  A FakeTomServer is started in a
+separate process (so that its memory doesn't count towards the clients'
+peak RSS), and each benchmark is run --repeat times against it.  The
+results are printed and written as JSON to --output, so that runs can be
+compared, e.g. before and after a change:
+
+  python bench_tom_clients.py --scale 0.5 --output before.json
+  ... change things ...
+  python bench_tom_clients.py --scale 0.5 --output after.json
+
+Each result has the benchmark name, the best and mean wall-clock time
+over the repeats, and, where it makes sense, rows and bytes per second
+(using the best time).  peak_rss_mb is the peak resident set size of
+this process so far, so it only ever goes up; benchmarks are run in
+order of (roughly) increasing memory use so that it's meaningful.
+
+"""
+
+import sys
+import io
+import json
+import time
+import logging
+import platform
+import argparse
+import resource
+import datetime
+import subprocess
+import statistics
+import multiprocessing
+
+import numpy
+import pandas
+
+import fake_tom
+import tom_session
+from tom_client import TomClient
+from metric_querier import ELAsTiCCMetricsQuerier
+from sql_query_conf_matrices_objects import ConfMatrixClient
+
+
+def _serve( scale, seed, latency, queue ):
+    server = fake_tom.FakeTomServer( scale=scale, seed=seed, latency=latency )
+    queue.put( server.url )
+    server.httpd.serve_forever()
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kiB on Linux, bytes on MacOS
+    rss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+
+class Bench:
+    def __init__( self, url, repeat, logger ):
+        self.url = url
+        self.repeat = repeat
+        self.logger = logger
+        self.results = []
+
+    def querier( self ):
+        return ELAsTiCCMetricsQuerier( tomusername='bench', tompasswd=fake_tom.password,
+                                       logger=self.logger, url=self.url )
+
+    def confmatrixclient( self ):
+        cls = type( 'BenchConfMatrixClient', ( ConfMatrixClient, ), { 'url': self.url } )
+        return cls.from_credentials( 'bench', fake_tom.password )
+
+    def run( self, name, func, setup=None, nrows=None, nbytes=None ):
+        """Time func( setup() ) self.repeat times; setup isn't timed.
+
+        nrows and nbytes may be numbers, or functions of func's return
+        value, giving how many rows / bytes one call moved.
+
+        """
+        times = []
+        for _ in range( self.repeat ):
+            arg = setup() if setup is not None else None
+            t0 = time.perf_counter()
+            rval = func( arg ) if setup is not None else func()
+            times.append( time.perf_counter() - t0 )
+        best = min( times )
+        res = { 'name': name, 'repeat': self.repeat, 'best_s': best, 'mean_s': statistics.mean( times ) }
+        if nrows is not None:
+            res['rows'] = nrows( rval ) if callable( nrows ) else nrows
+            res['rows_per_s'] = res['rows'] / best
+        if nbytes is not None:
+            res['bytes'] = nbytes( rval ) if callable( nbytes ) else nbytes
+            res['mb_per_s'] = res['bytes'] / 1024 / 1024 / best
+        res['peak_rss_mb'] = _peak_rss_mb()
+        self.results.append( res )
+        self.logger.info( "  ".join( f"{k}={v:.4g}" if isinstance( v, float ) else f"{k}={v}"
+                                     for k, v in res.items() ) )
+        return rval
+
+    def response_bytes( self, querier, query ):
+        res = querier.rqs.post( f'{self.url}/db/runsqlquery/', json={ 'query': query, 'subdict': {} } )
+        return len( res.content )
+
+    def cube_size( self, querier ):
+        """Record how the memory of probhist_cube() (with and without the arrays it keeps) compares to probhist()."""
+        frame = querier.probhist( copy=False )
+        cube = querier.probhist_cube()
+        res = { 'name': 'probhist_cube[size]',
+                'frame_mb': frame.memory_usage( index=True, deep=True ).sum() / 1024 / 1024,
+                'cube_mb': cube.nbytes( products=False ) / 1024 / 1024 }
+        for cfer in cube.classifierIds:
+            for true in cube.trueClassIds:
+                cube.get( cfer, true, what='cumulative' )
+        res['cube_with_products_mb'] = cube.nbytes() / 1024 / 1024
+        res['cube_cells'] = len( cube.counts )
+        self.results.append( res )
+        self.logger.info( "  ".join( f"{k}={v:.4g}" if isinstance( v, float ) else f"{k}={v}"
+                                     for k, v in res.items() ) )
+
+    def all( self ):
+        self.run( 'login', lambda: tom_session.TomSession( self.url, 'bench', fake_tom.password ) )
+        self.run( 'TomClient[shared session]',
+                  lambda: TomClient( url=self.url, username='bench', password=fake_tom.password ) )
+
+        q = self.querier()
+        self.run( 'classname', lambda: q.run_query( 'SELECT DISTINCT ON ("classId") "classId",description '
+                                                    'FROM elasticc_gentypeofclassid ORDER BY "classId"' ),
+                  nrows=len )
+
+        cmc = self.confmatrixclient()
+        self.run( 'ConfMatrixClient.__init__', lambda: type( cmc )( cmc.session ) )
+        ncfers = len( cmc.classifiers )
+        for label, kwargs in ( ( 'serial', {} ), ( 'jobs4', { 'jobs': 4 } ), ( 'batched', { 'batched': True } ) ):
+            self.run( f'get_classifications[{label}]',
+                      lambda: cmc.get_classifications( definition='best', classifier_id=None, **kwargs ),
+                      nrows=ncfers )
+
+        query = 'SELECT * FROM bench_rows'
+        nbytes = self.response_bytes( q, query )
+        self.run( 'run_query', lambda: q.run_query( query ), nrows=len, nbytes=nbytes )
+        self.run( 'run_query_frame', lambda: q.run_query_frame( query ), nrows=len, nbytes=nbytes )
+        self.run( 'run_query_chunked',
+                  lambda: sum( len( df ) for df in q.run_query_chunked( query, 'id', chunksize=100000 ) ),
+                  nrows=lambda n: n )
+
+        probhistbytes = self.response_bytes( q, 'SELECT * FROM elasticc_view_classifications_probmetrics' )
+        self.run( 'probhist[fresh querier]', lambda q: q.probhist(), setup=self.querier,
+                  nrows=len, nbytes=probhistbytes )
+        idx = q.probhist( copy=False ).index
+        cfers = sorted( set( idx.get_level_values( 'classifierId' ) ) )[:3]
+        trues = sorted( set( idx.get_level_values( 'trueClassId' ) ) )[:4]
+        self.run( 'probhist[fresh querier, 3 classifiers x 4 true classes]',
+                  lambda q: q.probhist( classifierIds=cfers, trueClassIds=trues ), setup=self.querier, nrows=len )
+        self.run( 'probhist[cached]', lambda: q.probhist(), nrows=len )
+        self.run( 'probhist[cached, copy=False]', lambda: q.probhist( copy=False ), nrows=len )
+        self.run( 'probhist_cube[full]', lambda q: q.probhist_cube(), setup=self.querier )
+        self.cube_size( q )
+
+        tc = TomClient( url=self.url, username='bench', password=fake_tom.password )
+        cfer = next( iter( cmc.classifiers ) )
+        for what in ( 'sources', 'classifications' ):
+            page = f'elasticc2/brokerclassfortruetype/pickle/{what}/{cfer}/2222'
+            nbytes = len( tc.get( page ).content )
+            self.run( f'brokerclassfortruetype/pickle/{what}',
+                      lambda: pandas.read_pickle( io.BytesIO( tc.get( page ).content ) ),
+                      nrows=len, nbytes=nbytes )
+            self.run( f'brokerclassfortruetype/pickle/{what}[download_frame]',
+                      lambda: tc.download_frame( page ), nrows=len, nbytes=nbytes )
+
+
+def _git_commit():
+    try:
+        return subprocess.run( [ 'git', 'rev-parse', 'HEAD' ], capture_output=True, text=True,
+                               check=True ).stdout.strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser( 'bench_tom_clients',
+                                      description="Benchmark the TOM clients against a local fake TOM" )
+    parser.add_argument( '-s', '--scale', default=0.2, type=float,
+                         help="Size of the synthetic data; 1 is about the size of the real probhist table" )
+    parser.add_argument( '-r', '--repeat', default=3, type=int, help="Times to run each benchmark (default 3)" )
+    parser.add_argument( '--latency', default=0., type=float,
+                         help="Seconds the fake server sleeps per request (default 0)" )
+    parser.add_argument( '--seed', default=42, type=int )
+    parser.add_argument( '-o', '--output', default='bench_results.json', help="JSON file to write results to" )
+    args = parser.parse_args()
+
+    logger = logging.getLogger( "bench_tom_clients" )
+    logout = logging.StreamHandler( sys.stderr )
+    logout.setFormatter( logging.Formatter( '[%(asctime)s - %(levelname)s] - %(message)s',
+                                            datefmt='%Y-%m-%d %H:%M:%S' ) )
+    logger.addHandler( logout )
+    logger.setLevel( logging.INFO )
+    logger.propagate = False
+    # The clients log every query result at INFO; that's not what we're timing
+    logging.getLogger().setLevel( logging.WARNING )
+
+    ctx = multiprocessing.get_context( 'spawn' )
+    queue = ctx.Queue()
+    server = ctx.Process( target=_serve, args=( args.scale, args.seed, args.latency, queue ), daemon=True )
+    server.start()
+    try:
+        url = queue.get( timeout=60 )
+        logger.info( f"Fake TOM running at {url}" )
+        bench = Bench( url, args.repeat, logger )
+        bench.all()
+    finally:
+        server.terminate()
+        server.join()
+
+    output = { 'meta': { 'time': datetime.datetime.now( datetime.timezone.utc ).isoformat(),
+                         'git_commit': _git_commit(),
+                         'python': platform.python_version(),
+                         'numpy': numpy.__version__,
+                         'pandas': pandas.__version__,
+                         'platform': platform.platform(),
+                         'scale': args.scale,
+                         'repeat': args.repeat,
+                         'latency': args.latency,
+                         'seed': args.seed },
+               'results': bench.results }
+    with open( args.output, 'w' ) as ofp:
+        json.dump( output, ofp, indent=2 )
+    logger.info( f"Wrote {args.output}" )
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Produce a whole set of confusion matrix outputs with as few server queries as possible.
+
+Running sql_query_conf_matrices_objects.py once per --definition,
+--norm and --include-missed combination logs in each time, reloads the
+taxonomy and classifiers each time, and re-runs the (expensive)
+classification query even when all that differs is --norm, which is
+applied on the client.  This instead takes a JSON file describing every
+output wanted, e.g.
+
+  {
+    "outdir": "report",
+    "outputs": [
+      { "definition": [ "best", "last_best" ],
+        "norm": [ "true", "pred", "all" ],
+        "include_missed": [ false, true ],
+        "format": [ "pdf", "csv" ] },
+      { "definition": "nth", "nth_detection": [ 3, 5 ], "norm": "true",
+        "classifier_id": [ 40, 89 ], "format": "png" }
+    ]
+  }
+
+Every field of an output may be a single value or a list; an output
+stands for every combination of its lists.  Missing fields default to
+definition "last_best", norm "true", include_missed false,
+nth_detection 3, classifier_id null (all classifiers), and format "pdf".
+A format of "csv" writes the counts and the normalized fraction of every
+cell; anything else is a matplotlib plot format.
+
+The outputs are turned into a small task graph:
+
+  query  : one get_classifications call for each distinct (definition,
+           nth_detection, include_missed), for the union of the
+           classifiers any output wants from it.  Up to --jobs of these
+           run at once, all sharing one login.
+  render : as soon as a query's result is in, each (norm, format) that
+           uses it is written: CSVs right away, plots (one per
+           classifier) in a pool of --plot-jobs processes, while the
+           other queries are still running.
+
+A query that fails after it was sent is retried up to --retries times
+(default 0).  If any classifier's query still fails, the report writes
+everything else, then fails with a list of what is missing.
+
+Files go in outdir/{definition}[_missed]/{norm}/{classifier name}.{format}
+for plots, and outdir/{definition}[_missed]/{norm}.csv for CSVs of all
+classifiers, where definition is nth{n} for the nth definition.  A CSV
+of only some classifiers goes in {norm}_classifiers_{id}-{id}-....csv
+instead, so that outputs differing only in classifier_id don't
+overwrite each other.
+
+  python conf_matrix_report.py report.json --jobs 4 --plot-jobs 8 --retries 2
+
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import pandas as pd
+
+import tom_stats
+from sql_query_conf_matrices_objects import ConfMatrixClient, _init_plot_worker, _plot_matrix
+
+
+_defaults = {'definition': 'last_best', 'norm': 'true', 'include_missed': False, 'nth_detection': 3,
+             'classifier_id': None, 'format': 'pdf'}
+
+# (definition, nth_detection, include_missed): everything that changes the server query
+QueryKey = Tuple[str, int, bool]
+
+
+def _as_list(value) -> List:
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def expand_outputs(outputs: List[Dict]) -> List[Dict]:
+    """Expand each output's lists into one dict per combination (see module docs); drops duplicates."""
+    expanded = []
+    for output in outputs:
+        unknown = set(output) - set(_defaults)
+        if len(unknown) > 0:
+            raise ValueError(f'Unknown report output field(s): {sorted(unknown)}')
+        output = {**_defaults, **output}
+        classifier_ids = output.pop('classifier_id')
+        classifier_ids = None if classifier_ids is None else tuple(sorted(int(i) for i in _as_list(classifier_ids)))
+        for combo in itertools.product(*(_as_list(output[k]) for k in output)):
+            one = dict(zip(output.keys(), combo))
+            if one['norm'] not in ('true', 'pred', 'all'):
+                raise ValueError(f"Unknown norm {one['norm']}")
+            ConfMatrixClient._classification_definition_sql(one['definition'], one['nth_detection'])
+            # nth_detection only matters for nth
+            if one['definition'] != 'nth':
+                one['nth_detection'] = _defaults['nth_detection']
+            one['nth_detection'] = int(one['nth_detection'])
+            one['include_missed'] = bool(one['include_missed'])
+            one['classifier_id'] = classifier_ids
+            if one not in expanded:
+                expanded.append(one)
+    return expanded
+
+
+def query_key(output: Dict) -> QueryKey:
+    return output['definition'], output['nth_detection'], output['include_missed']
+
+
+def query_tag(key: QueryKey) -> str:
+    definition, nth, include_missed = key
+    tag = f'nth{nth}' if definition == 'nth' else definition
+    return f'{tag}_missed' if include_missed else tag
+
+
+def csv_name(output: Dict) -> str:
+    """File name (in the query's directory) of a csv output; see module docs."""
+    if output['classifier_id'] is None:
+        return f"{output['norm']}.csv"
+    return f"{output['norm']}_classifiers_{'-'.join(str(i) for i in output['classifier_id'])}.csv"
+
+
+def plan_queries(outputs: List[Dict]) -> Dict[QueryKey, Optional[Set[int]]]:
+    """{ query key: classifier ids to get (None for all) } for a list of expanded outputs."""
+    plan = {}
+    for output in outputs:
+        key = query_key(output)
+        ids = output['classifier_id']
+        if key in plan and plan[key] is None:
+            continue
+        plan[key] = None if ids is None else plan.get(key, set()) | set(ids)
+    return plan
+
+
+def _select(dfs: Dict[int, pd.DataFrame], classifier_ids: Optional[Tuple[int, ...]]) -> Dict[int, pd.DataFrame]:
+    if classifier_ids is None:
+        return dfs
+    return {classifier_id: df for classifier_id, df in dfs.items() if classifier_id in classifier_ids}
+
+
+def fraction_frame(dfs: Dict[int, pd.DataFrame], norm: str) -> pd.DataFrame:
+    """The frames in dfs concatenated, with a fraction column normalized as for norm."""
+    frames = []
+    for matrix in dfs.values():
+        counts, fractions, true_classes, pred_classes = ConfMatrixClient.count_fraction_matrices(matrix, norm)
+        true_grid, pred_grid = np.meshgrid(true_classes, pred_classes, indexing='ij')
+        cells = pd.DataFrame({'true_class': true_grid.ravel(), 'pred_class': pred_grid.ravel(),
+                              'fraction': fractions.ravel()})
+        frames.append(matrix.merge(cells, on=['true_class', 'pred_class'], how='left'))
+    if len(frames) == 0:
+        return pd.DataFrame(columns=['pred_class', 'true_class', 'n', 'classifier_id', 'classifier_name',
+                                     'fraction'])
+    return pd.concat(frames, ignore_index=True)
+
+
+class ConfMatrixReport:
+    """Run a list of report outputs (see module docs) against one ConfMatrixClient."""
+
+    def __init__(self, client: ConfMatrixClient, outputs: List[Dict], outdir='.', *,
+                 jobs: int = 1, plot_jobs: int = 1, batched: bool = False, retries: int = 0):
+        self.client = client
+        self.outputs = expand_outputs(outputs)
+        self.outdir = pathlib.Path(outdir)
+        self.jobs = jobs
+        self.plot_jobs = plot_jobs
+        self.batched = batched
+        self.retries = retries
+        self.plan = plan_queries(self.outputs)
+        # { query key: { classifier id: exception } } for classifiers whose query failed; filled in by run()
+        self.failed: Dict[QueryKey, Dict[int, Exception]] = {}
+
+    def _query(self, key: QueryKey, classifier_ids: Optional[Set[int]]) -> Dict[int, pd.DataFrame]:
+        definition, nth, include_missed = key
+        logging.info(f'Querying classifications for {query_tag(key)}...')
+        # Each query gets its own dict, since several run at once on the one client
+        return self.client.get_classifications(definition=definition, nth_detection=nth,
+                                               classifier_id=classifier_ids, include_missed=include_missed,
+                                               batched=self.batched, retries=self.retries, failed=self.failed[key])
+
+    def _render(self, key: QueryKey, dfs: Dict[int, pd.DataFrame], plotter) -> List:
+        """Write the CSVs that use key's result; return futures of (or, without a pool, do) its plots."""
+        futures = []
+        for output in self.outputs:
+            if query_key(output) != key:
+                continue
+            selected = _select(dfs, output['classifier_id'])
+            tagdir = self.outdir / query_tag(key)
+            if output['format'] == 'csv':
+                tagdir.mkdir(parents=True, exist_ok=True)
+                fraction_frame(selected, output['norm']).to_csv(tagdir / csv_name(output), index=False)
+                continue
+            plotdir = tagdir / output['norm']
+            plotdir.mkdir(parents=True, exist_ok=True)
+            for matrix in selected.values():
+                kwargs = dict(norm=output['norm'], extension=output['format'], outdir=str(plotdir))
+                if plotter is None:
+                    _plot_matrix(self.client.taxonomy, matrix, **kwargs)
+                else:
+                    futures.append(plotter.submit(_plot_matrix, self.client.taxonomy, matrix, **kwargs))
+        return futures
+
+    def run(self) -> Dict[QueryKey, Dict[int, pd.DataFrame]]:
+        """Run every query once and write every output; returns { query key: get_classifications result }.
+
+        Classifiers whose query failed are left out of the outputs that use them; once everything else has been
+        written, a RuntimeError listing them is raised (they're also in self.failed).
+        """
+        logging.info(f'{len(self.outputs)} outputs need {len(self.plan)} queries')
+        # Put every key in before any query starts, so that the query threads only read the outer dict
+        self.failed = {key: {} for key in self.plan}
+        plotter = None
+        if self.plot_jobs > 1:
+            # spawn, as in ConfMatrixClient.plot_matrices
+            plotter = ProcessPoolExecutor(max_workers=self.plot_jobs,
+                                          mp_context=multiprocessing.get_context('spawn'),
+                                          initializer=_init_plot_worker)
+        results = {}
+        plots = []
+        try:
+            with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+                futures = {executor.submit(self._query, key, ids): key for key, ids in self.plan.items()}
+                for future in as_completed(futures):
+                    key = futures[future]
+                    results[key] = future.result()
+                    plots.extend(self._render(key, results[key], plotter))
+            for future in plots:
+                future.result()
+        finally:
+            if plotter is not None:
+                plotter.shutdown(wait=True, cancel_futures=True)
+        failures = [f'{query_tag(key)}: {self.client.classifiers.get(classifier_id, classifier_id)} ({ex})'
+                    for key, failed in self.failed.items() for classifier_id, ex in failed.items()]
+        if len(failures) > 0:
+            raise RuntimeError(f'Report is missing classifications for {len(failures)} classifier(s):\n  '
+                               + '\n  '.join(failures))
+        logging.info('...report done')
+        return results
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog='conf_matrix_report',
+        description='Produce many confusion matrix plots and CSVs, sending each distinct query only once',
+    )
+    parser.add_argument('spec', help='JSON file describing the outputs (see module docs)')
+    parser.add_argument('-o', '--outdir', help='Directory to write to (overrides "outdir" in the spec)')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of queries to run against the server at once (default: 1)')
+    parser.add_argument('--plot-jobs', default=1, type=int,
+                        help='Number of processes to use for plotting (default: 1)')
+    parser.add_argument('--batched', action='store_true',
+                        help='Do each query for all classifiers in one SQL statement')
+    parser.add_argument('--retries', default=0, type=int,
+                        help=('Times to retry a query that fails after it was sent (connection reset, read timeout '
+                              'or 5xx; default: 0)'))
+    parser.add_argument('--stats', metavar='FILE',
+                        help='Write per-query timing stats to FILE (JSON, or CSV if FILE ends in .csv)')
+    return parser.parse_args(args)
+
+
+def main(cli_args=None):
+    args = parse_args(cli_args)
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s - %(levelname)s] %(message)s')
+    with open(args.spec) as ifp:
+        spec = json.load(ifp)
+    username = os.getenv("DESC_TOM_USERNAME", "kostya")
+    password = os.getenv("DESC_TOM_PASSWORD")
+    client = ConfMatrixClient.from_credentials(username, password)
+    report = ConfMatrixReport(client, spec['outputs'], args.outdir or spec.get('outdir', '.'),
+                              jobs=args.jobs, plot_jobs=args.plot_jobs, batched=args.batched, retries=args.retries)
+    report.run()
+    if args.stats is not None:
+        tom_stats.stats.dump(args.stats)
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,434 @@
+"""A local stand-in for the DESC TOM, for timing the clients in this archive offline.
+
+This is NOT a real TOM.  It serves synthetic data, and only knows about
+the handful of endpoints and SQL queries that tom_client.py,
+metric_querier.py, and sql_query_conf_matrices_objects.py send:
+
+  /accounts/login/        GET sets a csrftoken cookie; POST checks
+                          csrfmiddlewaretoken and the password and sets
+                          a sessionid cookie
+  /db/runsqlquery/        recognizes queries by the tables they mention
+                          (see FakeTomData.run_query)
+  /elasticc2/brokerclassfortruetype/{dict,pickle}/{what}/{cfer}/{truetype}
+                          (pickle honors Accept-Encoding: gzip and
+                          Range: bytes=N-, for TomClient.download)
+
+Everything past login requires the sessionid cookie and an X-CSRFToken
+header, like the real thing.
+
+Run it standalone with
+
+  python fake_tom.py --port 8080 --scale 0.1
+
+and point a client at http://127.0.0.1:8080 (any username, password
+"fakepassword"), or use FakeTomServer from python (see
+bench_tom_clients.py).
+
+"""
+
+import sys
+import io
+import re
+import gzip
+import json
+import time
+import hashlib
+import secrets
+import argparse
+import threading
+import http.cookies
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+import pandas
+
+
+password = "fakepassword"
+
+
+class FakeTomData:
+    """Synthetic tables, generated deterministically from seed.
+
+    scale multiplies the size of the big things (the probhist table, the
+    bench_rows table, and the brokerclassfortruetype frames).  scale=1
+    gives a probhist table of roughly the size of the real one.
+
+    """
+
+    def __init__( self, scale=1.0, seed=42, nclassifiers=30 ):
+        self.scale = scale
+        self.seed = seed
+        rng = numpy.random.default_rng( seed )
+
+        self.classids = [ 0, 100, 200, 300, 1000, 1100, 2000, 2100, 2200, 2210, 2220, 2221, 2222, 2223, 2224,
+                          2225, 2226, 2230, 2231, 2232, 2233, 2234, 2235, 2240, 2241, 2242, 2243, 2244, 2245,
+                          2246, 2300, 2310, 2320, 2321, 2322, 2323, 2324, 2325, 2326, 2330, 2331, 2332 ]
+        self.leafclassids = [ c for c in self.classids if c % 10 != 0 and c > 2000 ]
+        self.classifiers = [ { 'classifierId': i + 1,
+                               'brokerName': f'Broker{i % 4}',
+                               'brokerVersion': f'{i // 4}.0',
+                               'classifierName': f'Classifier{i}',
+                               'classifierParams': f'v{i}' }
+                             for i in range( nclassifiers ) ]
+        self._rng = rng
+        self._probhist = None
+        self._bench_rows = None
+        self._latency_rows = None
+        self._frames = {}
+        self._lock = threading.Lock()
+
+    # ----------------------------------------------------------------------
+    # Tables
+
+    def taxonomy_rows( self ):
+        return [ { 'classId': c, 'description': f'Class {c}' } for c in self.classids ]
+
+    def probhist( self ):
+        with self._lock:
+            if self._probhist is None:
+                rng = numpy.random.default_rng( self.seed + 1 )
+                nrows = int( 300000 * self.scale )
+                cols = { 'classifierId': rng.integers( 1, len( self.classifiers ) + 1, nrows ),
+                         'trueClassId': rng.choice( self.leafclassids, nrows ),
+                         'classId': rng.choice( self.leafclassids, nrows ),
+                         'tbin': rng.integers( 0, 28, nrows ),
+                         'probbin': rng.integers( 0, 22, nrows ) }
+                df = pandas.DataFrame( cols ).drop_duplicates()
+                df['count'] = rng.integers( 1, 100000, len( df ) )
+                self._probhist = df
+            return self._probhist
+
+    def bench_rows( self ):
+        """A generic wide-ish table with a unique, ordered id column, for timing run_query."""
+        with self._lock:
+            if self._bench_rows is None:
+                rng = numpy.random.default_rng( self.seed + 2 )
+                nrows = int( 500000 * self.scale )
+                self._bench_rows = pandas.DataFrame( {
+                    'id': numpy.arange( nrows ),
+                    'diaObjectId': rng.integers( 0, 1000000, nrows ),
+                    'classifierId': rng.integers( 1, len( self.classifiers ) + 1, nrows ),
+                    'classId': rng.choice( self.leafclassids, nrows ),
+                    'probability': rng.random( nrows ) } )
+            return self._bench_rows
+
+    def latency_rows( self ):
+        """(brokerMessageId, classifierId) rows with alert / broker / TOM timestamps, as for latency_metrics."""
+        with self._lock:
+            if self._latency_rows is None:
+                rng = numpy.random.default_rng( self.seed + 3 )
+                nrows = int( 200000 * self.scale )
+                # Every broker message has classifications from one broker's classifiers;
+                #  keep it simple and give each row its own message
+                sent = ( numpy.datetime64( '2023-11-01T00:00:00', 'ns' )
+                         + rng.uniform( 0, 60 * 86400e9, nrows ).astype( 'timedelta64[ns]' ) )
+                hdr = sent + ( rng.lognormal( 4., 1., nrows ) * 1e9 ).astype( 'timedelta64[ns]' )
+                ingest = hdr + ( rng.lognormal( 1., 1.5, nrows ) * 1e9 ).astype( 'timedelta64[ns]' )
+                self._latency_rows = pandas.DataFrame( {
+                    'brokerMessageId': numpy.arange( nrows ) + 1,
+                    'classifierId': rng.integers( 1, len( self.classifiers ) + 1, nrows ),
+                    'alertSentTimestamp': numpy.datetime_as_string( sent, unit='us', timezone='UTC' ),
+                    'msgHdrTimestamp': numpy.datetime_as_string( hdr, unit='us', timezone='UTC' ),
+                    'descIngestTimestamp': numpy.datetime_as_string( ingest, unit='us', timezone='UTC' ) } )
+            return self._latency_rows
+
+    def confmatrix_rows( self, classifier_id, include_classifier_id=False ):
+        rng = numpy.random.default_rng( self.seed + 1000 + classifier_id )
+        rows = []
+        for pred in [ None ] + self.leafclassids:
+            for true in self.leafclassids:
+                if rng.random() < 0.3:
+                    row = { 'pred_class': pred, 'true_class': true, 'n': int( rng.integers( 1, 100000 ) ) }
+                    if include_classifier_id:
+                        row = { 'classifier_id': classifier_id, **row }
+                    rows.append( row )
+        return rows
+
+    def brokerclassfortruetype( self, what, cfer, truetype ):
+        key = ( what, cfer, truetype )
+        with self._lock:
+            if key in self._frames:
+                return self._frames[ key ]
+        rng = numpy.random.default_rng( [ self.seed, cfer, truetype ] )
+        nsrc = int( 20000 * self.scale ) + 1
+        srcids = numpy.arange( nsrc, dtype=numpy.int64 ) * 10 + 1000003
+        objids = srcids // 100
+        deltat = rng.uniform( -50., 120., nsrc )
+        if what == 'sources':
+            df = pandas.DataFrame( { 's.diaobject_id': objids,
+                                     's.midpointtai': 60000. + deltat,
+                                     'deltat': deltat,
+                                     'relday': numpy.round( deltat ).astype( int ),
+                                     's.filtername': rng.choice( list( 'ugrizY' ), nsrc ),
+                                     's.psflux': rng.uniform( 100., 5000., nsrc ),
+                                     's.snr': rng.uniform( 3., 50., nsrc ) },
+                                   index=pandas.Index( srcids, name='s.diasource_id' ) )
+        elif what == 'objects':
+            uobj = numpy.unique( objids )
+            df = pandas.DataFrame( { 't.zcmb': rng.uniform( 0.01, 1., len( uobj ) ),
+                                     't.peakmjd': rng.uniform( 60000., 61000., len( uobj ) ),
+                                     't.gentype': 10 },
+                                   index=pandas.Index( uobj, name='s.diaobject_id' ) )
+        elif what == 'classifications':
+            classes = numpy.array( self.leafclassids )
+            prob = rng.dirichlet( numpy.ones( len( classes ) ), nsrc ).ravel()
+            df = pandas.DataFrame( { 'relday': numpy.repeat( numpy.round( deltat ).astype( int ), len( classes ) ),
+                                     'm.probability': prob },
+                                   index=pandas.MultiIndex.from_arrays(
+                                       [ numpy.repeat( srcids, len( classes ) ), numpy.tile( classes, nsrc ) ],
+                                       names=[ 's.diasource_id', 'm.classid' ] ) )
+        elif what == 'meanprobabilities':
+            idx = pandas.MultiIndex.from_product( [ numpy.arange( -20, 91 ), self.leafclassids ],
+                                                  names=[ 'relday', 'm.classid' ] )
+            df = pandas.DataFrame( { 'm.probability': rng.random( len( idx ) ) }, index=idx )
+        elif what == 'maxprobabilities':
+            df = pandas.DataFrame( { 'm.classid': rng.choice( self.leafclassids, 111 ) },
+                                   index=pandas.Index( numpy.arange( -20, 91 ), name='relday' ) )
+        else:
+            raise KeyError( what )
+        with self._lock:
+            self._frames[ key ] = df
+        return df
+
+    # ----------------------------------------------------------------------
+    # SQL
+
+    def run_query( self, query, subdict ):
+        """Return the rows for one of the queries the clients send.
+
+        Queries are recognized by the tables they mention; anything else
+        raises ValueError.  Queries wrapped for keyset paging by tom_sql
+        are paged through bench_rows (the only table here big enough to
+        need it).
+
+        """
+        if 'bench_rows' in query:
+            df = self.bench_rows()
+            match = re.search( r'LIMIT (\d+)', query )
+            if '_keyset_q' in query and match is not None:
+                if '_keyset_0' in subdict:
+                    df = df[ df['id'] > subdict['_keyset_0'] ]
+                df = df.iloc[ :int( match.group( 1 ) ) ]
+            return df.to_dict( orient='records' )
+        if 'msgHdrTimestamp' in query:
+            # As sent by latency_metrics.LatencyMetrics.fetch, paged on ( brokerMessageId, classifierId )
+            df = self.latency_rows()
+            df = df[ df['brokerMessageId'] > subdict.get( 'after', -1 ) ]
+            match = re.search( r'"classifierId" IN \(([\d,]+)\)', query )
+            if match is not None:
+                df = df[ df['classifierId'].isin( [ int(i) for i in match.group( 1 ).split( ',' ) ] ) ]
+            if '_keyset_0' in subdict:
+                after = ( df['brokerMessageId'] > subdict['_keyset_0'] ) | (
+                    ( df['brokerMessageId'] == subdict['_keyset_0'] ) & ( df['classifierId'] > subdict['_keyset_1'] ) )
+                df = df[ after ]
+            match = re.search( r'LIMIT (\d+)', query )
+            if match is not None:
+                df = df.iloc[ :int( match.group( 1 ) ) ]
+            return df.to_dict( orient='records' )
+        if 'elasticc_view_classifications_probmetrics' in query:
+            # Filters as sent by ELAsTiCCMetricsQuerier._fetch_probhist_blocks
+            df = self.probhist()
+            if 'cfers' in subdict:
+                pairs = set( zip( subdict['cfers'], subdict['trues'] ) )
+                df = df[ [ p in pairs for p in zip( df['classifierId'], df['trueClassId'] ) ] ]
+            if 'classids' in subdict:
+                df = df[ df['classId'].isin( subdict['classids'] ) ]
+            if 'tbins' in subdict:
+                df = df[ df['tbin'].isin( subdict['tbins'] ) ]
+            return df.to_dict( orient='records' )
+        if 'best_last' in query:
+            match = re.search( r'"classifierId" IN \(([\d,]+)\)', query )
+            if match is not None:
+                rows = []
+                for cid in match.group( 1 ).split( ',' ):
+                    rows.extend( self.confmatrix_rows( int( cid ), include_classifier_id=True ) )
+                return rows
+            match = re.search( r'"classifierId"=(\d+)', query )
+            return self.confmatrix_rows( int( match.group( 1 ) ) )
+        if 'elasticc_brokerclassifier' in query:
+            return [ dict( c ) for c in self.classifiers ]
+        if 'elasticc_gentypeofclassid' in query:
+            return self.taxonomy_rows()
+        raise ValueError( "The fake TOM doesn't know how to run this query" )
+
+
+class _Handler( BaseHTTPRequestHandler ):
+    protocol_version = 'HTTP/1.1'
+
+    # Set on the subclass made by FakeTomServer
+    data = None
+    latency = 0.
+    sessions = None
+
+    def log_message( self, format, *args ):
+        pass
+
+    def _cookies( self ):
+        jar = http.cookies.SimpleCookie( self.headers.get( 'Cookie', '' ) )
+        return { k: v.value for k, v in jar.items() }
+
+    def _body( self ):
+        n = int( self.headers.get( 'Content-Length', 0 ) )
+        return self.rfile.read( n ) if n > 0 else b''
+
+    def _send( self, status, body, contenttype='application/json', cookies=None, headers=None ):
+        if isinstance( body, str ):
+            body = body.encode( 'utf-8' )
+        self.send_response( status )
+        self.send_header( 'Content-Type', contenttype )
+        self.send_header( 'Content-Length', str( len( body ) ) )
+        for k, v in ( cookies or {} ).items():
+            self.send_header( 'Set-Cookie', f'{k}={v}; Path=/' )
+        for k, v in ( headers or {} ).items():
+            self.send_header( k, v )
+        self.end_headers()
+        self.wfile.write( body )
+
+    def _logged_in( self ):
+        cookies = self._cookies()
+        return ( ( cookies.get( 'sessionid' ) in self.sessions )
+                 and ( self.headers.get( 'X-CSRFToken' ) == cookies.get( 'csrftoken' ) ) )
+
+    def do_GET( self ):
+        self._body()
+        path = urllib.parse.urlparse( self.path ).path
+        if path == '/accounts/login/':
+            self._send( 200, '<html>Log in</html>', 'text/html', { 'csrftoken': secrets.token_hex( 16 ) } )
+        elif path.startswith( '/elasticc2/' ):
+            self._rest( path )
+        else:
+            self._send( 404, 'Not found', 'text/plain' )
+
+    def do_POST( self ):
+        body = self._body()
+        path = urllib.parse.urlparse( self.path ).path
+        if path == '/accounts/login/':
+            form = urllib.parse.parse_qs( body.decode( 'utf-8' ) )
+            cookies = self._cookies()
+            if ( 'csrftoken' not in cookies ) or ( form.get( 'csrfmiddlewaretoken', [''] )[0] != cookies['csrftoken'] ):
+                self._send( 403, 'CSRF verification failed', 'text/plain' )
+            elif form.get( 'password', [''] )[0] != password:
+                self._send( 200, '<html>Please enter a correct username and password.</html>', 'text/html' )
+            else:
+                sessionid = secrets.token_hex( 16 )
+                self.sessions.add( sessionid )
+                self._send( 200, '<html>Logged in</html>', 'text/html', { 'sessionid': sessionid } )
+        elif path == '/db/runsqlquery/':
+            if not self._logged_in():
+                self._send( 403, 'Forbidden', 'text/plain' )
+                return
+            req = json.loads( body )
+            time.sleep( self.latency )
+            try:
+                rows = self.data.run_query( req['query'], req.get( 'subdict', {} ) )
+                self._send( 200, json.dumps( { 'status': 'ok', 'rows': rows } ) )
+            except Exception as ex:
+                self._send( 200, json.dumps( { 'status': 'error', 'error': str( ex ) } ) )
+        elif path.startswith( '/elasticc2/' ):
+            self._rest( path )
+        else:
+            self._send( 404, 'Not found', 'text/plain' )
+
+    def _rest( self, path ):
+        if not self._logged_in():
+            self._send( 403, 'Forbidden', 'text/plain' )
+            return
+        parts = path.strip( '/' ).split( '/' )
+        if ( len( parts ) != 6 ) or ( parts[1] != 'brokerclassfortruetype' ) or ( parts[2] not in ( 'dict', 'pickle' ) ):
+            self._send( 404, 'Not found', 'text/plain' )
+            return
+        _, _, fmt, what, cfer, truetype = parts
+        time.sleep( self.latency )
+        try:
+            df = self.data.brokerclassfortruetype( what, int( cfer ), int( truetype ) )
+        except ( KeyError, ValueError ):
+            self._send( 404, 'Not found', 'text/plain' )
+            return
+        if fmt == 'dict':
+            self._send( 200, json.dumps( df.to_dict( orient='tight' ) ) )
+        else:
+            bio = io.BytesIO()
+            df.to_pickle( bio )
+            self._send_ranged( bio.getvalue(), 'application/octet-stream' )
+
+    def _send_ranged( self, body, contenttype ):
+        # gzip if asked (with a fixed mtime, so the same body always
+        #  compresses to the same bytes), and honor "Range: bytes=N-"
+        headers = { 'Accept-Ranges': 'bytes' }
+        if 'gzip' in self.headers.get( 'Accept-Encoding', '' ):
+            body = gzip.compress( body, mtime=0 )
+            headers['Content-Encoding'] = 'gzip'
+        etag = f'"{hashlib.sha1( body ).hexdigest()}"'
+        headers['ETag'] = etag
+        match = re.fullmatch( r'bytes=(\d+)-', self.headers.get( 'Range', '' ) )
+        ifrange = self.headers.get( 'If-Range' )
+        if ( match is None ) or ( ( ifrange is not None ) and ( ifrange != etag ) ):
+            self._send( 200, body, contenttype, headers=headers )
+            return
+        start = int( match.group( 1 ) )
+        if start >= len( body ):
+            self._send( 416, b'', contenttype, headers={ 'Content-Range': f'bytes */{len( body )}' } )
+            return
+        headers['Content-Range'] = f'bytes {start}-{len( body ) - 1}/{len( body )}'
+        self._send( 206, body[ start: ], contenttype, headers=headers )
+
+
+class FakeTomServer:
+    """Run the fake TOM in a background thread.
+
+      with FakeTomServer( scale=0.1 ) as server:
+          tc = TomClient( url=server.url, username='x', password=fake_tom.password )
+
+    latency is extra time (in seconds) the server sleeps on every SQL
+    query or REST request, to make it behave a bit more like a database
+    that actually has to do some work.
+
+    """
+
+    def __init__( self, scale=1.0, seed=42, latency=0., host='127.0.0.1', port=0 ):
+        self.data = FakeTomData( scale=scale, seed=seed )
+        handler = type( '_BoundHandler', ( _Handler, ),
+                        { 'data': self.data, 'latency': latency, 'sessions': set() } )
+        self.httpd = ThreadingHTTPServer( ( host, port ), handler )
+        self.httpd.daemon_threads = True
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+        self._thread = None
+
+    def start( self ):
+        self._thread = threading.Thread( target=self.httpd.serve_forever, daemon=True )
+        self._thread.start()
+        return self
+
+    def stop( self ):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self._thread.join()
+
+    def __enter__( self ):
+        return self.start()
+
+    def __exit__( self, *args ):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser( 'fake_tom', description="Run a fake DESC TOM with synthetic data" )
+    parser.add_argument( '--host', default='127.0.0.1' )
+    parser.add_argument( '-p', '--port', default=8080, type=int )
+    parser.add_argument( '-s', '--scale', default=1.0, type=float, help="Size of synthetic data (default 1)" )
+    parser.add_argument( '--seed', default=42, type=int )
+    parser.add_argument( '--latency', default=0., type=float, help="Extra seconds to sleep per request" )
+    args = parser.parse_args()
+
+    server = FakeTomServer( scale=args.scale, seed=args.seed, latency=args.latency, host=args.host, port=args.port )
+    sys.stderr.write( f"Fake TOM at {server.url} ; password is {password}\n" )
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+# ======================================================================
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,476 @@
+"""Alert-to-classification latency metrics, computed in bounded memory.
+
+For every (broker message, classifier) pair, the TOM knows when the
+alert was sent (elasticc_diaalert.alertSentTimestamp), when the broker
+sent its message (elasticc_brokermessage.msgHdrTimestamp), and when the
+TOM ingested it (elasticc_brokermessage.descIngestTimestamp).  From those,
+three latencies (in seconds):
+
+  broker : msgHdrTimestamp - alertSentTimestamp
+  tom    : descIngestTimestamp - msgHdrTimestamp
+  total  : descIngestTimestamp - alertSentTimestamp
+
+There are far too many of those rows to pull down at once, so
+LatencyMetrics.fetch pages through them (see tom_sql.py) and folds each
+chunk into, for each slice (e.g. each classifier, or each broker version,
+or each hour of the campaign):
+
+  * a QuantileSketch per latency, which gives quantiles (p50, p90, p99,
+    ...) to within a fixed relative error whatever the number of values,
+    in memory that only grows with the log of the range of the values
+  * a fixed-bin histogram per latency (bins as in local_metrics)
+  * counts of rows per bin of TOM ingestion time (throughput)
+
+All of these are mergeable: two LatencyMetrics built with the same
+settings can be merge()d, and save() / load() write and read them as
+JSON, so results from separate runs (or separate ranges of broker
+messages) can be combined without pulling the data again.  A
+LatencyMetrics remembers the highest brokerMessageId it has seen, and
+by default fetch() only pulls newer messages, so:
+
+  lm = latency_metrics.LatencyMetrics.load( 'latency.json' )
+  lm.fetch( querier )
+  lm.save( 'latency.json' )
+  print( lm.quantiles() )
+
+keeps a running set of metrics up to date.  (As with the incremental
+confusion matrices, this assumes broker messages get increasing ids.)
+
+Usage:
+
+  lm = LatencyMetrics( by=[ 'brokerName', 'brokerVersion' ] )
+  lm.fetch( client )     # an ELAsTiCCMetricsQuerier, ConfMatrixClient, or TomClient
+  lm.quantiles()         # count, p50, p90, p99 per slice and latency
+  lm.throughput()        # rows per hour per slice
+  lm.histograms()        # fixed-bin latency histograms per slice
+
+Slices are given by by, a list of any of classifierId, brokerName,
+brokerVersion, classifierName (looked up from elasticc_brokerclassifier
+once, not sent with every row), and hour or day (of alertSentTimestamp).
+by=[] gives a single slice of everything.
+
+"""
+
+import json
+import math
+import functools
+
+import numpy
+import pandas
+
+import tom_sql
+import local_metrics
+
+
+_latencies = { 'broker': ( 'alertSentTimestamp', 'msgHdrTimestamp' ),
+               'tom': ( 'msgHdrTimestamp', 'descIngestTimestamp' ),
+               'total': ( 'alertSentTimestamp', 'descIngestTimestamp' ) }
+
+_timestamps = [ 'alertSentTimestamp', 'msgHdrTimestamp', 'descIngestTimestamp' ]
+
+_classifier_columns = [ 'brokerName', 'brokerVersion', 'classifierName' ]
+
+_time_slices = { 'hour': 3600, 'day': 86400 }
+
+# 1 s to ~11.6 days, four bins per decade
+default_latency_bins = numpy.logspace( 0., 6., 25 )
+
+_latency_schema = { 'brokerMessageId': numpy.int64, 'classifierId': numpy.int64 }
+
+
+def latency_query( classifierIds=None ):
+    """The SQL (for tom_sql paging on brokerMessageId, classifierId) that fetch() sends.
+
+    Rows are one per (broker message, classifier) with the three
+    timestamps; only messages with brokerMessageId > %(after)s, for
+    alerts that were sent, are included.
+
+    """
+    where = ''
+    if classifierIds is not None:
+        where = ( 'WHERE "classifierId" IN ('
+                  + ','.join( str( int(i) ) for i in classifierIds ) + ') ' )
+    return ( 'SELECT m."brokerMessageId", bc."classifierId", a."alertSentTimestamp", '
+             '  m."msgHdrTimestamp", m."descIngestTimestamp" '
+             'FROM ( SELECT DISTINCT "brokerMessageId", "classifierId" '
+             f'       FROM elasticc_brokerclassification {where}) bc '
+             'INNER JOIN elasticc_brokermessage m ON bc."brokerMessageId"=m."brokerMessageId" '
+             'INNER JOIN elasticc_diaalert a ON m."alertId"=a."alertId" '
+             'WHERE a."alertSentTimestamp" IS NOT NULL AND m."brokerMessageId" > %(after)s' )
+
+
+def timestamps_to_ns( values ):
+    """Convert timestamps (ISO strings as they come out of the TOM, or datetimes) to ns as float64; NULL is NaN."""
+    ts = pandas.DatetimeIndex( pandas.to_datetime( values, utc=True, format='ISO8601' ) ).as_unit( 'ns' )
+    ns = ts.asi8.astype( numpy.float64 )
+    ns[ ts.isna() ] = numpy.nan
+    return ns
+
+
+class QuantileSketch:
+    """A mergeable sketch of a distribution of non-negative values, for quantiles with bounded relative error.
+
+    Values are counted in logarithmic buckets: bucket i holds values in
+    ( gamma^(i-1), gamma^i ] with gamma = (1+a)/(1-a), a being
+    relative_accuracy.  A quantile is reported as the middle of its
+    bucket, which is within a factor of (1±a) of the true value.  Values
+    below min_value (including negative ones, e.g. from clock skew) are
+    counted together and reported as min_value.
+
+    Two sketches with the same relative_accuracy and min_value can be
+    merged exactly by adding bucket counts.
+
+    """
+
+    def __init__( self, relative_accuracy=0.01, min_value=1e-3 ):
+        if not ( 0. < relative_accuracy < 1. ):
+            raise ValueError( f"relative_accuracy must be in (0, 1), not {relative_accuracy}" )
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self._gamma = ( 1. + relative_accuracy ) / ( 1. - relative_accuracy )
+        self._lngamma = math.log( self._gamma )
+        # _counts[j] is the count of bucket _offset + j
+        self._offset = 0
+        self._counts = numpy.zeros( 0, dtype=numpy.int64 )
+        self.low_count = 0
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _grow( self, lo, hi ):
+        """Make sure buckets lo through hi have a place in _counts."""
+        if len( self._counts ) == 0:
+            self._offset = lo
+            self._counts = numpy.zeros( hi - lo + 1, dtype=numpy.int64 )
+            return
+        curhi = self._offset + len( self._counts ) - 1
+        newlo = min( lo, self._offset )
+        newhi = max( hi, curhi )
+        if ( newlo == self._offset ) and ( newhi == curhi ):
+            return
+        counts = numpy.zeros( newhi - newlo + 1, dtype=numpy.int64 )
+        counts[ self._offset - newlo : self._offset - newlo + len( self._counts ) ] = self._counts
+        self._offset = newlo
+        self._counts = counts
+
+    def add( self, values ):
+        """Add an array of values (NaNs are ignored)."""
+        values = numpy.asarray( values, dtype=numpy.float64 )
+        values = values[ ~numpy.isnan( values ) ]
+        if len( values ) == 0:
+            return
+        low = values < self.min_value
+        self.low_count += int( low.sum() )
+        high = values[ ~low ]
+        if len( high ) > 0:
+            idx = numpy.ceil( numpy.log( high ) / self._lngamma ).astype( numpy.int64 )
+            lo = int( idx.min() )
+            counts = numpy.bincount( idx - lo )
+            self._grow( lo, lo + len( counts ) - 1 )
+            self._counts[ lo - self._offset : lo - self._offset + len( counts ) ] += counts
+        self.count += len( values )
+        self.sum += float( values.sum() )
+        self.min = min( self.min, float( values.min() ) )
+        self.max = max( self.max, float( values.max() ) )
+
+    def merge( self, other ):
+        """Add the contents of other (a QuantileSketch with the same settings) to this one."""
+        if ( other.relative_accuracy != self.relative_accuracy ) or ( other.min_value != self.min_value ):
+            raise ValueError( "Can only merge QuantileSketches with the same relative_accuracy and min_value" )
+        if len( other._counts ) > 0:
+            self._grow( other._offset, other._offset + len( other._counts ) - 1 )
+            start = other._offset - self._offset
+            self._counts[ start : start + len( other._counts ) ] += other._counts
+        self.low_count += other.low_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min( self.min, other.min )
+        self.max = max( self.max, other.max )
+        return self
+
+    def quantile( self, q ):
+        """The q quantile(s) (q a number or array in [0, 1]); NaN if the sketch is empty."""
+        qs = numpy.atleast_1d( numpy.asarray( q, dtype=numpy.float64 ) )
+        if self.count == 0:
+            rval = numpy.full( qs.shape, numpy.nan )
+        else:
+            cum = numpy.cumsum( numpy.concatenate( [ [ self.low_count ], self._counts ] ) )
+            pos = numpy.searchsorted( cum, qs * ( self.count - 1 ), side='right' )
+            pos = numpy.minimum( pos, len( cum ) - 1 )
+            bucket = self._offset + pos - 1
+            rval = 2. * self._gamma ** bucket / ( self._gamma + 1. )
+            rval[ pos == 0 ] = self.min_value
+            rval = numpy.clip( rval, self.min, self.max )
+        return rval[0] if numpy.isscalar( q ) else rval
+
+    @property
+    def mean( self ):
+        return self.sum / self.count if self.count > 0 else math.nan
+
+    def to_dict( self ):
+        return { 'relative_accuracy': self.relative_accuracy, 'min_value': self.min_value,
+                 'offset': self._offset, 'counts': self._counts.tolist(), 'low_count': self.low_count,
+                 'count': self.count, 'sum': self.sum,
+                 'min': self.min if self.count > 0 else None, 'max': self.max if self.count > 0 else None }
+
+    @classmethod
+    def from_dict( cls, d ):
+        sketch = cls( d['relative_accuracy'], d['min_value'] )
+        sketch._offset = d['offset']
+        sketch._counts = numpy.array( d['counts'], dtype=numpy.int64 )
+        sketch.low_count = d['low_count']
+        sketch.count = d['count']
+        sketch.sum = d['sum']
+        sketch.min = math.inf if d['min'] is None else d['min']
+        sketch.max = -math.inf if d['max'] is None else d['max']
+        return sketch
+
+
+def _plain( value ):
+    """numpy scalars -> python, so that slice keys compare equal and go into JSON."""
+    return value.item() if isinstance( value, numpy.generic ) else value
+
+
+class LatencyMetrics:
+    """Latency quantiles, histograms and throughput per slice; see module docs."""
+
+    def __init__( self, by=( 'classifierId', ), relative_accuracy=0.01, latency_bins=default_latency_bins,
+                  timebin=3600, classifiers=None ):
+        """Make an empty set of metrics.
+
+        by : list of columns to slice on (see module docs)
+
+        relative_accuracy : of the quantile sketches
+
+        latency_bins : bins for the latency histograms, in seconds, as
+          for local_metrics.width_bucket
+
+        timebin : width in seconds of the throughput bins
+
+        classifiers : { classifierId: { 'brokerName': ..., 'brokerVersion': ...,
+          'classifierName': ... } }; only needed if by has any of those,
+          and fetch() fills it in if it's None
+
+        """
+        self.by = list( by )
+        for col in self.by:
+            if col not in ( [ 'classifierId' ] + _classifier_columns + list( _time_slices ) ):
+                raise ValueError( f"Can't slice on {col}" )
+        self.relative_accuracy = relative_accuracy
+        self.latency_bins = ( latency_bins if isinstance( latency_bins, tuple )
+                              else numpy.asarray( latency_bins, dtype=numpy.float64 ) )
+        self.timebin = int( timebin )
+        self.classifiers = classifiers
+        self.high_water = -1
+        # slice key tuple -> { 'sketch': { latency: QuantileSketch }, 'hist': { latency: array },
+        #                      'throughput': { time bin number: count } }
+        self._slices = {}
+
+    def _settings( self ):
+        bins = list( self.latency_bins ) if isinstance( self.latency_bins, tuple ) else self.latency_bins.tolist()
+        return { 'by': self.by, 'relative_accuracy': self.relative_accuracy,
+                 'latency_bins': bins, 'latency_bins_tuple': isinstance( self.latency_bins, tuple ),
+                 'timebin': self.timebin }
+
+    def _new_slice( self ):
+        nbins = local_metrics.nbuckets( self.latency_bins )
+        return { 'sketch': { lat: QuantileSketch( self.relative_accuracy ) for lat in _latencies },
+                 'hist': { lat: numpy.zeros( nbins, dtype=numpy.int64 ) for lat in _latencies },
+                 'throughput': {} }
+
+    def _slice_columns( self, df, ns ):
+        cols = {}
+        for col in self.by:
+            if col == 'classifierId':
+                cols[col] = df['classifierId'].to_numpy()
+            elif col in _classifier_columns:
+                if self.classifiers is None:
+                    raise RuntimeError( f"Need classifiers to slice on {col}" )
+                cols[col] = df['classifierId'].map( lambda i: self.classifiers[i][col] ).to_numpy()
+            else:
+                width = _time_slices[col] * 1_000_000_000
+                sent = ns['alertSentTimestamp']
+                cols[col] = ( numpy.floor( sent / width ) * width ).astype( numpy.int64 )
+        return pandas.DataFrame( cols )
+
+    def add_chunk( self, df ):
+        """Fold in a frame with brokerMessageId, classifierId, and the three timestamps (see latency_query)."""
+        if len( df ) == 0:
+            return
+        ns = { col: timestamps_to_ns( df[col] ) for col in _timestamps }
+        lat = { name: ( ns[t1] - ns[t0] ) / 1e9 for name, ( t0, t1 ) in _latencies.items() }
+        ingestbin = numpy.floor( ns['descIngestTimestamp'] / ( self.timebin * 1e9 ) )
+
+        if len( self.by ) == 0:
+            groups = { (): numpy.arange( len( df ) ) }
+        else:
+            keys = self._slice_columns( df, ns )
+            groups = keys.groupby( self.by, sort=False, dropna=False ).indices
+        for key, pos in groups.items():
+            key = tuple( _plain( k ) for k in ( key if isinstance( key, tuple ) else ( key, ) ) )
+            slc = self._slices.get( key )
+            if slc is None:
+                slc = self._slices[key] = self._new_slice()
+            for name, vals in lat.items():
+                vals = vals[ pos ]
+                vals = vals[ ~numpy.isnan( vals ) ]
+                slc['sketch'][name].add( vals )
+                slc['hist'][name] += numpy.bincount( local_metrics.width_bucket( vals, self.latency_bins ),
+                                                     minlength=len( slc['hist'][name] ) )
+            tbins = ingestbin[ pos ]
+            tbins, counts = numpy.unique( tbins[ ~numpy.isnan( tbins ) ].astype( numpy.int64 ), return_counts=True )
+            for tbin, count in zip( tbins.tolist(), counts.tolist() ):
+                slc['throughput'][tbin] = slc['throughput'].get( tbin, 0 ) + count
+        self.high_water = max( self.high_water, int( df['brokerMessageId'].max() ) )
+
+    def fetch( self, client, chunksize=1000000, classifierIds=None, after=None ):
+        """Page through the latency rows from the TOM and add them.
+
+        client : an ELAsTiCCMetricsQuerier, ConfMatrixClient, or TomClient
+
+        classifierIds : None for all classifiers, or a list
+
+        after : only pull broker messages with ids greater than this;
+          defaults to the highest one already added
+
+        Returns self.
+
+        """
+        if ( self.classifiers is None ) and any( col in _classifier_columns for col in self.by ):
+            self.classifiers = self._fetch_classifiers( client )
+        after = self.high_water if after is None else after
+        # Not through the query cache; these are big and only read once
+        if hasattr( client, 'run_query_chunked' ):
+            chunked = client.run_query_chunked
+        elif hasattr( client, 'query_chunked' ):
+            chunked = client.query_chunked
+        else:
+            chunked = functools.partial( tom_sql.iter_frames, functools.partial( client.query_frame, cache=False ) )
+        for chunk in chunked( latency_query( classifierIds ), [ 'brokerMessageId', 'classifierId' ],
+                              subdict={ 'after': int( after ) }, chunksize=chunksize, schema=_latency_schema ):
+            self.add_chunk( chunk )
+        return self
+
+    @staticmethod
+    def _fetch_classifiers( client ):
+        query_frame = getattr( client, 'run_query_frame', None ) or client.query_frame
+        df = query_frame( 'SELECT "classifierId","brokerName","brokerVersion","classifierName" '
+                          'FROM elasticc_brokerclassifier' )
+        if df is None:
+            raise RuntimeError( "Failed to get classifiers" )
+        return { int( row['classifierId'] ): row for row in df.to_dict( orient='records' ) }
+
+    def merge( self, other ):
+        """Add other's metrics (built with the same settings) into these.  Returns self."""
+        if other._settings() != self._settings():
+            raise ValueError( "Can only merge LatencyMetrics with the same by, bins, timebin and accuracy" )
+        for key, oslc in other._slices.items():
+            slc = self._slices.get( key )
+            if slc is None:
+                slc = self._slices[key] = self._new_slice()
+            for name in _latencies:
+                slc['sketch'][name].merge( oslc['sketch'][name] )
+                slc['hist'][name] += oslc['hist'][name]
+            for tbin, count in oslc['throughput'].items():
+                slc['throughput'][tbin] = slc['throughput'].get( tbin, 0 ) + count
+        if self.classifiers is None:
+            self.classifiers = other.classifiers
+        self.high_water = max( self.high_water, other.high_water )
+        return self
+
+    def _index( self, keys, extra=None, extravals=None ):
+        names = list( self.by ) + ( [] if extra is None else [ extra ] )
+        if len( names ) == 0:
+            return pandas.RangeIndex( len( keys ) )
+        arrays = [ [ k[i] for k in keys ] for i in range( len( self.by ) ) ]
+        for i, col in enumerate( self.by ):
+            if col in _time_slices:
+                arrays[i] = pandas.to_datetime( arrays[i], unit='ns', utc=True )
+        if extra is not None:
+            arrays.append( extravals )
+        return pandas.MultiIndex.from_arrays( arrays, names=names )
+
+    def quantiles( self, qs=( 0.5, 0.9, 0.99 ) ):
+        """DataFrame indexed by the slice columns and latency, with count, mean, min, max, and p{100q} columns."""
+        rows = []
+        keys = []
+        names = []
+        for key in sorted( self._slices, key=lambda k: tuple( str(v) for v in k ) ):
+            for name in _latencies:
+                sketch = self._slices[key]['sketch'][name]
+                row = { 'count': sketch.count, 'mean_s': sketch.mean,
+                        'min_s': sketch.min if sketch.count > 0 else numpy.nan,
+                        'max_s': sketch.max if sketch.count > 0 else numpy.nan }
+                for q, val in zip( qs, numpy.atleast_1d( sketch.quantile( qs ) ) ):
+                    row[ f'p{100*q:g}_s' ] = val
+                rows.append( row )
+                keys.append( key )
+                names.append( name )
+        return pandas.DataFrame( rows, index=self._index( keys, 'latency', names ) )
+
+    def histograms( self ):
+        """DataFrame indexed by the slice columns, latency, and bin number, with count."""
+        keys, names, bins, counts = [], [], [], []
+        for key, slc in self._slices.items():
+            for name in _latencies:
+                hist = slc['hist'][name]
+                keys.extend( [ key ] * len( hist ) )
+                names.extend( [ name ] * len( hist ) )
+                bins.append( numpy.arange( len( hist ) ) )
+                counts.append( hist )
+        if len( keys ) == 0:
+            return pandas.DataFrame( { 'count': pandas.Series( [], dtype=numpy.int64 ) } )
+        idx = self._index( keys, 'latency', names )
+        idx = pandas.MultiIndex.from_arrays( [ idx.get_level_values( i ) for i in range( idx.nlevels ) ]
+                                             + [ numpy.concatenate( bins ) ], names=list( idx.names ) + [ 'bin' ] )
+        return pandas.DataFrame( { 'count': numpy.concatenate( counts ) }, index=idx ).sort_index()
+
+    def throughput( self ):
+        """DataFrame indexed by the slice columns and start of TOM ingestion time bin, with count and per_s."""
+        keys, starts, counts = [], [], []
+        for key, slc in self._slices.items():
+            for tbin, count in slc['throughput'].items():
+                keys.append( key )
+                starts.append( tbin * self.timebin )
+                counts.append( count )
+        idx = self._index( keys, 'time', pandas.to_datetime( starts, unit='s', utc=True ) )
+        df = pandas.DataFrame( { 'count': numpy.array( counts, dtype=numpy.int64 ) }, index=idx ).sort_index()
+        df['per_s'] = df['count'] / self.timebin
+        return df
+
+    def to_dict( self ):
+        return { 'settings': self._settings(),
+                 'high_water': self.high_water,
+                 'classifiers': None if self.classifiers is None else list( self.classifiers.values() ),
+                 'slices': [ { 'key': list( key ),
+                               'sketch': { n: s.to_dict() for n, s in slc['sketch'].items() },
+                               'hist': { n: h.tolist() for n, h in slc['hist'].items() },
+                               'throughput': [ [ t, c ] for t, c in slc['throughput'].items() ] }
+                             for key, slc in self._slices.items() ] }
+
+    @classmethod
+    def from_dict( cls, d ):
+        settings = d['settings']
+        bins = settings['latency_bins']
+        lm = cls( by=settings['by'], relative_accuracy=settings['relative_accuracy'],
+                  latency_bins=tuple( bins ) if settings['latency_bins_tuple'] else bins,
+                  timebin=settings['timebin'],
+                  classifiers=( None if d['classifiers'] is None
+                                else { int( c['classifierId'] ): c for c in d['classifiers'] } ) )
+        lm.high_water = d['high_water']
+        for slc in d['slices']:
+            lm._slices[ tuple( slc['key'] ) ] = {
+                'sketch': { n: QuantileSketch.from_dict( s ) for n, s in slc['sketch'].items() },
+                'hist': { n: numpy.array( h, dtype=numpy.int64 ) for n, h in slc['hist'].items() },
+                'throughput': { int(t): int(c) for t, c in slc['throughput'] } }
+        return lm
+
+    def save( self, path ):
+        with open( path, 'w' ) as ofp:
+            json.dump( self.to_dict(), ofp )
+
+    @classmethod
+    def load( cls, path ):
+        with open( path ) as ifp:
+            return cls.from_dict( json.load( ifp ) )
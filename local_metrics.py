@@ -0,0 +1,340 @@
+"""Client-side aggregation of per-source broker classifications.
+
+The metrics in ELAsTiCCMetricsQuerier (metric_querier.py) come from
+materialized views on the server, whose binning was fixed when the views
+were built.  The functions and classes here compute the same kinds of
+things locally from the frames you get from the REST API:
+
+  elasticc2/brokerclassfortruetype/pickle/classifications/{cfer}/{truetype}
+     indexed by ( s.diasource_id, m.classid ), columns relday, m.probability
+
+  elasticc2/brokerclassfortruetype/pickle/sources/{cfer}/{truetype}
+     indexed by s.diasource_id, columns include s.diaobject_id, deltat
+
+(See elasticc2_rest_metric_demo.ipynb for how to get those.)  Everything
+is done with whole-array numpy operations, in chunks of rows so that
+memory use stays bounded even for the 200-million-row classification
+frames.
+
+Binning follows the postgres width_bucket function, which is what the
+server views use.  A set of bins is given either as a tuple ( low, high,
+nbins ), meaning nbins equal-width bins between low and high, or as an
+array of bin edges.  Bin 0 is everything below the lowest edge, bin i is
+[ edge[i-1], edge[i] ), and bin len(edges) is everything at or above the
+highest edge (so probability 1.0 is in the last, open, bin).
+
+"""
+
+import numpy
+import pandas
+
+
+# The binning of elasticc_view_classifications_probmetrics
+default_tbins = ( -30., 100., 26 )
+default_probbins = ( 0., 1., 20 )
+
+# The probability difference bins of elasticc_view_maxprobdiff_hist (see
+#  ELAsTiCCMetricsQuerier.right_probdiffs_hist_probbin_mean): 41 bins of
+#  width 0.05 centered on -1.00, -0.95, ..., 1.00
+default_probdiffbins = ( -1.025, 1.025, 41 )
+
+
+def nbuckets( bins ):
+    """Number of distinct bucket numbers (including the two open ends) for bins."""
+    if isinstance( bins, tuple ):
+        return int( bins[2] ) + 2
+    return len( bins ) + 1
+
+
+def width_bucket( values, bins ):
+    """Vectorized version of postgres' width_bucket.
+
+    values : numpy array of values to bin
+
+    bins : ( low, high, nbins ) or an array of bin edges; see module docs
+
+    Returns an int32 array of bucket numbers in [ 0, nbuckets(bins)-1 ].
+    NaN values go into the top bucket (as they sort above everything in
+    postgres).
+
+    """
+    values = numpy.asarray( values, dtype=numpy.float64 )
+    if isinstance( bins, tuple ):
+        low, high, nbins = bins
+        nbins = int( nbins )
+        # Same arithmetic as postgres (src/backend/utils/adt/float.c)
+        #  so that we land in the same bucket for values right at an edge.
+        with numpy.errstate( invalid='ignore' ):
+            frac = nbins * ( ( values - low ) / ( high - low ) )
+            bucket = numpy.floor( numpy.minimum( frac, nbins - 1 ) ).astype( numpy.int32 ) + 1
+            bucket[ values < low ] = 0
+            bucket[ ~( values < high ) ] = nbins + 1
+        return bucket
+    edges = numpy.asarray( bins, dtype=numpy.float64 )
+    if ( len( edges ) < 2 ) or numpy.any( numpy.diff( edges ) <= 0 ):
+        raise ValueError( "Bin edges must be at least two strictly increasing values" )
+    return numpy.searchsorted( edges, values, side='right' ).astype( numpy.int32 )
+
+
+def _level_or_column( df, name ):
+    if name in df.index.names:
+        return df.index.get_level_values( name ).values
+    return df[ name ].values
+
+
+def _source_positions( srcid, cifysrc ):
+    """Positions in sorted srcid of the sources cifysrc; returns ( pos, found ), pos only for those found."""
+    if len( srcid ) == 0:
+        return numpy.zeros( 0, dtype=numpy.intp ), numpy.zeros( len( cifysrc ), dtype=bool )
+    pos = numpy.searchsorted( srcid, cifysrc )
+    pos[ pos >= len( srcid ) ] = 0
+    found = srcid[ pos ] == cifysrc
+    return pos[ found ], found
+
+
+class ProbHistogrammer:
+    """Build probhist-style histograms from per-source classification frames.
+
+    Usage:
+
+      ph = ProbHistogrammer( tbins=( -30, 100, 52 ), probbins=( 0, 1, 40 ) )
+      ph.add( classificationsdf, sourcesdf, classifierId=13, trueClassId=2222 )
+      ... more add() calls for other classifiers / true types ...
+      df = ph.probhist()
+
+    df has the same layout as ELAsTiCCMetricsQuerier.probhist(): a
+    MultiIndex of ( classifierId, trueClassId, classId, tbin, probbin )
+    and a single count column.  With the default bins (those of the
+    server view), tbin and probbin mean the same thing as they do there,
+    so you can use tbin_val and probbin_val on the querier, and compare
+    the two tables.  (Counts may not match exactly: the server view
+    averages the probabilities of duplicate classifications of the same
+    source, whereas the classifications endpoint keeps only the latest.)
+
+    tbin is computed from the deltat column of the sources frame (the
+    source's midpointtai minus the object's peak mjd from the truth
+    table).
+
+    """
+
+    def __init__( self, tbins=default_tbins, probbins=default_probbins ):
+        self.tbins = tbins
+        self.probbins = probbins
+        self._ntbins = nbuckets( tbins )
+        self._nprobbins = nbuckets( probbins )
+        self._partials = []
+        self._probhist = None
+
+    def add( self, classifications, sources, classifierId, trueClassId, chunksize=10000000 ):
+        """Histogram one classifier / true type pair's classifications.
+
+        classifications : frame from the brokerclassfortruetype classifications endpoint
+
+        sources : frame from the brokerclassfortruetype sources endpoint
+          (for the same classifier and true type); only s.diasource_id and
+          deltat are used
+
+        classifierId, trueClassId : the classifier and true type these
+          frames are for; used for the index of the output
+
+        chunksize : number of classification rows to process at once
+
+        Classifications whose source isn't in sources are skipped.
+
+        """
+        srcid = _level_or_column( sources, 's.diasource_id' )
+        srcorder = numpy.argsort( srcid, kind='stable' )
+        srcid = srcid[ srcorder ]
+        srctbin = width_bucket( sources['deltat'].values, self.tbins )[ srcorder ]
+
+        cifysrc = _level_or_column( classifications, 's.diasource_id' )
+        cifyclass = _level_or_column( classifications, 'm.classid' )
+        cifyprob = _level_or_column( classifications, 'm.probability' )
+
+        nbins = self._ntbins * self._nprobbins
+        for i0 in range( 0, len( cifysrc ), chunksize ):
+            sl = slice( i0, i0 + chunksize )
+            pos, found = _source_positions( srcid, cifysrc[sl] )
+            tbin = srctbin[ pos ]
+            probbin = width_bucket( cifyprob[sl][ found ], self.probbins )
+            classcodes, classids = pandas.factorize( cifyclass[sl][ found ] )
+            key = ( classcodes.astype( numpy.int64 ) * self._ntbins + tbin ) * self._nprobbins + probbin
+            counts = numpy.bincount( key, minlength=len( classids ) * nbins )
+            nonzero = numpy.nonzero( counts )[0]
+            self._partials.append( pandas.DataFrame( {
+                'classifierId': classifierId,
+                'trueClassId': trueClassId,
+                'classId': numpy.asarray( classids )[ nonzero // nbins ],
+                'tbin': ( nonzero // self._nprobbins ) % self._ntbins,
+                'probbin': nonzero % self._nprobbins,
+                'count': counts[ nonzero ] } ) )
+        self._probhist = None
+
+    def probhist( self ):
+        """Return the histogram of everything add()ed so far."""
+        if self._probhist is None:
+            idx = [ 'classifierId', 'trueClassId', 'classId', 'tbin', 'probbin' ]
+            if len( self._partials ) == 0:
+                self._probhist = pandas.DataFrame( { 'count': pandas.Series( [], dtype=numpy.int64 ) },
+                                                   index=pandas.MultiIndex.from_tuples( [], names=idx ) )
+            else:
+                df = pandas.concat( self._partials, ignore_index=True )
+                self._probhist = df.groupby( idx ).sum()
+                # Keep only the combined table, not the pieces
+                self._partials = [ self._probhist.reset_index() ]
+        return self._probhist.copy( deep=True )
+
+
+class ProbDiffer:
+    """Max-probability differences between time windows, from per-source classification frames.
+
+    This does locally what the server views elasticc_view_maxprobdiff
+    and elasticc_view_maxprobdiff_hist (ELAsTiCCMetricsQuerier's
+    right_probdiffs_for_object(s) and right_probdiffs_hist) do, but with
+    whatever time windows you like.  Usage:
+
+      pd = ProbDiffer( timebins=[ ( -99999, -10 ), ( -10, 0 ), ( 0, 20 ), ( 20, 99999 ) ] )
+      pd.add( classificationsdf, sourcesdf, classifierId=13, trueClassId=2222 )
+      ... more add() calls for other classifiers / true types ...
+      objdf = pd.probdiffs()
+      histdf = pd.hist()
+
+    timebins is a list of ( dtmin, dtmax ) windows in days relative to
+    peak (the deltat column of the sources frame), each [ dtmin, dtmax );
+    windows are numbered by their position in the list, and may overlap.
+    For each object, the highest probability the classifier gave to the
+    object's true class in each window is found, and for each ( early,
+    late ) pair of windows (by default, every pair with early before late
+    in the list), probdiff is the late max minus the early max.  Objects
+    with no classifications in one of the windows of a pair are left out
+    of that pair.
+
+    probdiffs() has the columns of right_probdiffs_for_objects (indexed by
+    diaObjectId); hist() has the index and columns of right_probdiffs_hist,
+    with probdiffs binned by probdiffbins (by default the server's bins,
+    so binmeanprobdiff is the same as there).
+
+    The per-object maxima are reduced with numpy.maximum.at over all
+    objects at once, chunksize classification rows at a time.
+
+    """
+
+    def __init__( self, timebins, pairs=None, probdiffbins=default_probdiffbins ):
+        self.timebins = [ ( float( t0 ), float( t1 ) ) for t0, t1 in timebins ]
+        if pairs is None:
+            pairs = [ ( i, j ) for i in range( len( self.timebins ) ) for j in range( i + 1, len( self.timebins ) ) ]
+        self.pairs = [ ( int( i ), int( j ) ) for i, j in pairs ]
+        self.probdiffbins = probdiffbins
+        self._partials = []
+        self._probdiffs = None
+
+    def maxprobs( self, classifications, sources, trueClassId, chunksize=10000000 ):
+        """Per-object max probability of trueClassId in each time window.
+
+        Returns ( objids, maxprob ): objids is the sorted array of object
+        ids in sources, and maxprob a float array indexed by [ window,
+        object ] that's NaN where the object has no classifications in
+        the window.
+
+        """
+        srcid = _level_or_column( sources, 's.diasource_id' )
+        srcorder = numpy.argsort( srcid, kind='stable' )
+        srcid = srcid[ srcorder ]
+        objids, srcobj = numpy.unique( _level_or_column( sources, 's.diaobject_id' )[ srcorder ],
+                                       return_inverse=True )
+        deltat = sources['deltat'].values[ srcorder ]
+        inwindow = numpy.array( [ ( deltat >= t0 ) & ( deltat < t1 ) for t0, t1 in self.timebins ] )
+
+        cifysrc = _level_or_column( classifications, 's.diasource_id' )
+        cifyclass = _level_or_column( classifications, 'm.classid' )
+        cifyprob = _level_or_column( classifications, 'm.probability' )
+
+        maxprob = numpy.full( ( len( self.timebins ), len( objids ) ), -numpy.inf )
+        if len( srcid ) == 0:
+            return objids, numpy.full( maxprob.shape, numpy.nan )
+        for i0 in range( 0, len( cifysrc ), chunksize ):
+            sl = slice( i0, i0 + chunksize )
+            istrue = cifyclass[sl] == trueClassId
+            src = cifysrc[sl][ istrue ]
+            prob = numpy.asarray( cifyprob[sl][ istrue ], dtype=numpy.float64 )
+            pos, found = _source_positions( srcid, src )
+            prob = prob[ found ]
+            for w in range( len( self.timebins ) ):
+                inw = inwindow[ w, pos ]
+                numpy.maximum.at( maxprob[w], srcobj[ pos[ inw ] ], prob[ inw ] )
+        maxprob[ numpy.isneginf( maxprob ) ] = numpy.nan
+        return objids, maxprob
+
+    def add( self, classifications, sources, classifierId, trueClassId, chunksize=10000000 ):
+        """Compute the probability differences for one classifier / true type pair.
+
+        classifications, sources : as for ProbHistogrammer.add (sources
+          must also have s.diaobject_id)
+
+        classifierId, trueClassId : the classifier and true type these
+          frames are for; only probabilities for classId trueClassId are used
+
+        """
+        objids, maxprob = self.maxprobs( classifications, sources, trueClassId, chunksize=chunksize )
+        for early, late in self.pairs:
+            diff = maxprob[ late ] - maxprob[ early ]
+            have = ~numpy.isnan( diff )
+            n = int( have.sum() )
+            self._partials.append( pandas.DataFrame( {
+                'diaObjectId': objids[ have ],
+                'classifierId': numpy.full( n, classifierId ),
+                'trueClassId': numpy.full( n, trueClassId ),
+                'earlytimebin': numpy.full( n, early ),
+                'earlytimet0': self.timebins[ early ][0],
+                'earlytimet1': self.timebins[ early ][1],
+                'latetimebin': numpy.full( n, late ),
+                'latetimet0': self.timebins[ late ][0],
+                'latetimet1': self.timebins[ late ][1],
+                'probdiff': diff[ have ] } ) )
+        self._probdiffs = None
+
+    def probdiffs( self ):
+        """Everything add()ed so far, per object, like right_probdiffs_for_objects."""
+        if self._probdiffs is None:
+            columns = [ 'diaObjectId', 'classifierId', 'trueClassId', 'earlytimebin', 'earlytimet0', 'earlytimet1',
+                        'latetimebin', 'latetimet0', 'latetimet1', 'probdiff' ]
+            if len( self._partials ) == 0:
+                df = pandas.DataFrame( { col: pandas.Series( [], dtype=numpy.int64 if col.endswith( ( 'Id', 'bin' ) )
+                                                             else numpy.float64 ) for col in columns } )
+            else:
+                df = pandas.concat( self._partials, ignore_index=True )
+                # Keep only the combined table, not the pieces
+                self._partials = [ df ]
+            df = df.sort_values( [ 'diaObjectId', 'classifierId', 'earlytimebin', 'latetimebin' ], kind='stable' )
+            self._probdiffs = df.set_index( 'diaObjectId' )
+        return self._probdiffs.copy( deep=True )
+
+    def binmean( self, probdiffbin ):
+        """Middle of probability difference bin(s) probdiffbin (open-ended bins get the middle of an equal-width bin)."""
+        probdiffbin = numpy.asarray( probdiffbin )
+        if isinstance( self.probdiffbins, tuple ):
+            low, high, nbins = self.probdiffbins
+            width = ( high - low ) / nbins
+            return low + ( probdiffbin - 0.5 ) * width
+        edges = numpy.asarray( self.probdiffbins, dtype=numpy.float64 )
+        mids = numpy.concatenate( [ [ edges[0] - ( edges[1] - edges[0] ) / 2. ],
+                                    ( edges[:-1] + edges[1:] ) / 2.,
+                                    [ edges[-1] + ( edges[-1] - edges[-2] ) / 2. ] ] )
+        return mids[ probdiffbin ]
+
+    def hist( self ):
+        """Histogram of probdiffs(), with the layout of right_probdiffs_hist()."""
+        df = self.probdiffs()
+        idx = [ 'classifierId', 'trueClassId', 'earlytimebin', 'latetimebin', 'probdiffbin' ]
+        df['probdiffbin'] = width_bucket( df['probdiff'].values, self.probdiffbins )
+        hist = df.groupby( idx ).agg( earlytimet0=( 'earlytimet0', 'first' ),
+                                      earlytimet1=( 'earlytimet1', 'first' ),
+                                      latetimet0=( 'latetimet0', 'first' ),
+                                      latetimet1=( 'latetimet1', 'first' ),
+                                      count=( 'probdiff', 'size' ) )
+        hist.insert( 4, 'binmeanprobdiff', self.binmean( hist.index.get_level_values( 'probdiffbin' ) ) )
+        hist['count'] = hist['count'].astype( numpy.int64 )
+        hist['frac'] = ( hist['count']
+                         / hist.groupby( [ 'classifierId', 'trueClassId',
+                                           'earlytimebin', 'latetimebin' ] )['count'].transform( 'sum' ) )
+        return hist
@@ -1,9 +1,294 @@
 import sys
-import requests
+import os
+import time
+import pathlib
+import urllib.parse
 import json
 import numpy
 import pandas
 import logging
+import threading
+import collections
+import concurrent.futures
+
+import tom_sql
+import tom_stats
+import tom_cache
+import tom_session
+
+# dtypes for the columns of elasticc_view_classifications_probmetrics
+_probhist_schema = { 'classifierId': numpy.int32,
+                     'trueClassId': numpy.int32,
+                     'classId': numpy.int32,
+                     'tbin': numpy.int16,
+                     'probbin': numpy.int16,
+                     'count': numpy.int64 }
+
+_probhist_index = [ 'classifierId', 'trueClassId', 'classId', 'tbin', 'probbin' ]
+
+
+def _filter_probhist( df, classifierIds=None, trueClassIds=None, classIds=None, tbins=None ):
+    """Rows of a probhist() dataframe whose index levels are in the given lists (None for any)."""
+    mask = numpy.full( len(df), True )
+    for level, values in ( ( 'classifierId', classifierIds ), ( 'trueClassId', trueClassIds ),
+                           ( 'classId', classIds ), ( 'tbin', tbins ) ):
+        if values is not None:
+            mask &= df.index.get_level_values( level ).isin( list( values ) )
+    return df[ mask ]
+
+
+def _copy_on_write_enabled():
+    if int( pandas.__version__.split( '.' )[0] ) >= 3:
+        return True
+    try:
+        return pandas.options.mode.copy_on_write is True
+    except AttributeError:
+        return False
+
+
+def _readonly_view( df ):
+    """A frame sharing df's data whose changes can't get back into df.
+
+    With copy-on-write, a shallow copy does that.  Without it, build a new
+    frame around read-only views of df's columns, so that writes raise.
+
+    """
+    if _copy_on_write_enabled():
+        return df.copy( deep=False )
+    cols = {}
+    for col in df.columns:
+        arr = df[col].values.view()
+        arr.flags.writeable = False
+        cols[col] = arr
+    return pandas.DataFrame( cols, index=df.index, copy=False )
+
+
+class ProbHistCube:
+    """The probabilistic metrics histogram as compact numpy arrays, in blocks by classifier and true class.
+
+    Get one of these from ELAsTiCCMetricsQuerier.probhist_cube().
+
+    Only cells with counts are stored, grouped (like the rows of a CSR
+    sparse matrix) into one block for each ( classifier, true class )
+    pair:
+
+      counts     : the count in each stored cell, as the smallest
+                   unsigned integer dtype that holds the largest count
+      cell_class : the position of each cell's classId in classIds
+      cell_bin   : each cell's tbin * nprobbins + probbin
+      blockptr   : the cells of the pair at positions c and t in
+                   classifierIds and trueClassIds are
+                   [ blockptr[b] : blockptr[b+1] ], where
+                   b = c * len(trueClassIds) + t; within a block they're
+                   sorted by class, tbin, and probbin
+
+    classifierIds, trueClassIds, and classIds are the (sorted) ids in
+    the cube, and classifier_pos, trueclass_pos, and class_pos are
+    dictionaries mapping an id to its position in them.  tbin and
+    probbin are the bin numbers themselves; there are ntbins
+    (tbin_num+2) and nprobbins (probbin_num+2) of them.
+
+    That's about 7 bytes for each cell with counts, around half what a
+    row of the probhist() frame takes.  (Against fake_tom.py's
+    full-size table it's 2MB to the frame's 3.7MB; a dense classifier x
+    true class x class x 28 x 22 array of the same would be 44MB.)
+    nbytes() says how big it actually is; bench_tom_clients.py compares
+    it to the frame.
+
+    get( classifierId, trueClassId, what=... ) gives one pair's counts,
+    or an array derived from them, as a dense array whose class axis is
+    just the classes with counts for that pair (block_classIds()), so
+    its size follows the classes the classifier actually reports:
+
+      counts           : [ class, tbin, probbin ], the counts
+      marginal_probbin : int64 [ class, tbin ], counts summed over
+                         probbin (i.e. the number of classifications of
+                         each class in each time bin)
+      normalized       : float32 [ class, tbin, probbin ], counts
+                         divided by marginal_probbin, so each (class,
+                         tbin) probability distribution sums to 1 (all 0
+                         where there were no counts)
+      cumulative       : float32, the cumulative sum of normalized over
+                         probbin
+
+    These are made the first time a pair's array is asked for and kept
+    (read-only) for the maxblocks pairs used most recently, so going
+    over the whole grid never holds more than maxblocks pairs' worth.
+
+    For the whole cube, marginal() sums over any of its axes, and
+    totals() (int64 [ classifier, trueclass, tbin ], counts summed over
+    class and probbin) is computed once and kept.
+
+    """
+
+    axes = ( 'classifierId', 'trueClassId', 'classId', 'tbin', 'probbin' )
+
+    def __init__( self, df, ntbins, nprobbins, maxblocks=16 ):
+        """df is a probhist() dataframe (possibly a subset of one)."""
+        idx = df.index
+        self.ntbins = ntbins
+        self.nprobbins = nprobbins
+        self.classifierIds, cferpos = numpy.unique( idx.get_level_values( 'classifierId' ), return_inverse=True )
+        self.trueClassIds, truepos = numpy.unique( idx.get_level_values( 'trueClassId' ), return_inverse=True )
+        self.classIds, classpos = numpy.unique( idx.get_level_values( 'classId' ), return_inverse=True )
+        tbin = numpy.clip( numpy.asarray( idx.get_level_values( 'tbin' ), dtype=numpy.int64 ), 0, ntbins - 1 )
+        probbin = numpy.clip( numpy.asarray( idx.get_level_values( 'probbin' ), dtype=numpy.int64 ),
+                              0, nprobbins - 1 )
+        nbins = ntbins * nprobbins
+        nclasses = max( len( self.classIds ), 1 )
+
+        # One key per row, in ( block, class, tbin, probbin ) order; rows clipped into the same edge cell
+        #  share a key, and are summed by bincount.  Everything here is as long as the table, never the grid.
+        key = ( ( cferpos.astype( numpy.int64 ) * len( self.trueClassIds ) + truepos ) * nclasses
+                + classpos ) * nbins + tbin * nprobbins + probbin
+        cells, cellpos = numpy.unique( key, return_inverse=True )
+        sums = numpy.bincount( cellpos.ravel(), weights=df['count'].values, minlength=len( cells ) )
+        dtype = numpy.min_scalar_type( max( int( sums.max() ), 1 ) if len( sums ) > 0 else 1 )
+        self.counts = sums.astype( dtype )
+        block, cell = numpy.divmod( cells, nclasses * nbins )
+        cellclass, cellbin = numpy.divmod( cell, nbins )
+        self.cell_class = cellclass.astype( numpy.min_scalar_type( nclasses - 1 ) )
+        self.cell_bin = cellbin.astype( numpy.min_scalar_type( nbins - 1 ) )
+        self.blockptr = numpy.searchsorted( block, numpy.arange( len( self.classifierIds )
+                                                                 * len( self.trueClassIds ) + 1 ) )
+        for arr in ( self.counts, self.cell_class, self.cell_bin, self.blockptr ):
+            arr.setflags( write=False )
+
+        self.classifier_pos = { int(v): i for i, v in enumerate( self.classifierIds ) }
+        self.trueclass_pos = { int(v): i for i, v in enumerate( self.trueClassIds ) }
+        self.class_pos = { int(v): i for i, v in enumerate( self.classIds ) }
+
+        self.maxblocks = max( int( maxblocks ), 1 )
+        # block -> { what: read-only array }, least recently used first; see _product
+        self._products = collections.OrderedDict()
+        self._totals = None
+        # Reentrant, since computing one product can need another
+        self._products_lock = threading.RLock()
+
+    def _blocknum( self, classifierId, trueClassId ):
+        """Raises KeyError if either id isn't in the cube."""
+        return self.classifier_pos[ classifierId ] * len( self.trueClassIds ) + self.trueclass_pos[ trueClassId ]
+
+    def _cells( self, b ):
+        return slice( self.blockptr[b], self.blockptr[b+1] )
+
+    def block_classIds( self, classifierId, trueClassId ):
+        """The classIds with counts for one classifier and true class (the class axis of get())."""
+        return self.classIds[ numpy.unique( self.cell_class[ self._cells( self._blocknum( classifierId,
+                                                                                        trueClassId ) ) ] ) ]
+
+    def _dense( self, cells ):
+        """Counts of the cells as [ class, tbin, probbin ], over just the classes in cells."""
+        classpos, row = numpy.unique( self.cell_class[ cells ], return_inverse=True )
+        arr = numpy.zeros( ( len( classpos ), self.ntbins * self.nprobbins ), dtype=self.counts.dtype )
+        arr[ row.ravel(), self.cell_bin[ cells ] ] = self.counts[ cells ]
+        return arr.reshape( len( classpos ), self.ntbins, self.nprobbins ), classpos
+
+    _products_names = ( 'counts', 'marginal_probbin', 'normalized', 'cumulative' )
+
+    def _product( self, b, what ):
+        """Block b's array what (see class docs), computing and keeping it if need be."""
+        # Lock so that several threads asking at once only compute it once
+        with self._products_lock:
+            products = self._products.get( b )
+            if products is None:
+                products = self._products[ b ] = {}
+                while len( self._products ) > self.maxblocks:
+                    self._products.popitem( last=False )
+            else:
+                self._products.move_to_end( b )
+            if what not in products:
+                if what == 'counts':
+                    arr, products['classpos'] = self._dense( self._cells( b ) )
+                elif what == 'marginal_probbin':
+                    arr = self._product( b, 'counts' ).sum( axis=2, dtype=numpy.int64 )
+                elif what == 'normalized':
+                    counts = self._product( b, 'counts' )
+                    denom = self._product( b, 'marginal_probbin' )[ ..., numpy.newaxis ]
+                    arr = numpy.zeros( counts.shape, dtype=numpy.float32 )
+                    numpy.divide( counts, denom, out=arr, where=( denom > 0 ), casting='unsafe' )
+                else:
+                    arr = numpy.cumsum( self._product( b, 'normalized' ), axis=2, dtype=numpy.float32 )
+                arr.setflags( write=False )
+                products[ what ] = arr
+            return products[ what ]
+
+    def get( self, classifierId, trueClassId, classId=None, what='counts' ):
+        """One classifier and true class's counts (or a derived array), dense.
+
+        what : 'counts', 'marginal_probbin', 'normalized', or
+          'cumulative' (see class docs)
+
+        Returns a read-only array indexed by [ class, ... ], where the
+        class axis is block_classIds( classifierId, trueClassId ), or by
+        just the rest of the axes if classId is given (all 0 if that
+        class has no counts for the pair).  Raises KeyError if any of
+        the ids aren't in the cube.
+
+        """
+        if what not in self._products_names:
+            raise ValueError( f"Unknown array {what}; must be one of {self._products_names}" )
+        b = self._blocknum( classifierId, trueClassId )
+        with self._products_lock:
+            arr = self._product( b, what )
+            # Every product needs the counts, which left their class positions here
+            classpos = self._products[ b ][ 'classpos' ]
+        if classId is None:
+            return arr
+        i = numpy.searchsorted( classpos, self.class_pos[classId] )
+        if ( i < len( classpos ) ) and ( classpos[i] == self.class_pos[classId] ):
+            return arr[i]
+        return numpy.zeros( arr.shape[1:], dtype=arr.dtype )
+
+    def _coords( self ):
+        """{ axis: position of each stored cell on that axis }"""
+        block = numpy.repeat( numpy.arange( len( self.blockptr ) - 1 ), numpy.diff( self.blockptr ) )
+        cfer, true = numpy.divmod( block, max( len( self.trueClassIds ), 1 ) )
+        tbin, probbin = numpy.divmod( self.cell_bin.astype( numpy.int64 ), self.nprobbins )
+        return { 'classifierId': cfer, 'trueClassId': true, 'classId': self.cell_class,
+                 'tbin': tbin, 'probbin': probbin }
+
+    def _axislen( self, axis ):
+        return { 'classifierId': len( self.classifierIds ), 'trueClassId': len( self.trueClassIds ),
+                 'classId': len( self.classIds ), 'tbin': self.ntbins, 'probbin': self.nprobbins }[ axis ]
+
+    def totals( self ):
+        """Counts summed over class and probbin, int64 [ classifier, trueclass, tbin ]."""
+        with self._products_lock:
+            if self._totals is None:
+                self._totals = self.marginal( 'classId', 'probbin' )
+                self._totals.setflags( write=False )
+            return self._totals
+
+    def nbytes( self, products=True ):
+        """Bytes used by the cell arrays, plus (if products) the derived arrays being kept."""
+        nbytes = sum( arr.nbytes for arr in ( self.counts, self.cell_class, self.cell_bin, self.blockptr ) )
+        if products:
+            with self._products_lock:
+                nbytes += sum( arr.nbytes for products in self._products.values() for arr in products.values() )
+                nbytes += 0 if self._totals is None else self._totals.nbytes
+        return nbytes
+
+    def marginal( self, *axes ):
+        """Sum counts over the named axes (names from ProbHistCube.axes), as int64.
+
+        The result is dense over the axes that are left, so summing over
+        few (or none) of them can make an array the size of the whole
+        grid.
+
+        """
+        for axis in axes:
+            if axis not in self.axes:
+                raise ValueError( f"Unknown axis {axis}; must be one of {self.axes}" )
+        keep = [ a for a in self.axes if a not in axes ]
+        if len( keep ) == 0:
+            return numpy.array( self.counts.sum( dtype=numpy.int64 ) )
+        coords = self._coords()
+        shape = tuple( self._axislen( a ) for a in keep )
+        flat = numpy.ravel_multi_index( tuple( coords[a] for a in keep ), shape )
+        sums = numpy.bincount( flat, weights=self.counts, minlength=int( numpy.prod( shape ) ) )
+        return sums.astype( numpy.int64 ).reshape( shape )
+
 
 class ELAsTiCCMetricsQuerier:
     """Class to send some queries for ELAsTiCC Metrics.
@@ -15,6 +300,11 @@ class ELAsTiCCMetricsQuerier:
       https://github.com/LSSTDESC/tom_desc/blob/main/sql_query_tom_db.py)
       for a hopefully-up-to-date set of schema
 
+    * call run_query_chunked to send a query whose result is too big
+      to pull down in one go; it pages through the result ordered on a
+      key column you give it, and yields DataFrames (or numpy record
+      arrays) of at most chunksize rows
+
     * Look at the classifier_info property to get a dictionary of dictionaries:
        { classifierId: { 'brokerName': <string>, 'brokerVersion': <string>,
                          'classifierName': <string>, 'classifierParams': <string> } }
@@ -31,7 +321,26 @@ class ELAsTiCCMetricsQuerier:
      gives you a copy of an internally cached table, so any changes you
      make will not be reflected by the return value from subsequent
      calls to this method.  (So, if you want to make changes, store the
-     return value in your own variable.)
+     return value in your own variable.)  Making that copy costs a
+     full-table allocation on every call; if you call probhist() a lot
+     (e.g. in a loop, or from several threads sharing one querier),
+     call probhist( copy=False ) instead.  That gives you a frame that
+     shares memory with the cached table but can't change it: with
+     pandas copy-on-write (always on in pandas 3), writing to it makes
+     a private copy; otherwise its columns are read-only and writing to
+     them raises an exception.
+
+     If you only want part of the table, pass any of classifierIds,
+     trueClassIds, classIds, and tbins (each a list of ids / bin
+     numbers; for a range of time bins, pass e.g. range(5,20)) to
+     probhist().  If the whole table hasn't been loaded, only those
+     rows are pulled from the database.  The (classifierId,
+     trueClassId) blocks that have been pulled are remembered, so later
+     calls only query for blocks you haven't asked for before.  (Blocks
+     pulled with a classIds or tbins filter are only reused for calls
+     with that same classIds and tbins filter.)  Once the whole table
+     has been loaded (by calling probhist() with no filters), filtered
+     calls just pick rows out of it.
 
      This view is based on the elasticc_view_dedupedclassifications
      materialized view, which tried to de-duplicate entries in the
@@ -83,7 +392,35 @@ class ELAsTiCCMetricsQuerier:
      get a copy of the pandas dataframe cached in memory by the object
      you instantiated.  (This does mean that if the database materialized
      view is regenerated, you won't get the updates, but that should
-     happen rarely or never.)
+     happen rarely or never.)  If you passed cachedir to the
+     constructor, the table is also saved there (as parquet), and a
+     fresh ELAsTiCCMetricsQuerier (e.g. after a kernel restart) will
+     read it from there instead of pulling it from the database.
+
+   * Call probhist_cube() to get the same histogram as compact numpy
+     arrays (a ProbHistCube): the cells with counts, in one block per
+     classifier and true class, with dictionaries mapping ids to
+     positions.  It takes a fraction of the memory of the probhist()
+     frame.  Pulling out one classifier/true class pair as a dense
+     [ class, tbin, probbin ] array is then a slice and one numpy
+     assignment, and summing over an axis is one numpy call.
+     You can restrict it to some classifierIds and/or trueClassIds.
+     The cube also gives you each pair's normalized (per tbin) and
+     cumulative probability distributions and marginals over probbin,
+     and totals per classifier, true class, and tbin; see ProbHistCube.
+     Each pair's arrays are computed the first time you ask for them and
+     kept for the pairs used most recently; the full cube, and all that
+     goes with it, is thrown away along with the probhist table
+     (clear_cache).
+
+   * Call probdist( classifierId, trueClassId ) to get the normalized
+     probability distribution of every class in every tbin (optionally
+     just some classIds and tbins) for one classifier and true class,
+     as a dataframe indexed by tbin, classId, probbin, with the
+     probability at the middle of each probbin in a prob column.  Only
+     that pair's rows are fetched and normalized; to go over the whole
+     grid, use probhist_cube().get( ..., what='normalized' ) and
+     what='cumulative'.
 
    * Call the methods tbin_val(tbin) and probbin_val(pbin) to get the
      values at the middle of the bins in the table returned by
@@ -119,6 +456,13 @@ class ELAsTiCCMetricsQuerier:
      [100, 99999).  That nines are for internal database usage;
      interpret these as "less than -20 days" and "100 days or greater".
 
+   * To do that for lots of objects, call
+     right_probdiffs_for_objects( diaObjectIds ) instead.  It sends the
+     ids to the database chunksize (default 1000) at a time, rather than
+     one query per object, optionally running jobs (default 1) of those
+     queries at once.  You get back one dataframe with the same columns
+     as above, indexed by diaObjectId.
+
   * Call the method right_profdiffs_hist() to get a dataframe that has:
       Indexes:
         classifierId
@@ -160,11 +504,43 @@ class ELAsTiCCMetricsQuerier:
 
     That's all complicated and stuff.
 
+  * On-disk caching: pass cachedir=<directory> to the constructor to
+    have probhist(), classname, and classifier_info saved to parquet
+    files under that directory (in a subdirectory named for the TOM
+    host).  Later instances pointed at the same directory read those
+    files rather than querying the database.  Pass cache_maxage=<seconds>
+    to ignore cached files older than that.  Call clear_cache() to throw
+    away both the in-memory and on-disk copies.  Writing parquet needs
+    pyarrow (or fastparquet); without it, you just don't get the
+    on-disk cache.
+
+  * Logging in goes through tom_session.shared, so queriers (and other
+    clients) for the same account share one login and connection pool,
+    log in again if the login expires, and retry connection errors and
+    5xx statuses.  Pass session=<a tom_session.TomSession> instead of
+    tomusername and tompasswd to use a particular session.
+
+  * Every query sent to the TOM is timed (see tom_stats.py); call
+    tom_stats.stats.summary() to see where the time went.  Pass
+    stats=<a tom_stats.CallStats> to the constructor to record into
+    something other than the default tom_stats.stats.
+
+  * Query results are cached (see tom_cache.py), so sending the same
+    query twice, even from two different ELAsTiCCMetricsQueriers, only
+    goes to the database once.  Pass querycache=<a tom_cache.QueryCache>
+    to the constructor to use a different cache, or querycache=False to
+    not cache; pass cache=False to run_query (or run_query_frame) to
+    bypass the cache for one query.  run_query_chunked never uses the
+    cache.
+
     """
 
-    def __init__( self, tomusername=None, tompasswd=None, logger=None, url="https://desc-tom.lbl.gov" ):
-        if ( tomusername is None ) or ( tompasswd is None ):
-            raise RuntimError( "Must pass tomusername and tompasswd" )
+    _cachenames = ( 'classname', 'classifier_info', 'probhist' )
+
+    def __init__( self, tomusername=None, tompasswd=None, logger=None, url="https://desc-tom.lbl.gov",
+                  cachedir=None, cache_maxage=None, stats=None, querycache=None, session=None ):
+        if ( session is None ) and ( ( tomusername is None ) or ( tompasswd is None ) ):
+            raise RuntimeError( "Must pass tomusername and tompasswd (or session)" )
 
         if logger is None:
             self.logger = logging.getLogger( "ELAsTiCCMetricsQuerier" )
@@ -178,22 +554,30 @@ class ELAsTiCCMetricsQuerier:
         else:
             self.logger = logger
 
-        self.url = url
-        self.rqs = requests.session()
-        self.rqs.get( f'{self.url}/accounts/login/' )
-        res = self.rqs.post( f'{self.url}/accounts/login/',
-                             data={ "username": tomusername,
-                                    "password": tompasswd,
-                                    "csrfmiddlewaretoken": self.rqs.cookies['csrftoken'] } )
-        if res.status_code != 200:
-            raise RuntimeError( f"Failed to log in; http status: {res.status_code}" )
-        if 'Please enter a correct' in res.text:
-            raise RuntimeError( "Failed to log in.  I think.  Put in a debug break and look at res.text" )
-        self.rqs.headers.update( { 'X-CSRFToken': self.rqs.cookies['csrftoken'] } )
+        self.url = url if session is None else session.url
+        self.stats = tom_stats.stats if stats is None else stats
+        self.querycache = tom_cache.resolve( querycache )
+        self.rqs = tom_session.shared( url, tomusername, tompasswd ) if session is None else session
 
         self._classname = None
         self._classifier_info = None
         self._probhist = None
+        self._probhist_cube = None
+        # { ( classIds, tbins ): { ( classifierId, trueClassId ): DataFrame } } ; see _load_probhist_slice
+        self._probhist_slices = {}
+        # Held only while looking at or changing the above, never while waiting on the database
+        self._probhist_lock = threading.Lock()
+        # Held while loading the full table, so that several threads asking at once only load it once
+        self._probhist_loadlock = threading.Lock()
+        # Bumped by clear_cache, so that a query that was running then doesn't put old rows back
+        self._probhist_generation = 0
+
+        self._cache_maxage = cache_maxage
+        if cachedir is None:
+            self._cachedir = None
+        else:
+            host = urllib.parse.urlparse( self.url ).netloc or 'tom'
+            self._cachedir = pathlib.Path( cachedir ) / host.replace( ':', '_' )
 
         self._tbin_min = -30.
         self._tbin_max = 100.
@@ -204,30 +588,97 @@ class ELAsTiCCMetricsQuerier:
         self._probbin_num = 20
         self._delta_probbin = ( self._probbin_max - self._probbin_min ) / self._probbin_num
         
-    def run_query( self, query, subdict=None ):
-        if subdict == None:
-            subdict = {}
+    def _post_query( self, rec, query, subdict, cache ):
+        # Returns ( key, content ).  content is the response body, from
+        # the query cache if it's there, or None if the server returned
+        # an error.  key is what to store content under in the query
+        # cache once we know it's a good response, or None if it's not
+        # to be stored.
+        querycache = self.querycache if cache else None
+        key = None
+        if querycache is not None:
+            key = querycache.key( self.url, query, subdict )
+            content = querycache.get( key )
+            if content is not None:
+                rec.cached( content )
+                return None, content
         result = self.rqs.post( f'{self.url}/db/runsqlquery/',
                                 json={ 'query': query, 'subdict': subdict } )
+        rec.response( result )
         if result.status_code != 200:
             sys.stderr.write( f"ERROR: got status code {result.status_code} ({result.reason})\n" )
-        else:
-            data = json.loads( result.text )
-            if ( 'status' not in data ) or ( data['status'] != 'ok' ):
+            return None, None
+        return key, result.content
+
+    def run_query( self, query, subdict=None, cache=True ):
+        if subdict == None:
+            subdict = {}
+        with self.stats.record( 'ELAsTiCCMetricsQuerier', 'sql', query ) as rec:
+            key, content = self._post_query( rec, query, subdict, cache )
+            if content is not None:
+                data = json.loads( content )
+                rec.lap( 'decode_s' )
+                if ( 'status' not in data ) or ( data['status'] != 'ok' ):
+                    sys.stderr.write( "Got unexpected response\n" )
+                    print(data['error'])
+                else:
+                    if key is not None:
+                        self.querycache.put( key, content )
+                    rec.fields['nrows'] = len( data['rows'] )
+                    return data['rows']
+
+    def run_query_frame( self, query, subdict=None, schema=None, cache=True ):
+        """Like run_query, but returns a pandas DataFrame (or None on error).
+
+        The response is decoded straight into columns (see
+        tom_sql.decode_rows) rather than going through a list of dicts.
+        schema is an optional { column: numpy dtype } dict.
+
+        """
+        if subdict == None:
+            subdict = {}
+        with self.stats.record( 'ELAsTiCCMetricsQuerier', 'sql', query ) as rec:
+            key, content = self._post_query( rec, query, subdict, cache )
+            if content is None:
+                return None
+            data, df = tom_sql.decode_rows( content, schema=schema, timings=rec.timings )
+            if ( 'status' not in data ) or ( data['status'] != 'ok' ) or ( df is None ):
                 sys.stderr.write( "Got unexpected response\n" )
-                print(data['error'])
-            else:
-                return data['rows']
+                print( data.get( 'error' ) )
+                return None
+            if key is not None:
+                self.querycache.put( key, content )
+            rec.fields['nrows'] = len( df )
+            return df
+
+    def run_query_chunked( self, query, key, subdict=None, chunksize=100000, asrecords=False, schema=None ):
+        """Generator yielding the result of query in DataFrames of at most chunksize rows.
+
+        key is a column name (or list of column names) of the query
+        result that's unique across the result; the result is paged
+        through in order of key, so only one chunk needs to be in memory
+        at a time.  If asrecords is True, yield numpy record arrays
+        instead of DataFrames.  schema is as for run_query_frame.  The
+        pages never go through the query cache (that would keep them
+        all in memory).  See tom_sql.py for details.
+
+        """
+        send_frame = lambda q, sd, schema=None: self.run_query_frame( q, sd, schema=schema, cache=False )
+        return tom_sql.iter_frames( send_frame, query, key, subdict=subdict,
+                                    chunksize=chunksize, asrecords=asrecords, schema=schema )
 
     @property
     def classname( self ):
         if self._classname is not None:
             return self._classname
 
-        rows = self.run_query( 'SELECT DISTINCT ON ("classId") "classId",description '
-                               'FROM elasticc_gentypeofclassid '
-                               'ORDER BY "classId"' )
-        self._classname = { row["classId"]: row["description"] for row in rows }
+        df = self._read_cache( 'classname' )
+        if df is None:
+            df = self.run_query_frame( 'SELECT DISTINCT ON ("classId") "classId",description '
+                                       'FROM elasticc_gentypeofclassid '
+                                       'ORDER BY "classId"' )
+            self._write_cache( 'classname', df )
+        self._classname = { int( row.classId ): row.description for row in df.itertuples() }
 
         return self._classname
 
@@ -236,10 +687,13 @@ class ELAsTiCCMetricsQuerier:
         if self._classifier_info is not None:
             return self._classifier_info
         
-        rows = self.run_query( 'SELECT "classifierId","brokerName","brokerVersion",'
-                               '"classifierName","classifierParams" '
-                               'FROM elasticc_brokerclassifier' )
-        self._classifier_info = { row["classifierId"]: row for row in rows }
+        df = self._read_cache( 'classifier_info' )
+        if df is None:
+            df = self.run_query_frame( 'SELECT "classifierId","brokerName","brokerVersion",'
+                                       '"classifierName","classifierParams" '
+                                       'FROM elasticc_brokerclassifier' )
+            self._write_cache( 'classifier_info', df )
+        self._classifier_info = { row["classifierId"]: row for row in df.to_dict( orient='records' ) }
 
         return self._classifier_info
 
@@ -279,20 +733,244 @@ class ELAsTiCCMetricsQuerier:
         """
         return self._probbin_num
     
-    def probhist( self ):
-        if self._probhist is not None:
-            return self._probhist.copy( deep=True )
+    def probhist( self, copy=True, classifierIds=None, trueClassIds=None, classIds=None, tbins=None ):
+        """Return the probabilistic metrics histogram table; see class docs.
+
+        copy : if True, return a deep copy of the cached table.  If
+          False, return a frame that shares memory with the cached table
+          but whose changes can't leak back into it (see class docs).
+
+        classifierIds, trueClassIds, classIds, tbins : if not None, a
+          list of values; only return rows with those values.  Only
+          the rows asked for are queried from the database, unless the
+          whole table is already loaded (see class docs).
+
+        """
+        if all( x is None for x in ( classifierIds, trueClassIds, classIds, tbins ) ):
+            df = self._load_probhist()
+        else:
+            df = self._load_probhist_slice( classifierIds, trueClassIds, classIds, tbins )
+        return df.copy( deep=True ) if copy else _readonly_view( df )
+
+    def probhist_cube( self, classifierIds=None, trueClassIds=None ):
+        """Return the probhist table as a ProbHistCube.
+
+        classifierIds, trueClassIds : if not None, a list of ids; only
+          include those classifiers / true classes in the cube.  (Only
+          those are queried from the database, as with probhist().)
+
+        The full cube is built once and cached (it's read-only, so you
+        get the same object back each time); restricted cubes are built
+        on each call.
+
+        """
+        if ( classifierIds is None ) and ( trueClassIds is None ):
+            df = self._load_probhist()
+            with self._probhist_lock:
+                if self._probhist_cube is None:
+                    self._probhist_cube = ProbHistCube( df, self._tbin_num + 2, self._probbin_num + 2 )
+                return self._probhist_cube
+        df = self._load_probhist_slice( classifierIds, trueClassIds, None, None )
+        return ProbHistCube( df, self._tbin_num + 2, self._probbin_num + 2 )
+
+    def probdist( self, classifierId, trueClassId, classIds=None, tbins=None ):
+        """Per-time-bin probability distributions for one classifier and true class.
+
+        classIds, tbins : if not None, a list; only include those
+          classes / time bins
+
+        Returns a DataFrame indexed by ( tbin, classId, probbin ) with
+        columns count, frac (count divided by the sum of count over
+        probbin), cumfrac (cumulative frac over probbin), and prob (the
+        middle of the probability bin; see probbin_val).  Only cells
+        with a non-zero count are included.
+
+        Only this classifier and true class's rows are used (from the
+        full probhist table if that's already loaded, otherwise queried
+        and kept as with probhist( classifierIds=..., trueClassIds=... ));
+        their little cube is built on each call, so this doesn't build
+        the full cube.
+        Raises KeyError if the table has no rows for the pair.
+
+        """
+        df = self._load_probhist_slice( [ classifierId ], [ trueClassId ], None, None )
+        cube = ProbHistCube( df, self._tbin_num + 2, self._probbin_num + 2 )
+        # Classes with no rows for this pair would have no nonzero cells anyway
+        blockclasses = cube.block_classIds( classifierId, trueClassId )
+        classpos = ( numpy.arange( len( blockclasses ) ) if classIds is None
+                     else numpy.flatnonzero( numpy.isin( blockclasses, [ int(c) for c in classIds ] ) ) )
+        tbins = numpy.arange( cube.ntbins ) if tbins is None else numpy.array( sorted( set( tbins ) ) )
+
+        # [ tbin, class, probbin ] for this classifier and true class
+        sel = numpy.ix_( tbins, classpos )
+        arrs = { name: cube.get( classifierId, trueClassId, what=what ).transpose( 1, 0, 2 )[ sel ]
+                 for name, what in ( ( 'count', 'counts' ), ( 'frac', 'normalized' ),
+                                     ( 'cumfrac', 'cumulative' ) ) }
+        nonzero = numpy.nonzero( arrs['count'] )
+        probbin = numpy.arange( cube.nprobbins )[ nonzero[2] ]
+        index = pandas.MultiIndex.from_arrays( [ tbins[ nonzero[0] ], blockclasses[ classpos ][ nonzero[1] ],
+                                                 probbin ], names=[ 'tbin', 'classId', 'probbin' ] )
+        return pandas.DataFrame( { 'count': arrs['count'][ nonzero ].astype( numpy.int64 ),
+                                   'frac': arrs['frac'][ nonzero ],
+                                   'cumfrac': arrs['cumfrac'][ nonzero ],
+                                   'prob': self.probbin_val( probbin ) },
+                                 index=index )
+
+    def _load_probhist( self ):
+        """Make sure self._probhist is loaded and return it (not a copy!)."""
+        with self._probhist_loadlock:
+            with self._probhist_lock:
+                if self._probhist is not None:
+                    return self._probhist
+            # Not under _probhist_lock, so that slices can be fetched meanwhile
+            probhist = self._fetch_probhist()
+            with self._probhist_lock:
+                self._probhist = probhist
+                # Every slice is in there now
+                self._probhist_slices = {}
+            return probhist
+
+    def _fetch_probhist( self ):
+        probhist = self._read_cache( 'probhist' )
+        if probhist is not None:
+            return probhist
 
         self.logger.debug( "Sending query to get probabilistic metrics histogram table" )
-        rows = self.run_query( "SELECT * FROM elasticc_view_classifications_probmetrics" )
-        self.logger.debug( "Got response, pandifying" )
-        self._probhist = pandas.DataFrame( rows )
-        self._probhist.sort_values( ['classifierId', 'trueClassId', 'classId', 'tbin', 'probbin'], inplace=True )
-        self._probhist.set_index( ['classifierId', 'trueClassId', 'classId', 'tbin', 'probbin'], inplace=True )
+        # Not through the query cache; we keep the (much smaller) DataFrame instead
+        probhist = self.run_query_frame( "SELECT * FROM elasticc_view_classifications_probmetrics",
+                                         schema=_probhist_schema, cache=False )
+        self.logger.debug( "Got response, indexing" )
+        probhist.sort_values( _probhist_index, inplace=True )
+        probhist.set_index( _probhist_index, inplace=True )
+        self._write_cache( 'probhist', probhist )
         self.logger.debug( "Done" )
 
-        return self._probhist.copy( deep=True )
-                
+        return probhist
+
+    def _load_probhist_slice( self, classifierIds, trueClassIds, classIds, tbins ):
+        """The rows of the probhist table matching the filters (not a copy, but not the cached table either)."""
+        # The full table may already be here, either in memory or in the on-disk cache
+        with self._probhist_lock:
+            if ( self._probhist is None ) and ( self._cache_path( 'probhist' ) is not None ):
+                self._probhist = self._read_cache( 'probhist' )
+            if self._probhist is not None:
+                return _filter_probhist( self._probhist, classifierIds, trueClassIds, classIds, tbins )
+
+        cfers = sorted( self.classifier_info.keys() ) if classifierIds is None else sorted( set( classifierIds ) )
+        trues = sorted( self.classname.keys() ) if trueClassIds is None else sorted( set( trueClassIds ) )
+        classIds = None if classIds is None else sorted( set( int(i) for i in classIds ) )
+        tbins = None if tbins is None else sorted( set( int(i) for i in tbins ) )
+        pairs = [ ( int(c), int(t) ) for c in cfers for t in trues ]
+
+        filterkey = ( None if classIds is None else tuple(classIds), None if tbins is None else tuple(tbins) )
+        with self._probhist_lock:
+            # Blocks pulled with no classId / tbin filter are good for any filter
+            full = self._probhist_slices.get( ( None, None ), {} )
+            mine = self._probhist_slices.get( filterkey, {} )
+            blocks = { p: full[p] if p in full else mine[p] for p in pairs if ( p in full ) or ( p in mine ) }
+            generation = self._probhist_generation
+        missing = [ p for p in pairs if p not in blocks ]
+        if len( missing ) > 0:
+            # Query without holding the lock, so that other threads' slices (and the full table) aren't held up
+            #  by this one.  (Two threads that want the same missing blocks at once both query them.)
+            fetched = {}
+            self._fetch_probhist_blocks( missing, classIds, tbins, fetched )
+            with self._probhist_lock:
+                if self._probhist_generation == generation:
+                    self._probhist_slices.setdefault( filterkey, {} ).update( fetched )
+            blocks.update( fetched )
+        blocks = [ blocks[p] for p in pairs ]
+
+        df = pandas.concat( blocks ) if len( blocks ) > 0 else self._empty_probhist()
+        return _filter_probhist( df, classIds=classIds, tbins=tbins )
+
+    def _fetch_probhist_blocks( self, pairs, classIds, tbins, blocks ):
+        """Query the probhist rows for the (classifierId, trueClassId) pairs into blocks[ pair ]."""
+        q = ( 'SELECT * FROM elasticc_view_classifications_probmetrics '
+              'WHERE ("classifierId","trueClassId") IN '
+              '  ( SELECT * FROM unnest( %(cfers)s::integer[], %(trues)s::integer[] ) ) ' )
+        subdict = { 'cfers': [ p[0] for p in pairs ], 'trues': [ p[1] for p in pairs ] }
+        if classIds is not None:
+            q += 'AND "classId"=ANY(%(classids)s) '
+            subdict['classids'] = classIds
+        if tbins is not None:
+            q += 'AND tbin=ANY(%(tbins)s) '
+            subdict['tbins'] = tbins
+        self.logger.debug( f"Sending query to get probabilistic metrics histogram for {len(pairs)} "
+                           f"(classifier, true class) pairs" )
+        df = self.run_query_frame( q, subdict, schema=_probhist_schema, cache=False )
+        if df is None:
+            raise RuntimeError( "Failed to get probabilistic metrics histogram rows" )
+        df.sort_values( _probhist_index, inplace=True )
+        df.set_index( _probhist_index, inplace=True )
+        got = { k: v for k, v in df.groupby( level=[ 'classifierId', 'trueClassId' ], sort=False ) }
+        empty = df.iloc[0:0]
+        for pair in pairs:
+            blocks[ pair ] = got.get( pair, empty )
+
+    def _empty_probhist( self ):
+        df = pandas.DataFrame( { col: numpy.array( [], dtype=dtype ) for col, dtype in _probhist_schema.items() } )
+        return df.set_index( _probhist_index )
+
+    def _cache_path( self, name ):
+        return None if self._cachedir is None else self._cachedir / f'{name}.parquet'
+
+    def _read_cache( self, name ):
+        """Return the cached dataframe for name, or None if there isn't a usable one on disk."""
+        path = self._cache_path( name )
+        if ( path is None ) or ( not path.is_file() ):
+            return None
+        if ( self._cache_maxage is not None ) and ( time.time() - path.stat().st_mtime > self._cache_maxage ):
+            self.logger.debug( f"Cache file {path} is older than {self._cache_maxage} s, ignoring it" )
+            return None
+        try:
+            df = pandas.read_parquet( path )
+        except Exception as ex:
+            self.logger.warning( f"Failed to read cache file {path}, ignoring it: {ex}" )
+            return None
+        self.logger.debug( f"Read {name} from cache file {path}" )
+        return df
+
+    def _write_cache( self, name, df ):
+        path = self._cache_path( name )
+        if path is None:
+            return
+        # Write to a temporary file and rename so that another process
+        # never sees a half-written cache file.
+        tmppath = path.parent / f'.{path.name}.{os.getpid()}.tmp'
+        try:
+            path.parent.mkdir( parents=True, exist_ok=True )
+            df.to_parquet( tmppath )
+            os.replace( tmppath, path )
+        except Exception as ex:
+            self.logger.warning( f"Failed to write cache file {path}: {ex}" )
+            tmppath.unlink( missing_ok=True )
+            return
+        self.logger.debug( f"Wrote {name} to cache file {path}" )
+
+    def clear_cache( self, which=None ):
+        """Forget cached tables, both in memory and on disk.
+
+        which : None to clear everything, or a list of some of
+          'classname', 'classifier_info', 'probhist'
+
+        """
+        which = self._cachenames if which is None else which
+        for name in which:
+            if name not in self._cachenames:
+                raise ValueError( f"Unknown cache {name}; must be one of {self._cachenames}" )
+            if name == 'probhist':
+                with self._probhist_lock:
+                    self._probhist = None
+                    self._probhist_cube = None
+                    self._probhist_slices = {}
+                    self._probhist_generation += 1
+            else:
+                setattr( self, f'_{name}', None )
+            path = self._cache_path( name )
+            if path is not None:
+                path.unlink( missing_ok=True )
+
     def tbin_val( self, intbin ):
         tbin = numpy.atleast_1d( intbin ).copy()
         tbin[ tbin < 0 ] = 0
@@ -315,35 +993,91 @@ class ELAsTiCCMetricsQuerier:
         return rval[0] if numpy.isscalar( inprobbin ) else rval
 
 
-    def right_probdiffs_for_object( self, diaObjectId ):
-        self.logger.debug( f"Sending query to get probability differences for object {diaObjectId}" )
-        rows = self.run_query( 'SELECT v."classifierId", v."trueClassId", '
+    _right_probdiffs_query = ( 'SELECT v."diaObjectId", v."classifierId", v."trueClassId", '
                                '  v.earlytimebin, tbe.dtmin AS earlytimet0, tbe.dtmax AS earlytimet1,'
                                '  v.latetimebin, tbl.dtmin AS latetimet0, tbl.dtmax AS latetimet1,'
-                               '  probdiff ',
+                               '  probdiff '
                                'FROM elasticc_view_maxprobdiff v '
                                'INNER JOIN elasticc_maxprob_timebins tbe ON v.earlytimebin=tbe.timebin '
                                'INNER JOIN elasticc_maxprob_timebins tbl ON v.latetimebin=tbl.timebin '
-                               'WHERE v."diaObjectId"=%(objid)s '
-                               'ORDER BY "classifierId", earlytimebin, latetimebin',
-                               { 'objid': diaObjectId } )
-        self.logger.debug( f"Query done, pandafying" )
-        return pandas.DataFrame( rows )
-        
+                               'WHERE v."diaObjectId"=ANY(%(objids)s) '
+                               'ORDER BY "diaObjectId", "classifierId", earlytimebin, latetimebin' )
+    _right_probdiffs_schema = { 'diaObjectId': numpy.int64, 'probdiff': numpy.float64 }
+
+    def right_probdiffs_for_object( self, diaObjectId ):
+        self.logger.debug( f"Sending query to get probability differences for object {diaObjectId}" )
+        df = self.run_query_frame( 'SELECT v."classifierId", v."trueClassId", '
+                                   '  v.earlytimebin, tbe.dtmin AS earlytimet0, tbe.dtmax AS earlytimet1,'
+                                   '  v.latetimebin, tbl.dtmin AS latetimet0, tbl.dtmax AS latetimet1,'
+                                   '  probdiff '
+                                   'FROM elasticc_view_maxprobdiff v '
+                                   'INNER JOIN elasticc_maxprob_timebins tbe ON v.earlytimebin=tbe.timebin '
+                                   'INNER JOIN elasticc_maxprob_timebins tbl ON v.latetimebin=tbl.timebin '
+                                   'WHERE v."diaObjectId"=%(objid)s '
+                                   'ORDER BY "classifierId", earlytimebin, latetimebin',
+                                   { 'objid': diaObjectId },
+                                   schema={ 'probdiff': numpy.float64 } )
+        self.logger.debug( f"Query done" )
+        return df
+
+    def right_probdiffs_for_objects( self, diaObjectIds, chunksize=1000, jobs=1 ):
+        """right_probdiffs_for_object for many objects at once.
+
+        diaObjectIds : iterable of object ids (duplicates are ignored)
+
+        chunksize : number of object ids to send in each query
+
+        jobs : number of queries to have going at once
+
+        Returns a single DataFrame indexed by diaObjectId (in increasing
+        order), with the columns that right_probdiffs_for_object
+        returns.  Objects with no rows in elasticc_view_maxprobdiff just
+        aren't there.  Raises a RuntimeError if any query fails.
+
+        """
+        objids = numpy.unique( numpy.fromiter( diaObjectIds, dtype=numpy.int64 ) )
+        chunks = [ objids[i:i+chunksize].tolist() for i in range( 0, len(objids), chunksize ) ]
+        self.logger.debug( f"Sending {len(chunks)} queries to get probability differences "
+                           f"for {len(objids)} objects" )
+
+        def query( chunk ):
+            df = self.run_query_frame( self._right_probdiffs_query, { 'objids': chunk },
+                                       schema=self._right_probdiffs_schema )
+            if df is None:
+                raise RuntimeError( f"Query for probability differences of objects "
+                                    f"{chunk[0]} through {chunk[-1]} failed" )
+            return df
+
+        if len( chunks ) == 0:
+            dfs = []
+        elif ( jobs <= 1 ) or ( len( chunks ) == 1 ):
+            dfs = [ query( chunk ) for chunk in chunks ]
+        else:
+            with concurrent.futures.ThreadPoolExecutor( max_workers=min( jobs, len(chunks) ) ) as executor:
+                dfs = list( executor.map( query, chunks ) )
+        self.logger.debug( "Queries done" )
+
+        dfs = [ df for df in dfs if len(df) > 0 ]
+        if len( dfs ) == 0:
+            columns = [ 'classifierId', 'trueClassId', 'earlytimebin', 'earlytimet0', 'earlytimet1',
+                        'latetimebin', 'latetimet0', 'latetimet1', 'probdiff' ]
+            return pandas.DataFrame( columns=columns,
+                                     index=pandas.Index( [], dtype=numpy.int64, name='diaObjectId' ) )
+        # Chunks are in increasing object id order, and each is sorted, so no need to sort again
+        return pandas.concat( dfs, ignore_index=True ).set_index( 'diaObjectId' )
 
     def right_probdiffs_hist( self ):
         self.logger.debug( "Sending query to get the probability differences histogram thingy" )
-        rows = self.run_query( 'SELECT v."classifierId", v."trueClassId", '
-                               '  v.earlytimebin, tbe.dtmin AS earlytimet0, tbe.dtmax AS earlytimet1,'
-                               '  v.latetimebin, tbl.dtmin AS latetimet0, tbl.dtmax AS latetimet1,'
-                               '  probdiffbin, binmeanprobdiff, count '
-                               'FROM elasticc_view_maxprobdiff_hist v '
-                               'INNER JOIN elasticc_maxprob_timebins tbe ON v.earlytimebin=tbe.timebin '
-                               'INNER JOIN elasticc_maxprob_timebins tbl ON v.latetimebin=tbl.timebin '
-                               'ORDER BY "trueClassId", "classifierId", earlytimebin, latetimebin, probdiffbin ' )
-        self.logger.debug( "Query done, pandafying" )
-        df = pandas.DataFrame( rows )
-        df['binmeanprobdiff'] = numpy.array( df['binmeanprobdiff'], dtype=numpy.float64 )
+        df = self.run_query_frame( 'SELECT v."classifierId", v."trueClassId", '
+                                   '  v.earlytimebin, tbe.dtmin AS earlytimet0, tbe.dtmax AS earlytimet1,'
+                                   '  v.latetimebin, tbl.dtmin AS latetimet0, tbl.dtmax AS latetimet1,'
+                                   '  probdiffbin, binmeanprobdiff, count '
+                                   'FROM elasticc_view_maxprobdiff_hist v '
+                                   'INNER JOIN elasticc_maxprob_timebins tbe ON v.earlytimebin=tbe.timebin '
+                                   'INNER JOIN elasticc_maxprob_timebins tbl ON v.latetimebin=tbl.timebin '
+                                   'ORDER BY "trueClassId", "classifierId", earlytimebin, latetimebin, probdiffbin ',
+                                   schema={ 'binmeanprobdiff': numpy.float64, 'count': numpy.int64 } )
+        self.logger.debug( "Query done, indexing" )
         df.set_index( [ 'classifierId', 'trueClassId', 'earlytimebin', 'latetimebin', 'probdiffbin' ], inplace=True )
         df['frac'] = ( df['count']
                        / df.groupby( ['classifierId','trueClassId',
@@ -1,13 +1,29 @@
 import argparse
+import functools
+import json
 import logging
+import multiprocessing
 import os
+import pathlib
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pprint import pformat
-from typing import Dict, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import requests
 
+import tom_cache
+import tom_session
+import tom_sql
+import tom_stats
+
+
+# dtypes for the (classifier_id,) pred_class, true_class, n results of the classification queries.
+# pred_class is left out because it's NULL for missed objects.
+_classifications_schema = {'classifier_id': np.int64, 'true_class': np.int64, 'n': np.int64}
+
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(
@@ -31,41 +47,51 @@ def parse_args(args=None):
     parser.add_argument('-n', '--nth-detection', default=3, type=int,
                         help='Which detection to use for --definition nth' )
     parser.add_argument('--classifier_id', type=int, help='consider a single classifier')
+    parser.add_argument('-j', '--jobs', default=1, type=int,
+                        help='Number of classifier queries to run against the server at once (default: 1)')
+    parser.add_argument('--batched', action='store_true',
+                        help='Get all classifiers with a single query instead of one query per classifier')
+    parser.add_argument('--plot-jobs', default=1, type=int,
+                        help='Number of processes to use for plotting (default: 1)')
+    parser.add_argument('--incremental', metavar='DIR',
+                        help=('Keep per-object classification state in DIR and only fetch broker messages '
+                              'newer than the last run'))
+    parser.add_argument('--bootstrap', metavar='N', type=int,
+                        help=('Draw N bootstrap resamples of each matrix and save percentile intervals '
+                              'for every --norm option to conf_matrices_bootstrap.csv'))
+    parser.add_argument('--bootstrap-method', default='multinomial', choices=['multinomial', 'poisson'],
+                        help='How to resample counts for --bootstrap (default: multinomial)')
+    parser.add_argument('--bootstrap-jobs', default=1, type=int,
+                        help='Number of processes to use for --bootstrap (default: 1)')
+    parser.add_argument('--seed', type=int, help='Random seed for --bootstrap')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                        help=('Save each classifier\'s result in DIR as soon as it arrives, and skip classifiers '
+                              'already saved there by an earlier run with the same arguments'))
+    parser.add_argument('--retries', default=0, type=int,
+                        help=('Times to retry a query that fails after it was sent (connection reset, read timeout '
+                              'or 5xx; default: 0)'))
+    parser.add_argument('--stats', metavar='FILE',
+                        help='Write per-query timing stats to FILE (JSON, or CSV if FILE ends in .csv)')
     return parser.parse_args(args)
 
 
 class ConfMatrixClient:
     url = "https://desc-tom.lbl.gov"
+    # Where query timings are recorded; see tom_stats.py
+    stats = tom_stats.stats
 
     @classmethod
-    def from_credentials(cls, user, password):
-        session = requests.session()
-        session.get(f'{cls.url}/accounts/login/')
-        res = session.post(
-            f'{cls.url}/accounts/login/',
-            data={
-                "username": user,
-                "password": password,
-                "csrfmiddlewaretoken": session.cookies['csrftoken']
-            },
-        )
-        if res.status_code != 200:
-            raise RuntimeError(f"Failed to log in; http status: {res.status_code}")
-        if 'Please enter a correct' in res.text:
-            # This is a very cheesy attempt at checking if the login failed.
-            # I haven't found clean documentation on how to log into a django site
-            # from an app like this using standard authentication stuff.  So, for
-            # now, I'm counting on the HTML that happened to come back when
-            # I ran it with a failed login one time.  One of these days I'll actually
-            # figure out how Django auth works and make a version of /accounts/login/
-            # designed for use in API scripts like this one, rather than desgined
-            # for interactive users.
-            raise RuntimeError("Failed to log in.  I think.  Put in a debug break and look at res.text")
-        session.headers['X-CSRFToken'] = session.cookies['csrftoken']
-        return cls(session)
-
-    def __init__(self, session: requests.Session):
+    def from_credentials(cls, user, password, querycache=None):
+        """A client using the tom_session.shared session for user (so it logs in only if nothing else has)."""
+        return cls(tom_session.shared(cls.url, user, password), querycache=querycache)
+
+    def __init__(self, session: requests.Session, querycache=None):
+        """querycache is a tom_cache.QueryCache, None for tom_cache.shared, or False to not cache queries.
+
+        With the default, constructing more clients doesn't re-send the taxonomy and classifier queries.
+        """
         self.session = session
+        self.querycache = tom_cache.resolve(querycache)
         self.taxonomy = { -1: 'missed' }
         self.load_taxonomy()
         self.load_classifiers()
@@ -94,37 +120,93 @@ class ConfMatrixClient:
         self.classifiers = {row['classifierId']: f'{row["brokerName"]} {row["brokerVersion"]} {row["classifierName"]}'
                             for row in data}
         
-    def query(self, query: str) -> List[Dict]:
-        result = self.session.post(f'{self.url}/db/runsqlquery/', json={'query': query, 'subdict': {}})
+    def _post_query(self, rec: tom_stats.CallRecord, query: str, subdict: Dict,
+                    cache: bool) -> Tuple[Optional[str], bytes]:
+        """Get the body of the response to query, from self.querycache if it's there.
+
+        Returns (key, content).  key is the cache key to store content under once the caller has checked
+        that it's a good response; it's None if content came from the cache, or the cache isn't in use.
+        """
+        querycache = self.querycache if cache else None
+        key = None
+        if querycache is not None:
+            key = querycache.key(self.url, query, subdict)
+            content = querycache.get(key)
+            if content is not None:
+                rec.cached(content)
+                return None, content
+        result = self.session.post(f'{self.url}/db/runsqlquery/', json={'query': query, 'subdict': subdict})
+        rec.response(result)
         result.raise_for_status()
-        data = result.json()
-        if ('status' not in data) or (data['status'] != 'ok'):
-            raise RuntimeError(f"Got unexpected response:\n{data}\n")
-        return data['rows']
+        return key, result.content
 
+    def query(self, query: str, subdict: Optional[Dict] = None, cache: bool = True) -> List[Dict]:
+        """Send query to the server and return the rows; cache=False bypasses self.querycache."""
+        subdict = {} if subdict is None else subdict
+        with self.stats.record('ConfMatrixClient', 'sql', query) as rec:
+            key, content = self._post_query(rec, query, subdict, cache)
+            data = json.loads(content)
+            rec.lap('decode_s')
+            if ('status' not in data) or (data['status'] != 'ok'):
+                raise RuntimeError(f"Got unexpected response:\n{data}\n")
+            if key is not None:
+                self.querycache.put(key, content)
+            rec.fields['nrows'] = len(data['rows'])
+            return data['rows']
 
-    def get_classifications(self, *,
-                            definition: str,
-                            nth_detection: int = 3,
-                            classifier_id: Optional[int],
-                            include_missed: bool = False) -> Dict[str, pd.DataFrame]:
-        if include_missed:
-            best_last_join_type = 'LEFT'
-            join_object_sent = '''
-                INNER JOIN (
-                    SELECT
-                    "diaObjectId", bool_or("alertSentTimestamp" IS NOT NULL) AS "is_sent"
-                        FROM elasticc_diaalert
-                        GROUP BY "diaObjectId" 
-                    ) object_sent_record
-                        ON (elasticc_diaobjecttruth."diaObjectId" = object_sent_record."diaObjectId")
-                    '''
-            where = 'WHERE object_sent_record."is_sent"'
-        else:
-            best_last_join_type = 'INNER'
-            join_object_sent = ''
-            where = ''
+    def query_frame(self, query: str, subdict: Optional[Dict] = None,
+                    schema: Optional[Dict] = None, cache: bool = True) -> pd.DataFrame:
+        """Like query, but decode the response straight into a DataFrame; see tom_sql.decode_rows."""
+        subdict = {} if subdict is None else subdict
+        with self.stats.record('ConfMatrixClient', 'sql', query) as rec:
+            key, content = self._post_query(rec, query, subdict, cache)
+            data, df = tom_sql.decode_rows(content, schema=schema, timings=rec.timings)
+            if ('status' not in data) or (data['status'] != 'ok') or (df is None):
+                raise RuntimeError(f"Got unexpected response:\n{data}\n")
+            if key is not None:
+                self.querycache.put(key, content)
+            rec.fields['nrows'] = len(df)
+            return df
+
+    def query_chunked(self, query: str, key, subdict: Optional[Dict] = None, chunksize: int = 100_000,
+                      asrecords: bool = False,
+                      schema: Optional[Dict] = None) -> Iterator[Union[pd.DataFrame, np.recarray]]:
+        """Yield the result of query in chunks of at most chunksize rows, paging on the (unique) key column(s).
+
+        Pages never go through self.querycache, so only one chunk is in memory at a time.
+        """
+        return tom_sql.iter_frames(functools.partial(self.query_frame, cache=False), query, key, subdict=subdict,
+                                   chunksize=chunksize, asrecords=asrecords, schema=schema)
+
+    def truth_frame(self, cache: bool = True) -> pd.DataFrame:
+        """Get a diaObjectId, true_class frame for all truth objects.
+
+        There is one row per matching elasticc_gentypeofclassid row, as in the confusion matrix queries.
+        """
+        return self.query_frame(
+            'SELECT elasticc_diaobjecttruth."diaObjectId", elasticc_gentypeofclassid."classId" AS true_class '
+            'FROM elasticc_diaobjecttruth '
+            'INNER JOIN elasticc_gentypeofclassid '
+            '  ON (elasticc_diaobjecttruth.gentype = elasticc_gentypeofclassid.gentype)',
+            schema={'diaObjectId': np.int64, 'true_class': np.int64}, cache=cache)
+
+    def truth_count(self) -> int:
+        """Number of rows in the truth table (never from the query cache)."""
+        df = self.query_frame('SELECT COUNT(*) AS n FROM elasticc_diaobjecttruth', schema={'n': np.int64},
+                              cache=False)
+        return int(df['n'].iloc[0])
+
+    def sent_objects_frame(self, after_alert_id: int = -1, cache: bool = True) -> pd.DataFrame:
+        """diaObjectId, maxAlertId for objects with an alert sent, considering only alerts after after_alert_id."""
+        return self.query_frame(
+            'SELECT "diaObjectId", MAX("alertId") AS "maxAlertId" FROM elasticc_diaalert '
+            'WHERE "alertSentTimestamp" IS NOT NULL AND "alertId" > %(after)s '
+            'GROUP BY "diaObjectId"', {'after': int(after_alert_id)},
+            schema={'diaObjectId': np.int64, 'maxAlertId': np.int64}, cache=cache)
 
+    @staticmethod
+    def _classification_definition_sql(definition: str, nth_detection: int = 3) -> Tuple[str, str]:
+        """Return (distinct_order, count_join) SQL fragments for a --definition."""
         if definition == 'last_best':
             distinct_order = ( 'elasticc_diaalert."alertSentTimestamp" DESC,'
                                'elasticc_brokerclassification."probability" DESC' )
@@ -145,115 +227,857 @@ class ConfMatrixClient:
                            f'  AND elasticc_view_prevsourcecounts.ndetections={nth_detection}' )
         else:
             raise ValueError(f'Unknown classification definition: {definition}')
+        return distinct_order, count_join
 
-        dfs = {}
-        for classifier_id_, classifier_name in self.classifiers.items():
-            if classifier_id is not None and classifier_id != classifier_id_:
-                continue
+    @staticmethod
+    def _object_sent_sql(include_missed: bool) -> Tuple[str, str]:
+        """Return (join_object_sent, where) SQL fragments for --include-missed."""
+        if not include_missed:
+            return '', ''
+        join_object_sent = '''
+            INNER JOIN (
+                SELECT
+                "diaObjectId", bool_or("alertSentTimestamp" IS NOT NULL) AS "is_sent"
+                    FROM elasticc_diaalert
+                    GROUP BY "diaObjectId" 
+                ) object_sent_record
+                    ON (elasticc_diaobjecttruth."diaObjectId" = object_sent_record."diaObjectId")
+                '''
+        return join_object_sent, 'WHERE object_sent_record."is_sent"'
 
-            logging.info(f'Getting classifications for {classifier_name}...')
-            query = f'''
-                SELECT best_last."classId" AS pred_class,
-                       elasticc_gentypeofclassid."classId" AS true_class,
-                       COUNT(*) AS n
-                FROM elasticc_diaobjecttruth
-                INNER JOIN elasticc_gentypeofclassid
-                    ON (elasticc_diaobjecttruth.gentype = elasticc_gentypeofclassid.gentype)
-                {join_object_sent}
-                {best_last_join_type} JOIN
-                (
-                   SELECT DISTINCT ON (elasticc_diaalert."diaObjectId")
-                      elasticc_brokerclassification."classId", elasticc_brokerclassification."probability",
-                      elasticc_diaalert."diaObjectId"
-                   FROM elasticc_brokerclassification
-                   INNER JOIN elasticc_brokermessage
-                      ON elasticc_brokerclassification."brokerMessageId"=elasticc_brokermessage."brokerMessageId"
-                   INNER JOIN elasticc_diaalert
-                      ON elasticc_brokermessage."alertId"=elasticc_diaalert."alertId"
-                   {count_join}
-                   WHERE elasticc_brokerclassification."classifierId"={classifier_id_}
-                   ORDER BY elasticc_diaalert."diaObjectId", {distinct_order}
-                ) best_last
-                ON (best_last."diaObjectId" = elasticc_diaobjecttruth."diaObjectId")
-                {where}
-                GROUP BY pred_class, true_class
-                ORDER BY pred_class, true_class
-            '''
-            data = self.query(query)
-            logging.info(pformat(data))
-            if len(data) == 0:
-                logging.warning(f'No data for {classifier_name}')
-                continue
-            df = pd.DataFrame.from_records(data)
-            df['classifier_id'] = classifier_id_
-            df['classifier_name'] = classifier_name
-            df['pred_class'] = df['pred_class'].fillna(-1).astype(int)
-            dfs[classifier_id_] = df
+    def _classifications_query(self, classifier_id: int, *,
+                               definition: str,
+                               nth_detection: int = 3,
+                               include_missed: bool = False) -> str:
+        distinct_order, count_join = self._classification_definition_sql(definition, nth_detection)
+        join_object_sent, where = self._object_sent_sql(include_missed)
+        best_last_join_type = 'LEFT' if include_missed else 'INNER'
+        classifier_id = int( classifier_id )
+        return f'''
+            SELECT best_last."classId" AS pred_class,
+                   elasticc_gentypeofclassid."classId" AS true_class,
+                   COUNT(*) AS n
+            FROM elasticc_diaobjecttruth
+            INNER JOIN elasticc_gentypeofclassid
+                ON (elasticc_diaobjecttruth.gentype = elasticc_gentypeofclassid.gentype)
+            {join_object_sent}
+            {best_last_join_type} JOIN
+            (
+               SELECT DISTINCT ON (elasticc_diaalert."diaObjectId")
+                  elasticc_brokerclassification."classId", elasticc_brokerclassification."probability",
+                  elasticc_diaalert."diaObjectId"
+               FROM elasticc_brokerclassification
+               INNER JOIN elasticc_brokermessage
+                  ON elasticc_brokerclassification."brokerMessageId"=elasticc_brokermessage."brokerMessageId"
+               INNER JOIN elasticc_diaalert
+                  ON elasticc_brokermessage."alertId"=elasticc_diaalert."alertId"
+               {count_join}
+               WHERE elasticc_brokerclassification."classifierId"={classifier_id}
+               ORDER BY elasticc_diaalert."diaObjectId", {distinct_order}
+            ) best_last
+            ON (best_last."diaObjectId" = elasticc_diaobjecttruth."diaObjectId")
+            {where}
+            GROUP BY pred_class, true_class
+            ORDER BY pred_class, true_class
+        '''
+
+    def _batched_classifications_query(self, classifier_ids: List[int], *,
+                                       definition: str,
+                                       nth_detection: int = 3,
+                                       include_missed: bool = False) -> str:
+        """One statement giving (classifier_id, pred_class, true_class, n) for all of classifier_ids.
+
+        The DISTINCT ON is partitioned by ("classifierId", "diaObjectId"),
+        so the big classification/message/alert join is scanned once
+        rather than once per classifier.  With include_missed, every
+        truth object is crossed with every classifier so that objects a
+        classifier never reported on show up with a NULL pred_class,
+        same as the LEFT JOIN in the per-classifier query.
+        """
+        distinct_order, count_join = self._classification_definition_sql(definition, nth_detection)
+        join_object_sent, where = self._object_sent_sql(include_missed)
+        idlist = ','.join(str(int(i)) for i in classifier_ids)
+        if include_missed:
+            classifier_col = 'classifiers."classifierId"'
+            cross_join = f'CROSS JOIN ( SELECT unnest(ARRAY[{idlist}]) AS "classifierId" ) classifiers'
+            best_last_join = 'LEFT JOIN'
+            classifier_match = 'AND best_last."classifierId" = classifiers."classifierId"'
+        else:
+            classifier_col = 'best_last."classifierId"'
+            cross_join = ''
+            best_last_join = 'INNER JOIN'
+            classifier_match = ''
+        return f'''
+            SELECT {classifier_col} AS classifier_id,
+                   best_last."classId" AS pred_class,
+                   elasticc_gentypeofclassid."classId" AS true_class,
+                   COUNT(*) AS n
+            FROM elasticc_diaobjecttruth
+            INNER JOIN elasticc_gentypeofclassid
+                ON (elasticc_diaobjecttruth.gentype = elasticc_gentypeofclassid.gentype)
+            {join_object_sent}
+            {cross_join}
+            {best_last_join}
+            (
+               SELECT DISTINCT ON (elasticc_brokerclassification."classifierId", elasticc_diaalert."diaObjectId")
+                  elasticc_brokerclassification."classifierId",
+                  elasticc_brokerclassification."classId", elasticc_brokerclassification."probability",
+                  elasticc_diaalert."diaObjectId"
+               FROM elasticc_brokerclassification
+               INNER JOIN elasticc_brokermessage
+                  ON elasticc_brokerclassification."brokerMessageId"=elasticc_brokermessage."brokerMessageId"
+               INNER JOIN elasticc_diaalert
+                  ON elasticc_brokermessage."alertId"=elasticc_diaalert."alertId"
+               {count_join}
+               WHERE elasticc_brokerclassification."classifierId" IN ({idlist})
+               ORDER BY elasticc_brokerclassification."classifierId", elasticc_diaalert."diaObjectId",
+                        {distinct_order}
+            ) best_last
+            ON (best_last."diaObjectId" = elasticc_diaobjecttruth."diaObjectId" {classifier_match})
+            {where}
+            GROUP BY classifier_id, pred_class, true_class
+            ORDER BY classifier_id, pred_class, true_class
+        '''
+
+    def _classifications_frame(self, classifier_id: int, df: pd.DataFrame) -> Optional[pd.DataFrame]:
+        classifier_name = self.classifiers[classifier_id]
+        if len(df) == 0:
+            logging.warning(f'No data for {classifier_name}')
+            return None
+        logging.info(f'\n{df.to_string(index=False)}')
+        df = df.reset_index(drop=True)
+        df['classifier_id'] = classifier_id
+        df['classifier_name'] = classifier_name
+        df['pred_class'] = df['pred_class'].fillna(-1).astype(int)
+        return df
+
+    def get_classifications(self, *,
+                            definition: str,
+                            nth_detection: int = 3,
+                            classifier_id: Optional[Union[int, Iterable[int]]],
+                            include_missed: bool = False,
+                            jobs: int = 1,
+                            batched: bool = False,
+                            checkpoint_dir: Optional[str] = None,
+                            retries: int = 0,
+                            retry_backoff: float = 5.,
+                            failed: Optional[Dict[int, Exception]] = None) -> Dict[int, pd.DataFrame]:
+        """Get aggregated (pred_class, true_class, n) frames for each classifier.
+
+        classifier_id is one classifier id, a collection of them, or None for all classifiers.
+
+        With jobs > 1, up to that many per-classifier queries are sent
+        to the server at once.  The results (and the log output for each
+        classifier) come back in the same order as with jobs=1.
 
+        With batched=True, all classifiers are done in a single SQL
+        statement and the result is split up by classifier afterwards;
+        jobs is ignored.  The returned frames are the same as without
+        batched.
+
+        A query that fails after it was sent (a connection reset, a read
+        timeout, or an HTTP 5xx status) is retried up to retries times,
+        waiting retry_backoff seconds before the first retry and twice as
+        long before each one after that.  (Failures to connect are
+        retried by the session, not here; see tom_session.py.)  A
+        classifier whose query still fails is left out of the returned
+        dict; the exception is logged and, if you pass a dict as failed,
+        put in it (classifierId -> exception), so the rest of the run can
+        finish.  Failures are only reported that way, per
+        call, so concurrent calls on one client don't mix them up.
+
+        With checkpoint_dir, each classifier's query result is written to
+        a parquet file under checkpoint_dir (in a subdirectory named for
+        definition and include_missed; see checkpoint_path) as soon as it
+        comes back.  Classifiers that already have a file there aren't
+        queried again, so re-running with the same arguments after a
+        crash picks up where the last run stopped.  Delete the directory
+        to start over.
+        """
+        query_kwargs = dict(definition=definition, nth_detection=nth_detection, include_missed=include_missed)
+        if classifier_id is None or isinstance(classifier_id, (int, np.integer)):
+            selected = None if classifier_id is None else {classifier_id}
+        else:
+            selected = set(classifier_id)
+        classifier_ids = [classifier_id_ for classifier_id_ in self.classifiers
+                          if selected is None or classifier_id_ in selected]
+        failed = {} if failed is None else failed
+        checkpoint = None if checkpoint_dir is None else self.checkpoint_path(checkpoint_dir, **query_kwargs)
+        fetch = functools.partial(self._query_with_retry, retries=retries, retry_backoff=retry_backoff)
+
+        checkpointed = {}
+        if checkpoint is not None:
+            for classifier_id_ in classifier_ids:
+                path = checkpoint / f'classifier_{classifier_id_}.parquet'
+                if path.is_file():
+                    checkpointed[classifier_id_] = pd.read_parquet(path)
+            if len(checkpointed) > 0:
+                logging.info(f'Using checkpointed classifications for {len(checkpointed)} classifier(s) '
+                             f'from {checkpoint}')
+        todo = [classifier_id_ for classifier_id_ in classifier_ids if classifier_id_ not in checkpointed]
+
+        if batched:
+            dfs = self._get_batched_classifications(todo, fetch, checkpoint, failed, **query_kwargs)
+        else:
+            dfs = self._get_each_classifications(todo, fetch, checkpoint, failed, jobs, **query_kwargs)
+        for classifier_id_, data in checkpointed.items():
+            logging.info(f'Checkpointed classifications for {self.classifiers[classifier_id_]}:')
+            df = self._classifications_frame(classifier_id_, data)
+            if df is not None:
+                dfs[classifier_id_] = df
+
+        self._log_failed_classifiers(failed)
         logging.info('...done getting all classifications')
+        return {classifier_id_: dfs[classifier_id_] for classifier_id_ in classifier_ids if classifier_id_ in dfs}
+
+    @staticmethod
+    def checkpoint_path(checkpoint_dir, *, definition: str, nth_detection: int = 3,
+                        include_missed: bool = False) -> pathlib.Path:
+        """The directory under checkpoint_dir that get_classifications checkpoints into for these arguments."""
+        tag = f'nth{int(nth_detection)}' if definition == 'nth' else definition
+        return pathlib.Path(checkpoint_dir) / (f'{tag}_missed' if include_missed else tag)
+
+    def _query_with_retry(self, query: str, *, retries: int, retry_backoff: float,
+                          checkpoint_path: Optional[pathlib.Path] = None) -> pd.DataFrame:
+        """query_frame the query with the classifications schema, retrying transient failures.
+
+        If checkpoint_path isn't None, the result is written there before it's returned.
+        """
+        attempt = 0
+        while True:
+            try:
+                # Not from the query cache: in a long-lived process, a cached result would go stale
+                data = self.query_frame(query, schema=_classifications_schema, cache=False)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as ex:
+                status = getattr(ex.response, 'status_code', None)
+                if attempt >= retries or (isinstance(ex, requests.HTTPError) and (status is None or status < 500)):
+                    raise
+                # e.g. couldn't connect: the session has already retried that (see tom_session.py)
+                if tom_session.exhausted(ex):
+                    raise
+                wait = retry_backoff * 2 ** attempt
+                attempt += 1
+                logging.warning(f'Query failed ({ex}); retry {attempt} of {retries} in {wait:.3g} s')
+                time.sleep(wait)
+        if checkpoint_path is not None:
+            _write_atomically(checkpoint_path, lambda tmppath: data.to_parquet(tmppath, index=False))
+        return data
+
+    def _get_each_classifications(self, classifier_ids: List[int], fetch, checkpoint: Optional[pathlib.Path],
+                                  failed: Dict[int, Exception], jobs: int, **query_kwargs) -> Dict[int, pd.DataFrame]:
+        """One query per classifier, up to jobs at once; see get_classifications."""
+        queries = {classifier_id_: self._classifications_query(classifier_id_, **query_kwargs)
+                   for classifier_id_ in classifier_ids}
+        paths = {classifier_id_: None if checkpoint is None else checkpoint / f'classifier_{classifier_id_}.parquet'
+                 for classifier_id_ in classifier_ids}
+        if jobs > 1:
+            executor = ThreadPoolExecutor(max_workers=jobs)
+            futures = {classifier_id_: executor.submit(fetch, query, checkpoint_path=paths[classifier_id_])
+                       for classifier_id_, query in queries.items()}
+        else:
+            executor = None
+            futures = None
+
+        dfs = {}
+        try:
+            for classifier_id_, query in queries.items():
+                classifier_name = self.classifiers[classifier_id_]
+                logging.info(f'Getting classifications for {classifier_name}...')
+                try:
+                    data = (futures[classifier_id_].result() if futures is not None
+                            else fetch(query, checkpoint_path=paths[classifier_id_]))
+                except Exception as ex:
+                    logging.error(f'Failed to get classifications for {classifier_name}: {ex}')
+                    failed[classifier_id_] = ex
+                    continue
+                df = self._classifications_frame(classifier_id_, data)
+                if df is not None:
+                    dfs[classifier_id_] = df
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
         return dfs
 
+    def _get_batched_classifications(self, classifier_ids: List[int], fetch, checkpoint: Optional[pathlib.Path],
+                                     failed: Dict[int, Exception], **query_kwargs) -> Dict[int, pd.DataFrame]:
+        dfs = {}
+        if len(classifier_ids) == 0:
+            return dfs
+        logging.info(f'Getting classifications for {len(classifier_ids)} classifiers in one query...')
+        try:
+            data = fetch(self._batched_classifications_query(classifier_ids, **query_kwargs))
+        except Exception as ex:
+            logging.error(f'Failed to get batched classifications: {ex}')
+            failed.update({classifier_id_: ex for classifier_id_ in classifier_ids})
+            return dfs
 
-    @np.vectorize
-    def conf_annotation(count: int, fraction: float) -> str:
-        percent = np.round(fraction * 100)
-        if count < 1_000_000:
-            count_str = str(count)
+        empty = data.iloc[0:0].drop(columns='classifier_id')
+        groups = {classifier_id_: group.drop(columns='classifier_id')
+                  for classifier_id_, group in data.groupby('classifier_id', sort=False)}
+        for classifier_id_ in classifier_ids:
+            group = groups.get(classifier_id_, empty)
+            if checkpoint is not None:
+                _write_atomically(checkpoint / f'classifier_{classifier_id_}.parquet',
+                                  lambda tmppath: group.to_parquet(tmppath, index=False))
+            logging.info(f'Classifications for {self.classifiers[classifier_id_]}:')
+            df = self._classifications_frame(classifier_id_, group)
+            if df is not None:
+                dfs[classifier_id_] = df
+        return dfs
+
+    def _log_failed_classifiers(self, failed: Dict[int, Exception]):
+        if len(failed) > 0:
+            logging.error(f'Failed to get classifications for {len(failed)} classifier(s): '
+                          + ', '.join(self.classifiers[i] for i in failed))
+
+
+    @staticmethod
+    def conf_annotations(counts: np.ndarray, fractions: np.ndarray) -> np.ndarray:
+        """Build the "percent%\ncount" cell labels for a whole matrix at once."""
+        percent = np.round(fractions * 100).astype(str)
+        count_str = counts.astype(str).astype(object)
+        big = counts >= 1_000_000
+        count_str[big] = [f'{count:.3g}' for count in counts[big]]
+        return np.char.add(np.char.add(percent, '%\n'), count_str.astype(str))
+
+    @staticmethod
+    def count_fraction_matrices(matrix: pd.DataFrame, norm: str):
+        """Pivot a (pred_class, true_class, n) frame into count and fraction matrices.
+
+        Returns (counts, fractions, true_classes, pred_classes); rows are
+        true_classes and columns pred_classes, both sorted, and only classes
+        that appear in matrix are included.  norm is as for
+        sklearn.metrics.confusion_matrix: 'true' normalizes rows, 'pred'
+        columns, 'all' the whole matrix, None not at all.
+        """
+        table = matrix.pivot_table(index='true_class', columns='pred_class', values='n',
+                                   aggfunc='sum', fill_value=0).sort_index(axis=0).sort_index(axis=1)
+        counts = table.to_numpy()
+        return counts, normalize_counts(counts, norm), table.index.to_numpy(), table.columns.to_numpy()
+
+    def bootstrap_matrices(self, dfs: Dict[int, pd.DataFrame], *, nsamples: int = 1000,
+                           method: str = 'multinomial', norms: Tuple[str, ...] = ('true', 'pred', 'all'),
+                           interval: Tuple[float, float] = (2.5, 97.5), seed: Optional[int] = None,
+                           jobs: int = 1) -> pd.DataFrame:
+        """Bootstrap percentile intervals for every cell of every matrix in dfs (as from get_classifications).
+
+        See bootstrap_matrix.  Each classifier gets its own random stream
+        spawned from seed, so the result for a given seed is the same
+        whatever jobs is.  With jobs > 1, classifiers are done in up to
+        that many processes.  Returns the bootstrap_matrix frames of all
+        classifiers concatenated.
+        """
+        seeds = np.random.SeedSequence(seed).spawn(len(dfs))
+        kwargs = dict(nsamples=nsamples, method=method, norms=norms, interval=interval)
+        if jobs <= 1 or len(dfs) <= 1:
+            frames = [bootstrap_matrix(matrix, seed=seed_, **kwargs) for matrix, seed_ in zip(dfs.values(), seeds)]
         else:
-            count_str = f'{count:.3g}'
-        return f'{percent}%\n{count_str}'
-
-    def plot_matrix(self, matrix: pd.DataFrame, *, norm: str, extension:str="pdf", show:bool=False ):
-        import matplotlib.pyplot as plt
-        import seaborn as sns
-        from matplotlib.patches import Rectangle
-        from sklearn.metrics import confusion_matrix
-
-        plt.figure(figsize=(20, 20))
-        plt.gca().set_aspect(
-            # aspect=len(np.unique(matrix['true_class'])) / len(np.unique(matrix['pred_class'])),
-            aspect='equal',
-            adjustable='box',
-        )
-        name = matrix.iloc[0]['classifier_name']
-        counts = confusion_matrix(
-            y_true=matrix['true_class'],
-            y_pred=matrix['pred_class'],
-            sample_weight=matrix['n'],
-            normalize=None,
-        )
-        # Remove empty lines corresponding to missed and Other classes
-        idx = np.where(np.sum(counts, axis=1) > 0)[0], np.where(np.sum(counts, axis=0) > 0)[0]
-        counts = counts[idx[0], :][:, idx[1]]
-        fractions = confusion_matrix(
-            y_true=matrix['true_class'],
-            y_pred=matrix['pred_class'],
-            sample_weight=matrix['n'],
-            normalize=norm,
-        )[idx[0], :][:, idx[1]]
-        annotations = self.conf_annotation(counts, fractions)
-        true_labels = np.vectorize(self.taxonomy.get)(np.unique(matrix['true_class']))
-        pred_labels = np.vectorize(self.taxonomy.get)(np.unique(matrix['pred_class']))
-        sns.heatmap(fractions,
-                    cmap='Blues', vmin=0, vmax=1,
-                    annot=annotations, fmt='s', annot_kws={"fontsize": 10},
-                    xticklabels=pred_labels, yticklabels=true_labels)
-        for j, label in enumerate(true_labels):
-            try:
-                i = np.where(pred_labels == label)[0].item()
-            except ValueError:
-                logging.warning(f'{label} not found in predictions for {name}')
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = [executor.submit(bootstrap_matrix, matrix, seed=seed_, **kwargs)
+                           for matrix, seed_ in zip(dfs.values(), seeds)]
+                frames = [future.result() for future in futures]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['classifier_id', 'classifier_name', 'norm', 'true_class', 'pred_class',
+                                         'n', 'fraction', 'fraction_lo', 'fraction_hi'])
+        return pd.concat(frames, ignore_index=True)
+
+    def plot_matrix(self, matrix: pd.DataFrame, *, norm: str, extension:str="pdf", show:bool=False,
+                    outdir: Optional[str] = None):
+        _plot_matrix(self.taxonomy, matrix, norm=norm, extension=extension, show=show, outdir=outdir)
+
+    def plot_matrices(self, dfs: Dict[int, pd.DataFrame], *, norm: str, extension: str = "pdf", jobs: int = 1,
+                      outdir: Optional[str] = None):
+        """Plot every matrix in dfs (as returned by get_classifications), using up to jobs processes.
+
+        Plots go in outdir (default: the current directory).
+        """
+        if jobs <= 1:
+            for matrix in dfs.values():
+                self.plot_matrix(matrix, norm=norm, extension=extension, outdir=outdir)
+            return
+        # spawn rather than fork so that the workers start with a clean
+        #  matplotlib (non-interactive backend, no inherited figures)
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_plot_worker) as executor:
+            futures = [executor.submit(_plot_matrix, self.taxonomy, matrix, norm=norm, extension=extension,
+                                       outdir=outdir)
+                       for matrix in dfs.values()]
+            for future in futures:
+                future.result()
+
+
+def normalize_counts(counts: np.ndarray, norm: Optional[str]) -> np.ndarray:
+    """Normalize confusion matrix counts (true class rows, predicted class columns) as for --norm.
+
+    counts may have leading axes (e.g. a stack of bootstrap resamples);
+    the matrix is the last two axes.  Cells of an all-zero row / column /
+    matrix come out 0 rather than NaN.
+    """
+    with np.errstate(all='ignore'):
+        if norm == 'true':
+            fractions = counts / counts.sum(axis=-1, keepdims=True)
+        elif norm == 'pred':
+            fractions = counts / counts.sum(axis=-2, keepdims=True)
+        elif norm == 'all':
+            fractions = counts / counts.sum(axis=(-2, -1), keepdims=True)
+        elif norm is None:
+            fractions = counts
+        else:
+            raise ValueError(f'Unknown normalization: {norm}')
+    return np.nan_to_num(fractions)
+
+
+def resample_counts(counts: np.ndarray, nsamples: int, method: str = 'multinomial',
+                    rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    """Draw nsamples resamples of a (true_class, pred_class) count matrix in one go.
+
+    method is 'multinomial' (each true-class row keeps its total, and is
+    redistributed over predicted classes with the observed fractions) or
+    'poisson' (every cell is an independent Poisson draw with the observed
+    count as its mean).  Returns an int64 array of shape
+    (nsamples, ntrue, npred).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    counts = np.asarray(counts, dtype=np.int64)
+    if method == 'multinomial':
+        totals = counts.sum(axis=1)
+        pvals = counts / np.maximum(totals, 1)[:, np.newaxis]
+        # Rows with no objects always resample to all zeros; any valid pvals will do
+        pvals[totals == 0] = 1. / counts.shape[1]
+        return rng.multinomial(totals, pvals, size=(nsamples, counts.shape[0]))
+    if method == 'poisson':
+        return rng.poisson(counts, size=(nsamples,) + counts.shape)
+    raise ValueError(f'Unknown bootstrap method: {method}')
+
+
+def bootstrap_matrix(matrix: pd.DataFrame, *, nsamples: int = 1000, method: str = 'multinomial',
+                     norms: Tuple[str, ...] = ('true', 'pred', 'all'),
+                     interval: Tuple[float, float] = (2.5, 97.5), seed=None) -> pd.DataFrame:
+    """Bootstrap percentile intervals for the normalized cells of one get_classifications frame.
+
+    Only the aggregated (pred_class, true_class, n) counts are used; see
+    resample_counts for method.  All nsamples resamples are drawn as one
+    array, and normalized for each of norms, so nothing is re-queried.
+    seed is anything numpy.random.default_rng takes.
+
+    Returns a long frame with one row per norm and (true_class,
+    pred_class) cell of the pivoted matrix (as count_fraction_matrices
+    gives): classifier_id, classifier_name, norm, true_class,
+    pred_class, n, fraction (of the observed counts), and fraction_lo,
+    fraction_hi (the interval percentiles of the resampled fractions).
+    """
+    counts, _, true_classes, pred_classes = ConfMatrixClient.count_fraction_matrices(matrix, None)
+    samples = resample_counts(counts, nsamples, method, np.random.default_rng(seed))
+    true_grid, pred_grid = np.meshgrid(true_classes, pred_classes, indexing='ij')
+    frames = []
+    for norm in norms:
+        lo, hi = np.percentile(normalize_counts(samples, norm), interval, axis=0)
+        frames.append(pd.DataFrame({'norm': norm,
+                                    'true_class': true_grid.ravel(),
+                                    'pred_class': pred_grid.ravel(),
+                                    'n': counts.ravel(),
+                                    'fraction': normalize_counts(counts, norm).ravel(),
+                                    'fraction_lo': lo.ravel(),
+                                    'fraction_hi': hi.ravel()}))
+    df = pd.concat(frames, ignore_index=True)
+    df.insert(0, 'classifier_name', matrix.iloc[0]['classifier_name'])
+    df.insert(0, 'classifier_id', matrix.iloc[0]['classifier_id'])
+    return df
+
+
+def _init_plot_worker():
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def _plot_matrix(taxonomy: Dict[int, str], matrix: pd.DataFrame, *, norm: str, extension: str = "pdf",
+                 show: bool = False, outdir: Optional[str] = None):
+    """Does the work of ConfMatrixClient.plot_matrix; a function so that it can run in a worker process."""
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from matplotlib.patches import Rectangle
+
+    plt.figure(figsize=(20, 20))
+    plt.gca().set_aspect(
+        # aspect=len(np.unique(matrix['true_class'])) / len(np.unique(matrix['pred_class'])),
+        aspect='equal',
+        adjustable='box',
+    )
+    name = matrix.iloc[0]['classifier_name']
+    # Empty lines corresponding to missed and Other classes don't show up in the pivot
+    counts, fractions, true_classes, pred_classes = ConfMatrixClient.count_fraction_matrices(matrix, norm)
+    annotations = ConfMatrixClient.conf_annotations(counts, fractions)
+    true_labels = np.vectorize(taxonomy.get)(true_classes)
+    pred_labels = np.vectorize(taxonomy.get)(pred_classes)
+    sns.heatmap(fractions,
+                cmap='Blues', vmin=0, vmax=1,
+                annot=annotations, fmt='s', annot_kws={"fontsize": 10},
+                xticklabels=pred_labels, yticklabels=true_labels)
+    for j, label in enumerate(true_labels):
+        try:
+            i = np.where(pred_labels == label)[0].item()
+        except ValueError:
+            logging.warning(f'{label} not found in predictions for {name}')
+            continue
+        plt.gca().add_patch(Rectangle((i, j), 1, 1, ec='black', fc='none', lw=2))
+    plt.title(name)
+    plt.xlabel('Predicted class')
+    plt.ylabel('True class')
+    plt.tight_layout()
+    if extension is not None:
+        plt.savefig(pathlib.Path(outdir or '.') / f'{name}.{extension}')
+    if show:
+        plt.show()
+    plt.close()
+
+
+def _timestamps_to_ns(values) -> np.ndarray:
+    """Convert alertSentTimestamp values to int64 ns since the epoch.
+
+    NULL timestamps become the largest int64, because postgres sorts NULLs
+    first for "ORDER BY ... DESC", i.e. as if they were larger than anything.
+    """
+    ts = pd.DatetimeIndex(pd.to_datetime(values, utc=True, format='ISO8601')).as_unit('ns')
+    ns = ts.asi8.copy()
+    ns[ts.isna()] = np.iinfo(np.int64).max
+    return ns
+
+
+def best_per_object(df: pd.DataFrame, definition: str, by: Tuple[str, ...] = ('diaObjectId',)) -> pd.DataFrame:
+    """Reduce classification rows to the one row per diaObjectId that defines the object's classification.
+
+    df has columns diaObjectId, classId, probability, and alertSentTimestamp
+    (int64 ns, see _timestamps_to_ns).  This reproduces the DISTINCT ON
+    ordering of ConfMatrixClient._classifications_query: for "best" and
+    "nth" the highest probability wins, for "last_best" the most recent
+    alert wins, with the other column breaking ties.
+
+    by gives the columns to group on; pass e.g. ('ndetections', 'diaObjectId')
+    to get one row per object for each number of detections at once.  The
+    result is sorted by the by columns.
+    """
+    prob = df['probability'].to_numpy(dtype=np.float64)
+    ts = df['alertSentTimestamp'].to_numpy(dtype=np.int64)
+    if definition == 'last_best':
+        ranking = (-prob, -ts)
+    elif definition in ('best', 'nth'):
+        ranking = (-ts, -prob)
+    else:
+        raise ValueError(f'Unknown classification definition: {definition}')
+    groupcols = [df[col].to_numpy() for col in by]
+    # np.lexsort sorts on the last key first
+    order = np.lexsort(ranking + tuple(reversed(groupcols)))
+    first = np.ones(len(order), dtype=bool)
+    for col in groupcols:
+        sorted_col = col[order]
+        first[1:] &= sorted_col[1:] == sorted_col[:-1]
+    first = ~first
+    first[:1] = True
+    return df.iloc[order[first]].reset_index(drop=True)
+
+
+def confusion_counts(truth: pd.DataFrame, best: pd.DataFrame,
+                     sent_objects: Optional[np.ndarray] = None) -> pd.DataFrame:
+    """Count objects by (pred_class, true_class).
+
+    truth : diaObjectId, true_class frame (ConfMatrixClient.truth_frame)
+
+    best : frame with diaObjectId, classId, one row per object (best_per_object)
+
+    sent_objects : if not None, include missed objects: objects in this
+      array with no row in best get a NULL (NaN) pred_class.  This is
+      --include-missed.
+
+    Returns a pred_class, true_class, n frame ordered like the server query.
+    """
+    if sent_objects is not None:
+        truth = truth[truth['diaObjectId'].isin(sent_objects)]
+    merged = truth.merge(best[['diaObjectId', 'classId']], on='diaObjectId',
+                         how='left' if sent_objects is not None else 'inner')
+    return (merged.rename(columns={'classId': 'pred_class'})
+            .groupby(['pred_class', 'true_class'], dropna=False).size()
+            .rename('n').reset_index())
+
+
+def _write_atomically(path: pathlib.Path, write):
+    """Call write(tmppath) and then rename tmppath to path, so readers never see a partial file."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmppath = path.parent / f'.{path.name}.{os.getpid()}.tmp'
+    try:
+        write(tmppath)
+        os.replace(tmppath, path)
+    finally:
+        tmppath.unlink(missing_ok=True)
+
+
+class IncrementalConfMatrices:
+    """Keep confusion matrices up to date without recomputing them from scratch.
+
+    For each classifier, the classification that currently defines each
+    object (see best_per_object) is kept in a parquet file under
+    state_dir, along with the highest brokerMessageId that has been folded
+    in.  update() fetches only classifications from newer broker messages,
+    merges them into the saved state, and rebuilds the (pred_class,
+    true_class, n) frames from that state, so the cost of a rerun scales
+    with the amount of new data.  The first update() for a classifier has
+    to pull all of its classifications.
+
+    The truth table (diaObjectId -> true class) is kept in state_dir along
+    with its row count, and fetched again whenever update() finds that the
+    count on the server has changed, so objects added to it after the
+    first run are counted once their classifications come in.  For
+    include_missed, the set of objects that have had an alert sent is kept
+    too, and updated by alertId.  Each update() checks both once, however
+    many classifiers it does.
+
+    This assumes broker messages are inserted with increasing
+    brokerMessageId (and alerts with increasing alertId).  A message that
+    commits with an id below the saved high-water mark will be missed;
+    delete state_dir to start over.
+    """
+
+    def __init__(self, client: ConfMatrixClient, state_dir, *, definition: str, nth_detection: int = 3,
+                 chunksize: int = 1_000_000):
+        # Raises ValueError for an unknown definition
+        ConfMatrixClient._classification_definition_sql(definition, nth_detection)
+        self.client = client
+        self.definition = definition
+        self.nth_detection = int(nth_detection)
+        self.chunksize = chunksize
+        self.state_dir = pathlib.Path(state_dir)
+        tag = f'nth{self.nth_detection}' if definition == 'nth' else definition
+        self.definition_dir = self.state_dir / tag
+        self._truth = None
+
+    def _read_json(self, path: pathlib.Path) -> Dict:
+        if not path.is_file():
+            return {}
+        with open(path) as ifp:
+            return json.load(ifp)
+
+    def _write_json(self, path: pathlib.Path, data: Dict):
+        def write(tmppath):
+            with open(tmppath, 'w') as ofp:
+                json.dump(data, ofp)
+        _write_atomically(path, write)
+
+    def _write_parquet(self, path: pathlib.Path, df: pd.DataFrame):
+        _write_atomically(path, lambda tmppath: df.to_parquet(tmppath, index=False))
+
+    def truth(self) -> pd.DataFrame:
+        """diaObjectId, true_class frame (one row per gentypeofclassid match, as in the server query).
+
+        Asks the server for the truth table's row count each call, and fetches the table again if it has
+        changed since the saved copy was made.
+        """
+        path = self.state_dir / 'truth.parquet'
+        countpath = self.state_dir / 'truth_count.json'
+        count = self.client.truth_count()
+        saved = self._read_json(countpath).get('count')
+        if self._truth is None and path.is_file() and saved == count:
+            self._truth = pd.read_parquet(path)
+        elif self._truth is None or saved != count:
+            logging.info(f'Getting truth table ({count} rows, was {saved})...')
+            self._truth = self.client.truth_frame(cache=False)
+            # Table first, then the count: if we die in between, the next run just fetches it again
+            self._write_parquet(path, self._truth)
+            self._write_json(countpath, {'count': count})
+        return self._truth
+
+    def sent_objects(self) -> np.ndarray:
+        """Sorted array of diaObjectIds that have had at least one alert sent, brought up to date."""
+        path = self.state_dir / 'sent_objects.parquet'
+        hwmpath = self.state_dir / 'sent_highwater.json'
+        sent = pd.read_parquet(path)['diaObjectId'].to_numpy() if path.is_file() else np.array([], dtype=np.int64)
+        hwm = self._read_json(hwmpath).get('alertId', -1)
+        # Never from the query cache: a cached answer for the same high-water mark would miss new alerts
+        new = self.client.sent_objects_frame(after_alert_id=hwm, cache=False)
+        if len(new) > 0:
+            sent = np.union1d(sent, new['diaObjectId'].to_numpy())
+            self._write_parquet(path, pd.DataFrame({'diaObjectId': sent}))
+            self._write_json(hwmpath, {'alertId': int(max(hwm, new['maxAlertId'].max()))})
+        return sent
+
+    def _new_classifications_query(self, classifier_id: int) -> str:
+        _, count_join = ConfMatrixClient._classification_definition_sql(self.definition, self.nth_detection)
+        return f'''
+            SELECT elasticc_brokerclassification."classificationId",
+                   elasticc_brokerclassification."brokerMessageId",
+                   elasticc_diaalert."diaObjectId",
+                   elasticc_brokerclassification."classId",
+                   elasticc_brokerclassification."probability",
+                   elasticc_diaalert."alertSentTimestamp"
+            FROM elasticc_brokerclassification
+            INNER JOIN elasticc_brokermessage
+               ON elasticc_brokerclassification."brokerMessageId"=elasticc_brokermessage."brokerMessageId"
+            INNER JOIN elasticc_diaalert
+               ON elasticc_brokermessage."alertId"=elasticc_diaalert."alertId"
+            {count_join}
+            WHERE elasticc_brokerclassification."classifierId"={int(classifier_id)}
+              AND elasticc_brokerclassification."brokerMessageId" > %(hwm)s
+        '''
+
+    def update_classifier(self, classifier_id: int) -> pd.DataFrame:
+        """Fold new classifications for one classifier into its saved state, and return the state."""
+        path = self.definition_dir / f'classifier_{classifier_id}.parquet'
+        hwmpath = self.definition_dir / 'highwater.json'
+        state = (pd.read_parquet(path) if path.is_file()
+                 else pd.DataFrame({'diaObjectId': pd.Series([], dtype=np.int64),
+                                    'classId': pd.Series([], dtype=np.int64),
+                                    'probability': pd.Series([], dtype=np.float64),
+                                    'alertSentTimestamp': pd.Series([], dtype=np.int64)}))
+        hwms = self._read_json(hwmpath)
+        hwm = hwms.get(str(classifier_id), -1)
+
+        newhwm = hwm
+        nnew = 0
+        schema = {'classificationId': np.int64, 'brokerMessageId': np.int64, 'diaObjectId': np.int64,
+                  'classId': np.int64, 'probability': np.float64}
+        for chunk in self.client.query_chunked(self._new_classifications_query(classifier_id), 'classificationId',
+                                               subdict={'hwm': int(hwm)}, chunksize=self.chunksize,
+                                               schema=schema):
+            nnew += len(chunk)
+            newhwm = max(newhwm, int(chunk['brokerMessageId'].max()))
+            chunk['alertSentTimestamp'] = _timestamps_to_ns(chunk['alertSentTimestamp'])
+            state = best_per_object(pd.concat([state, chunk[state.columns]], ignore_index=True), self.definition)
+
+        logging.info(f'{nnew} new classifications for {self.client.classifiers[classifier_id]} '
+                     f'(brokerMessageId > {hwm})')
+        if nnew > 0:
+            # State first, then the high-water mark: if we die in between, the
+            #  next run just re-applies some rows, which doesn't change the result.
+            self._write_parquet(path, state)
+            hwms = self._read_json(hwmpath)
+            hwms[str(classifier_id)] = newhwm
+            self._write_json(hwmpath, hwms)
+        return state
+
+    def matrix(self, classifier_id: int, state: pd.DataFrame, truth: pd.DataFrame,
+               sent: Optional[np.ndarray] = None) -> Optional[pd.DataFrame]:
+        """Build the (pred_class, true_class, n) frame for a classifier from its state.
+
+        truth is from truth(); pass sent (from sent_objects()) for include_missed.
+        """
+        counts = confusion_counts(truth, state, sent)
+        return self.client._classifications_frame(classifier_id, counts)
+
+    def update(self, *, classifier_id: Optional[int] = None, include_missed: bool = False) -> Dict[int, pd.DataFrame]:
+        """Bring the state for each (or one) classifier up to date; return the same thing as get_classifications."""
+        dfs = {}
+        # Once for all classifiers; each is a server query
+        truth = self.truth()
+        sent = self.sent_objects() if include_missed else None
+        for classifier_id_ in self.client.classifiers:
+            if classifier_id is not None and classifier_id != classifier_id_:
                 continue
-            plt.gca().add_patch(Rectangle((i, j), 1, 1, ec='black', fc='none', lw=2))
-        plt.title(name)
-        plt.xlabel('Predicted class')
-        plt.ylabel('True class')
-        plt.tight_layout()
-        if extension is not None:
-            plt.savefig(f'{name}.{extension}')
-        if show:
-            plt.show()
-        plt.close()
+            logging.info(f'Updating classifications for {self.client.classifiers[classifier_id_]}...')
+            state = self.update_classifier(classifier_id_)
+            df = self.matrix(classifier_id_, state, truth, sent)
+            if df is not None:
+                dfs[classifier_id_] = df
+        logging.info('...done updating all classifications')
+        return dfs
+
+
+class LocalConfMatrices:
+    """Compute the best, last_best and nth confusion matrices together, locally.
+
+    get_classifications has the server do a DISTINCT ON sort for every
+    classifier and every definition.  This instead pulls each
+    classifier's (diaObjectId, classId, probability, alertSentTimestamp,
+    ndetections) rows once, in chunks of chunksize rows, and reduces each
+    chunk for every definition (and every n for nth) at the same time
+    with best_per_object.  The per-definition running results are folded
+    together chunk by chunk, so memory is bounded by chunksize plus one
+    row per object per definition, not by the number of classifications.
+    """
+
+    def __init__(self, client: ConfMatrixClient, chunksize: int = 2_000_000):
+        self.client = client
+        self.chunksize = chunksize
+
+    def _rows_query(self, classifier_id: int) -> str:
+        return f'''
+            SELECT elasticc_brokerclassification."classificationId",
+                   elasticc_diaalert."diaObjectId",
+                   elasticc_brokerclassification."classId",
+                   elasticc_brokerclassification."probability",
+                   elasticc_diaalert."alertSentTimestamp",
+                   elasticc_view_prevsourcecounts.ndetections
+            FROM elasticc_brokerclassification
+            INNER JOIN elasticc_brokermessage
+               ON elasticc_brokerclassification."brokerMessageId"=elasticc_brokermessage."brokerMessageId"
+            INNER JOIN elasticc_diaalert
+               ON elasticc_brokermessage."alertId"=elasticc_diaalert."alertId"
+            LEFT JOIN elasticc_view_prevsourcecounts
+               ON elasticc_diaalert."diaSourceId"=elasticc_view_prevsourcecounts."diaSourceId"
+            WHERE elasticc_brokerclassification."classifierId"={int(classifier_id)}
+        '''
+
+    def per_object(self, classifier_id: int, nth_detections=(3,)) -> Dict[str, pd.DataFrame]:
+        """Return { definition: frame with one row per object } for one classifier.
+
+        Definitions are 'best', 'last_best', and 'nth{n}' for each n in
+        nth_detections.
+        """
+        nth_detections = np.array(sorted(int(n) for n in nth_detections), dtype=np.int64)
+        columns = ['diaObjectId', 'classId', 'probability', 'alertSentTimestamp', 'ndetections']
+        best = last_best = nth = pd.DataFrame({col: pd.Series([], dtype=np.int64) for col in columns})
+        schema = {'diaObjectId': np.int64, 'classId': np.int64, 'probability': np.float64}
+        for chunk in self.client.query_chunked(self._rows_query(classifier_id), 'classificationId',
+                                               chunksize=self.chunksize, schema=schema):
+            chunk['alertSentTimestamp'] = _timestamps_to_ns(chunk['alertSentTimestamp'])
+            chunk['ndetections'] = chunk['ndetections'].fillna(-1).astype(np.int64)
+            chunk = chunk[columns]
+            best = best_per_object(pd.concat([best, chunk], ignore_index=True), 'best')
+            last_best = best_per_object(pd.concat([last_best, chunk], ignore_index=True), 'last_best')
+            if len(nth_detections) > 0:
+                nthchunk = chunk[np.isin(chunk['ndetections'].to_numpy(), nth_detections)]
+                nth = best_per_object(pd.concat([nth, nthchunk], ignore_index=True), 'nth',
+                                      by=('ndetections', 'diaObjectId'))
+
+        rval = {'best': best, 'last_best': last_best}
+        # nth is sorted by ndetections, so each n is a contiguous block
+        ndet = nth['ndetections'].to_numpy()
+        for n in nth_detections:
+            lo, hi = np.searchsorted(ndet, [n, n + 1])
+            rval[f'nth{n}'] = nth.iloc[lo:hi].reset_index(drop=True)
+        return rval
+
+    def compute(self, *, classifier_id: Optional[int] = None, nth_detections=(3,),
+                include_missed: bool = False) -> pd.DataFrame:
+        """Return one frame with the matrices for every definition and classifier.
+
+        Columns are definition, plus the columns of a get_classifications
+        frame (pred_class, true_class, n, classifier_id, classifier_name).
+        Use split_by_definition to get get_classifications-style dicts.
+        """
+        truth = self.client.truth_frame()
+        sent = self.client.sent_objects_frame()['diaObjectId'].to_numpy() if include_missed else None
+        frames = []
+        for classifier_id_ in self.client.classifiers:
+            if classifier_id is not None and classifier_id != classifier_id_:
+                continue
+            logging.info(f'Getting classification rows for {self.client.classifiers[classifier_id_]}...')
+            for definition, best in self.per_object(classifier_id_, nth_detections).items():
+                df = self.client._classifications_frame(classifier_id_, confusion_counts(truth, best, sent))
+                if df is not None:
+                    df.insert(0, 'definition', definition)
+                    frames.append(df)
+        logging.info('...done getting all classifications')
+        if len(frames) == 0:
+            return pd.DataFrame(columns=['definition', 'pred_class', 'true_class', 'n',
+                                         'classifier_id', 'classifier_name'])
+        return pd.concat(frames, ignore_index=True)
+
+    @staticmethod
+    def split_by_definition(df: pd.DataFrame) -> Dict[str, Dict[int, pd.DataFrame]]:
+        """Turn the output of compute into { definition: { classifier_id: frame } }."""
+        return {definition: {classifier_id: matrix.drop(columns='definition').reset_index(drop=True)
+                             for classifier_id, matrix in defdf.groupby('classifier_id', sort=False)}
+                for definition, defdf in df.groupby('definition', sort=False)}
+
 
 def main(cli_args=None):
     args = parse_args(cli_args)
@@ -261,14 +1085,26 @@ def main(cli_args=None):
     username = os.getenv("DESC_TOM_USERNAME", "kostya")
     password = os.getenv("DESC_TOM_PASSWORD")
     client = ConfMatrixClient.from_credentials(username, password)
-    dfs = client.get_classifications(definition=args.definition, classifier_id=args.classifier_id,
-                                     include_missed=args.include_missed)
+    if args.incremental is not None:
+        incremental = IncrementalConfMatrices(client, args.incremental, definition=args.definition,
+                                              nth_detection=args.nth_detection)
+        dfs = incremental.update(classifier_id=args.classifier_id, include_missed=args.include_missed)
+    else:
+        dfs = client.get_classifications(definition=args.definition, nth_detection=args.nth_detection,
+                                         classifier_id=args.classifier_id, include_missed=args.include_missed,
+                                         jobs=args.jobs, batched=args.batched, checkpoint_dir=args.checkpoint,
+                                         retries=args.retries)
     if args.save:
         df = pd.concat(list(dfs.values()))
         df.to_csv('conf_matrices.csv', index=False)
+    if args.bootstrap is not None:
+        intervals = client.bootstrap_matrices(dfs, nsamples=args.bootstrap, method=args.bootstrap_method,
+                                              seed=args.seed, jobs=args.bootstrap_jobs)
+        intervals.to_csv('conf_matrices_bootstrap.csv', index=False)
     if args.plot:
-        for classifier_id, matrix in dfs.items():
-            client.plot_matrix(matrix, norm=args.norm, extension=args.plotfmt )
+        client.plot_matrices(dfs, norm=args.norm, extension=args.plotfmt, jobs=args.plot_jobs)
+    if args.stats is not None:
+        client.stats.dump(args.stats)
 
 
 
@@ -0,0 +1,36 @@
+"""Fixtures shared by the tests: a fake TOM (fake_tom.py) running in a background thread, and clients of it.
+
+The modules under test live in the top directory of the repository, not in a package, so put that on sys.path.
+
+"""
+
+import sys
+import pathlib
+
+import pytest
+
+sys.path.insert( 0, str( pathlib.Path( __file__ ).resolve().parent.parent ) )
+
+import fake_tom
+import tom_session
+
+
+@pytest.fixture( scope='session' )
+def fake_server():
+    with fake_tom.FakeTomServer( scale=0.02 ) as server:
+        yield server
+    tom_session.forget( server.url )
+
+
+@pytest.fixture( scope='session' )
+def confmatrix_client( fake_server ):
+    from sql_query_conf_matrices_objects import ConfMatrixClient
+    # ConfMatrixClient's url is a class attribute
+    cls = type( 'FakeConfMatrixClient', ( ConfMatrixClient, ), { 'url': fake_server.url } )
+    return cls.from_credentials( 'test', fake_tom.password, querycache=False )
+
+
+@pytest.fixture
+def tomclient( fake_server ):
+    from tom_client import TomClient
+    return TomClient( url=fake_server.url, username='test', password=fake_tom.password, querycache=False )
@@ -0,0 +1,72 @@
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sql_query_conf_matrices_objects import ConfMatrixClient, _timestamps_to_ns, best_per_object
+
+
+def _classifications(n=2000, seed=3):
+    """Random classification rows with plenty of ties in probability and time, and some NULL times."""
+    rng = np.random.default_rng(seed)
+    times = pd.Series(pd.date_range('2023-10-01', periods=5, freq='D', tz='UTC').strftime('%Y-%m-%dT%H:%M:%SZ'))
+    timestamps = times.iloc[rng.integers(0, len(times), n)].tolist()
+    for i in rng.choice(n, n // 20, replace=False):
+        timestamps[i] = None
+    return pd.DataFrame({'diaObjectId': rng.integers(0, 300, n),
+                         'ndetections': rng.integers(1, 4, n),
+                         'classId': rng.choice([2221, 2222, 2223, 2224], n),
+                         'probability': rng.choice([0.1, 0.5, 0.5, 0.9, 1.0], n),
+                         'alertSentTimestamp': _timestamps_to_ns(timestamps)})
+
+
+def _distinct_on(df, definition, by=('diaObjectId',)):
+    """What SELECT DISTINCT ON (by) ... ORDER BY by, <the definition's ordering> picks, and the ordering columns.
+
+    The ordering is parsed from the SQL that ConfMatrixClient sends, so this follows any change to it.
+    """
+    distinct_order, _ = ConfMatrixClient._classification_definition_sql(definition, 3)
+    order = re.findall(r'"(\w+)"\s+(ASC|DESC)', distinct_order)
+    assert len(order) > 0
+    cols = [col for col, _ in order]
+    # NULL times sort first for DESC in postgres; _timestamps_to_ns makes them the largest int64, which does the same
+    ranked = df.sort_values(list(by) + cols, ascending=[True] * len(by) + [d == 'ASC' for _, d in order],
+                            kind='stable')
+    return ranked.groupby(list(by), sort=True).head(1).reset_index(drop=True), cols
+
+
+@pytest.mark.parametrize('definition', ['best', 'last_best', 'nth'])
+def test_matches_distinct_on(definition):
+    df = _classifications()
+    expected, cols = _distinct_on(df, definition)
+    got = best_per_object(df, definition)
+    assert got['diaObjectId'].tolist() == expected['diaObjectId'].tolist()
+    # Where the SQL ordering ties, DISTINCT ON may pick any of the tied rows; the ordering columns must agree
+    pd.testing.assert_frame_equal(got[cols], expected[cols])
+    if definition != 'nth':
+        # best and last_best order on both probability and time, so the row is fully determined (up to classId)
+        pd.testing.assert_frame_equal(got[['probability', 'alertSentTimestamp']],
+                                      expected[['probability', 'alertSentTimestamp']])
+
+
+def test_by_several_columns():
+    df = _classifications()
+    by = ('ndetections', 'diaObjectId')
+    expected, cols = _distinct_on(df, 'last_best', by=by)
+    got = best_per_object(df, 'last_best', by=by)
+    pd.testing.assert_frame_equal(got[list(by) + cols], expected[list(by) + cols])
+
+
+def test_null_time_wins_last_best():
+    df = pd.DataFrame({'diaObjectId': [1, 1], 'classId': [2221, 2222], 'probability': [0.9, 0.1],
+                       'alertSentTimestamp': _timestamps_to_ns(['2023-10-01T00:00:00Z', None])})
+    assert best_per_object(df, 'last_best')['classId'].tolist() == [2222]
+    assert best_per_object(df, 'best')['classId'].tolist() == [2221]
+
+
+def test_empty_and_unknown():
+    df = _classifications().iloc[0:0]
+    assert len(best_per_object(df, 'best')) == 0
+    with pytest.raises(ValueError):
+        best_per_object(_classifications(n=10), 'worst')
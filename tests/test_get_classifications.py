@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+
+
+def _assert_same(expected, got):
+    assert list(got) == list(expected)
+    for classifier_id, df in expected.items():
+        pd.testing.assert_frame_equal(got[classifier_id], df)
+
+
+@pytest.mark.parametrize('definition', ['best', 'last_best'])
+def test_jobs_matches_serial(confmatrix_client, definition):
+    serial = confmatrix_client.get_classifications(definition=definition, classifier_id=None)
+    assert len(serial) == len(confmatrix_client.classifiers)
+    _assert_same(serial, confmatrix_client.get_classifications(definition=definition, classifier_id=None, jobs=4))
+
+
+def test_jobs_matches_serial_for_some_classifiers(confmatrix_client):
+    ids = list(confmatrix_client.classifiers)[3:8]
+    serial = confmatrix_client.get_classifications(definition='best', classifier_id=ids)
+    assert list(serial) == ids
+    _assert_same(serial, confmatrix_client.get_classifications(definition='best', classifier_id=ids, jobs=3))
+
+
+@pytest.mark.parametrize('definition', ['best', 'last_best'])
+def test_batched_matches_serial(confmatrix_client, definition):
+    serial = confmatrix_client.get_classifications(definition=definition, classifier_id=None)
+    _assert_same(serial, confmatrix_client.get_classifications(definition=definition, classifier_id=None,
+                                                               batched=True))
+
+
+def test_batched_matches_serial_for_some_classifiers(confmatrix_client):
+    ids = list(confmatrix_client.classifiers)[:4]
+    serial = confmatrix_client.get_classifications(definition='best', classifier_id=ids)
+    _assert_same(serial, confmatrix_client.get_classifications(definition='best', classifier_id=ids, batched=True))
@@ -0,0 +1,50 @@
+import numpy
+import pytest
+
+import local_metrics
+
+
+def test_width_bucket_tbins_edges():
+    # The bins documented for elasticc_view_classifications_probmetrics (see metric_querier.py):
+    #  tbin 0 is dt < -30, tbin 1 is [-30,-25), ..., tbin 26 is [95,100), tbin 27 is dt >= 100
+    dt = [ -1e9, -30.0001, -30., -25., -20., 94.9999, 95., 99.9999, 100., 1e9 ]
+    assert local_metrics.width_bucket( dt, local_metrics.default_tbins ).tolist() == [ 0, 0, 1, 2, 3, 25,
+                                                                                        26, 26, 27, 27 ]
+
+
+def test_width_bucket_probbins_edges():
+    # probbin 1 is [0,0.05), ..., 20 is [0.95,1.0), and 21 is >= 1, so a probability of exactly 1 is in 21
+    prob = [ -0.01, 0., 0.05, 0.15, 0.95, 0.999999, 1., 1.5 ]
+    assert local_metrics.width_bucket( prob, local_metrics.default_probbins ).tolist() == [ 0, 1, 2, 4, 20,
+                                                                                            20, 21, 21 ]
+
+
+def test_width_bucket_nan_and_inf():
+    got = local_metrics.width_bucket( [ numpy.nan, numpy.inf, -numpy.inf ], ( 0., 1., 4 ) )
+    # NaN sorts above everything in postgres, so goes in the top bucket
+    assert got.tolist() == [ 5, 5, 0 ]
+
+
+def test_width_bucket_edges_match_tuple():
+    values = numpy.array( [ -1., 0., 0.1, 0.25, 0.5, 0.75, 0.99, 1., 2., numpy.nan ] )
+    bytuple = local_metrics.width_bucket( values, ( 0., 1., 4 ) )
+    byedges = local_metrics.width_bucket( values, [ 0., 0.25, 0.5, 0.75, 1. ] )
+    assert bytuple.tolist() == byedges.tolist() == [ 0, 1, 1, 2, 3, 4, 4, 5, 5, 5 ]
+    assert bytuple.dtype == byedges.dtype == numpy.int32
+    assert local_metrics.nbuckets( ( 0., 1., 4 ) ) == local_metrics.nbuckets( [ 0., 0.25, 0.5, 0.75, 1. ] ) == 6
+
+
+def test_width_bucket_uneven_edges():
+    assert local_metrics.width_bucket( [ -5, 0, 1, 9, 10, 50 ], [ 0, 1, 10 ] ).tolist() == [ 0, 1, 2, 2, 3, 3 ]
+
+
+def test_width_bucket_empty():
+    got = local_metrics.width_bucket( [], ( 0., 1., 20 ) )
+    assert len( got ) == 0
+    assert got.dtype == numpy.int32
+
+
+@pytest.mark.parametrize( 'edges', [ [ 1. ], [ 0., 0. ], [ 0., 2., 1. ] ] )
+def test_width_bucket_bad_edges( edges ):
+    with pytest.raises( ValueError ):
+        local_metrics.width_bucket( [ 0.5 ], edges )
@@ -0,0 +1,92 @@
+import os
+import time
+
+import tom_cache
+
+
+def test_key_ignores_whitespace_and_subdict_order():
+    k = tom_cache.QueryCache.key( 'u', 'SELECT  *\n FROM t WHERE x=%(a)s', { 'a': 1, 'b': 2 } )
+    assert k == tom_cache.QueryCache.key( 'u', 'SELECT * FROM t WHERE x=%(a)s', { 'b': 2, 'a': 1 } )
+    assert k != tom_cache.QueryCache.key( 'v', 'SELECT * FROM t WHERE x=%(a)s', { 'b': 2, 'a': 1 } )
+    assert k != tom_cache.QueryCache.key( 'u', 'SELECT * FROM t WHERE x=%(a)s', { 'a': 2, 'b': 2 } )
+
+
+def test_lru_eviction_by_entries():
+    cache = tom_cache.QueryCache( maxentries=2 )
+    cache.put( 'a', b'1' )
+    cache.put( 'b', b'2' )
+    # Using a makes b the least recently used
+    assert cache.get( 'a' ) == b'1'
+    cache.put( 'c', b'3' )
+    assert cache.get( 'b' ) is None
+    assert ( cache.get( 'a' ), cache.get( 'c' ) ) == ( b'1', b'3' )
+    assert len( cache ) == 2
+    assert ( cache.hits, cache.misses ) == ( 3, 1 )
+
+
+def test_lru_eviction_by_bytes():
+    cache = tom_cache.QueryCache( maxbytes=10 )
+    cache.put( 'a', b'x' * 4 )
+    cache.put( 'b', b'x' * 4 )
+    cache.put( 'c', b'x' * 4 )
+    assert cache.get( 'a' ) is None
+    assert cache.nbytes == 8
+    # Bigger than the whole cache: not kept in memory at all, and nothing else is thrown out for it
+    cache.put( 'd', b'x' * 11 )
+    assert cache.get( 'd' ) is None
+    assert len( cache ) == 2
+    # Replacing an entry doesn't count it twice
+    cache.put( 'b', b'y' * 2 )
+    assert ( cache.nbytes, cache.get( 'b' ) ) == ( 6, b'yy' )
+
+
+def test_ttl( monkeypatch ):
+    now = [ 1000. ]
+    monkeypatch.setattr( tom_cache.time, 'time', lambda: now[0] )
+    cache = tom_cache.QueryCache( ttl=60 )
+    cache.put( 'a', b'1' )
+    now[0] += 59
+    assert cache.get( 'a' ) == b'1'
+    now[0] += 2
+    assert cache.get( 'a' ) is None
+    # A stale entry is dropped, not just hidden
+    assert ( len( cache ), cache.nbytes ) == ( 0, 0 )
+
+
+def test_disk_tier( tmp_path ):
+    cache = tom_cache.QueryCache( cachedir=tmp_path )
+    key = cache.key( 'u', 'SELECT 1' )
+    cache.put( key, b'response' )
+    assert ( tmp_path / key[:2] / key ).read_bytes() == b'response'
+    # A fresh cache (e.g. another process) finds it on disk, and keeps it in memory from then on
+    other = tom_cache.QueryCache( cachedir=tmp_path )
+    assert len( other ) == 0
+    assert other.get( key ) == b'response'
+    assert len( other ) == 1
+    # Clearing memory only leaves the disk tier
+    other.clear( disk=False )
+    assert other.get( key ) == b'response'
+    other.clear()
+    assert tom_cache.QueryCache( cachedir=tmp_path ).get( key ) is None
+
+
+def test_disk_tier_ttl( tmp_path ):
+    cache = tom_cache.QueryCache( cachedir=tmp_path, ttl=60 )
+    cache.put( 'abc', b'response' )
+    path = tmp_path / 'ab' / 'abc'
+    old = time.time() - 120
+    os.utime( path, ( old, old ) )
+    assert tom_cache.QueryCache( cachedir=tmp_path, ttl=60 ).get( 'abc' ) is None
+    assert tom_cache.QueryCache( cachedir=tmp_path ).get( 'abc' ) == b'response'
+
+
+def test_disk_tier_trim( tmp_path ):
+    cache = tom_cache.QueryCache( cachedir=tmp_path, maxdiskbytes=25 )
+    for i, key in enumerate( [ 'aa1', 'aa2', 'bb3' ] ):
+        cache.put( key, b'x' * 10 )
+        # Make the write order unambiguous to the mtime-based trim
+        t = time.time() - 100 + i
+        os.utime( tmp_path / key[:2] / key, ( t, t ) )
+    cache.put( 'cc4', b'x' * 10 )
+    left = sorted( p.name for p in tmp_path.glob( '*/*' ) )
+    assert left == [ 'bb3', 'cc4' ]
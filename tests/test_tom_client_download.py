@@ -0,0 +1,170 @@
+import io
+import json
+import os
+
+import pandas
+import pytest
+
+import fake_tom
+import tom_stats
+from tom_client import TomClient
+
+page = 'elasticc2/brokerclassfortruetype/pickle/classifications/13/2221'
+
+
+@pytest.fixture
+def client( fake_server ):
+    return TomClient( url=fake_server.url, username='test', password=fake_tom.password, querycache=False,
+                      stats=tom_stats.CallStats() )
+
+
+@pytest.fixture
+def handler( fake_server ):
+    """The fake server's request handler class, to monkeypatch."""
+    return fake_server.httpd.RequestHandlerClass
+
+
+def _raw( client ):
+    """The gzipped body and ETag the fake TOM sends for page."""
+    res = client._rqs.get( f'{client._url}/{page}', headers={ 'Accept-Encoding': 'gzip' }, stream=True )
+    try:
+        return res.raw.read( decode_content=False ), res.headers['ETag']
+    finally:
+        res.close()
+
+
+def _partial( path, raw, nbytes, etag ):
+    """Leave what an earlier download() that died after nbytes bytes would have."""
+    with open( f'{path}.part', 'wb' ) as ofp:
+        ofp.write( raw[:nbytes] )
+    with open( f'{path}.part.json', 'w' ) as ofp:
+        json.dump( { 'etag': etag, 'encoding': 'gzip', 'ranges': True }, ofp )
+
+
+def _statuses( client ):
+    return client.stats.records()['status'].tolist()
+
+
+def test_download( client, tmp_path ):
+    path = tmp_path / 'x.pkl'
+    assert client.download( page, path ) == path
+    assert path.read_bytes() == client.get( page ).content
+    assert os.listdir( tmp_path ) == [ 'x.pkl' ]
+
+
+def test_download_frame( client, tmp_path, monkeypatch ):
+    monkeypatch.chdir( tmp_path )
+    expected = pandas.read_pickle( io.BytesIO( client.get( page ).content ) )
+    pandas.testing.assert_frame_equal( client.download_frame( page ), expected )
+    # The temporary file is gone
+    assert os.listdir( tmp_path ) == []
+
+
+def test_resume( client, tmp_path ):
+    path = tmp_path / 'x.pkl'
+    raw, etag = _raw( client )
+    expected = client.get( page ).content
+    client.stats.reset()
+    _partial( path, raw, len( raw ) // 3, etag )
+    client.download( page, path )
+    assert path.read_bytes() == expected
+    assert _statuses( client ) == [ 206 ]
+    assert client.stats.records()['nbytes'].tolist() == [ len( raw ) - len( raw ) // 3 ]
+    assert os.listdir( tmp_path ) == [ 'x.pkl' ]
+
+
+def test_resume_changed_response( client, tmp_path ):
+    # With an ETag that's no longer current, If-Range makes the server send everything again
+    path = tmp_path / 'x.pkl'
+    raw, etag = _raw( client )
+    client.stats.reset()
+    _partial( path, b'garbage' * 100, 700, '"old"' )
+    client.download( page, path )
+    assert path.read_bytes() == client.get( page ).content
+    assert _statuses( client )[0] == 200
+
+
+def test_resume_mismatched_content_range( client, handler, tmp_path, monkeypatch ):
+    # A server (or proxy) that answers a Range request with the wrong bytes
+    path = tmp_path / 'x.pkl'
+    raw, etag = _raw( client )
+    send_ranged = handler._send_ranged
+
+    def shifted( self, body, contenttype ):
+        if 'Range' in self.headers:
+            del self.headers['Range']
+            self.headers['Range'] = 'bytes=10-'
+        return send_ranged( self, body, contenttype )
+
+    monkeypatch.setattr( handler, '_send_ranged', shifted )
+    client.stats.reset()
+    _partial( path, raw, 1000, etag )
+    client.download( page, path, retry_backoff=0.01 )
+    # The 206 starting at byte 10 isn't appended; the part is thrown away and the whole thing fetched
+    assert _statuses( client ) == [ 206, 200 ]
+    monkeypatch.undo()
+    assert path.read_bytes() == client.get( page ).content
+
+
+def test_resume_past_end( client, tmp_path ):
+    # More in the part file than the server has: a 416, then start over
+    path = tmp_path / 'x.pkl'
+    raw, etag = _raw( client )
+    client.stats.reset()
+    _partial( path, raw + b'xx', len( raw ) + 2, etag )
+    client.download( page, path, retry_backoff=0.01 )
+    assert _statuses( client ) == [ 416, 200 ]
+    assert path.read_bytes() == client.get( page ).content
+
+
+def test_cut_off_transfer_resumes( client, handler, tmp_path, monkeypatch ):
+    path = tmp_path / 'x.pkl'
+    send = handler._send
+    cut = []
+
+    def cut_once( self, status, body, contenttype='application/json', **kwargs ):
+        if ( status == 200 ) and ( contenttype == 'application/octet-stream' ) and ( len( cut ) == 0 ):
+            # Promise the whole body, send half of it, and hang up
+            cut.append( len( body ) // 2 )
+            self.send_response( status )
+            self.send_header( 'Content-Type', contenttype )
+            self.send_header( 'Content-Length', str( len( body ) ) )
+            for k, v in kwargs.get( 'headers', {} ).items():
+                self.send_header( k, v )
+            self.end_headers()
+            self.wfile.write( body[ :cut[0] ] )
+            self.close_connection = True
+            return
+        return send( self, status, body, contenttype, **kwargs )
+
+    monkeypatch.setattr( handler, '_send', cut_once )
+    client.download( page, path, retry_backoff=0.01 )
+    assert _statuses( client ) == [ 200, 206 ]
+    # The retry only asks for what didn't arrive
+    assert client.stats.records()['nbytes'].iloc[1] == len( _raw( client )[0] ) - cut[0]
+    monkeypatch.undo()
+    assert path.read_bytes() == client.get( page ).content
+
+
+def test_cut_off_transfer_gives_up( client, handler, tmp_path, monkeypatch ):
+    # Every response claims more bytes than it sends
+    def always_cut( self, status, body, contenttype='application/json', **kwargs ):
+        self.send_response( status )
+        self.send_header( 'Content-Length', str( len( body ) + 10 ) )
+        for k, v in kwargs.get( 'headers', {} ).items():
+            self.send_header( k, v )
+        self.end_headers()
+        self.wfile.write( body )
+        self.close_connection = True
+
+    monkeypatch.setattr( handler, '_send', always_cut )
+    with pytest.raises( Exception ):
+        client.download( page, tmp_path / 'x.pkl', retries=1, retry_backoff=0.01 )
+    assert len( _statuses( client ) ) == 2
+    assert not ( tmp_path / 'x.pkl' ).exists()
+
+
+def test_error_status( client, tmp_path ):
+    with pytest.raises( RuntimeError, match='404' ):
+        client.download( 'elasticc2/brokerclassfortruetype/pickle/nope/13/2221', tmp_path / 'x.pkl' )
+    assert os.listdir( tmp_path ) == []
@@ -0,0 +1,78 @@
+import re
+
+import numpy
+import pandas
+import pytest
+
+import tom_sql
+
+
+def test_keyset_page_query_first_page():
+    query, subdict = tom_sql.keyset_page_query( 'SELECT * FROM t', 'id', 10 )
+    assert query == 'SELECT * FROM ( SELECT * FROM t ) _keyset_q ORDER BY _keyset_q."id" LIMIT 10'
+    assert subdict == {}
+
+
+def test_keyset_page_query_after_compound_key():
+    query, subdict = tom_sql.keyset_page_query( 'SELECT * FROM t', [ 'a', 'b' ], 5, after=[ 3, 7 ] )
+    assert query == ( 'SELECT * FROM ( SELECT * FROM t ) _keyset_q '
+                      'WHERE ( _keyset_q."a", _keyset_q."b" ) > ( %(_keyset_0)s, %(_keyset_1)s ) '
+                      'ORDER BY _keyset_q."a", _keyset_q."b" LIMIT 5' )
+    assert subdict == { '_keyset_0': 3, '_keyset_1': 7 }
+
+
+class _PagedTable:
+    """A send_frame for iter_frames that runs keyset pages against a DataFrame, and remembers what it was sent."""
+
+    def __init__( self, df, key ):
+        self.df = df
+        self.key = key
+        self.calls = []
+
+    def __call__( self, query, subdict, schema=None ):
+        self.calls.append( ( query, subdict ) )
+        df = self.df.sort_values( self.key )
+        if '_keyset_0' in subdict:
+            after = tuple( subdict[ f'_keyset_{i}' ] for i in range( len( self.key ) ) )
+            df = df[ [ tuple( row ) > after for row in df[ self.key ].itertuples( index=False ) ] ]
+        return df.iloc[ :int( re.search( r'LIMIT (\d+)', query ).group( 1 ) ) ].reset_index( drop=True )
+
+
+@pytest.mark.parametrize( 'nrows,chunksize', [ ( 10, 3 ), ( 9, 3 ), ( 2, 5 ), ( 0, 4 ) ] )
+def test_iter_frames_pages( nrows, chunksize ):
+    df = pandas.DataFrame( { 'id': numpy.arange( nrows )[::-1], 'x': numpy.arange( nrows ) * 2. } )
+    send = _PagedTable( df, [ 'id' ] )
+    chunks = list( tom_sql.iter_frames( send, 'SELECT * FROM t', 'id', subdict={ 'a': 1 }, chunksize=chunksize ) )
+    assert all( len( c ) <= chunksize for c in chunks )
+    got = pandas.concat( chunks, ignore_index=True ) if len( chunks ) > 0 else df.iloc[0:0]
+    pandas.testing.assert_frame_equal( got, df.sort_values( 'id' ).reset_index( drop=True ) )
+    # A short page ends it; a full last page needs one more (empty) query to find out it was the last
+    assert len( send.calls ) == nrows // chunksize + 1
+    assert all( subdict['a'] == 1 for query, subdict in send.calls )
+
+
+def test_iter_frames_compound_key_and_records():
+    df = pandas.DataFrame( { 'a': [ 1, 1, 1, 2, 2, 3 ], 'b': [ 1, 2, 3, 1, 2, 1 ], 'x': range( 6 ) } )
+    send = _PagedTable( df, [ 'a', 'b' ] )
+    chunks = list( tom_sql.iter_frames( send, 'SELECT * FROM t', [ 'a', 'b' ], chunksize=4, asrecords=True ) )
+    assert [ len( c ) for c in chunks ] == [ 4, 2 ]
+    assert isinstance( chunks[0], numpy.recarray )
+    assert numpy.concatenate( chunks )['x'].tolist() == list( range( 6 ) )
+
+
+def test_iter_frames_errors():
+    with pytest.raises( ValueError ):
+        next( tom_sql.iter_frames( None, 'SELECT * FROM t', 'id', chunksize=0 ) )
+    with pytest.raises( RuntimeError ):
+        next( tom_sql.iter_frames( lambda q, sd, schema=None: None, 'SELECT * FROM t', 'id' ) )
+    with pytest.raises( KeyError ):
+        next( tom_sql.iter_frames( lambda q, sd, schema=None: pandas.DataFrame( { 'x': [ 1 ] } ),
+                                   'SELECT * FROM t', 'id' ) )
+
+
+def test_query_chunked_against_fake_tom( confmatrix_client ):
+    full = confmatrix_client.query_frame( 'SELECT * FROM bench_rows', cache=False )
+    chunks = list( confmatrix_client.query_chunked( 'SELECT * FROM bench_rows', 'id', chunksize=3000 ) )
+    assert len( chunks ) == -( -len( full ) // 3000 )
+    pandas.testing.assert_frame_equal( pandas.concat( chunks, ignore_index=True ),
+                                       full.sort_values( 'id' ).reset_index( drop=True ) )
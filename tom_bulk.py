@@ -0,0 +1,181 @@
+"""Fetch many brokerclassfortruetype frames from the TOM concurrently.
+
+The REST endpoints
+
+  elasticc2/brokerclassfortruetype/{format}/{what}/{cfer}/{truetype}
+
+each take seconds to respond, and a full grid of classifiers x true
+types x { sources, classifications, ... } is thousands of requests.
+Sent one at a time with TomClient.request, the grid takes the sum of
+their latencies; BulkFetcher keeps up to inflight of them going at once,
+so it's limited by what the server can handle instead.
+
+Usage, with a callback:
+
+  tc = TomClient( username='rknop', passwordfile='...' )
+  fetcher = BulkFetcher( tc, inflight=8 )
+  keys = [ ( 'classifications', cfer, truetype ) for cfer in cfers for truetype in truetypes ]
+  fetcher.fetch_all( keys, callback=lambda key, df: df.to_parquet( '_'.join( map( str, key ) ) + '.parquet' ) )
+
+or, without a callback, fetch_all returns { key: DataFrame }.  From
+async code, iterate over the frames as they arrive:
+
+  async for key, df in fetcher.fetch( keys ):
+      ...
+
+Keys are ( what, cfer, truetype ) tuples.  Frames come back in whatever
+order the server finishes them, not the order of keys.
+
+This uses asyncio for the scheduling, but the HTTP requests themselves
+go through the TomClient (on a pool of inflight threads), so they use
+its logged-in session (no second login) and are recorded in its
+tom_stats.CallStats like any other TomClient request.  Each frame is
+streamed to a file in a temporary directory with TomClient.download
+and loaded from there, so the response body is never held in memory
+next to the frame; a transfer cut off part way through is retried (up
+to retries times, with backoff), picking up where it stopped if the
+server allows.  They're GETs, so the session already retries any that
+can't connect, get a read error, or come back 5xx (see
+tom_session.py), and BulkFetcher doesn't retry those again on top of
+that.  (The session's
+connection pool should be at least inflight connections, or urllib3
+will open and throw away extra ones; tom_session.TomSession keeps 16 by
+default, so for more than that, give the TomClient a session made with
+a bigger pool_maxsize.)
+
+"""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas
+
+
+class BulkFetcher:
+    """Fetch ( what, cfer, truetype ) brokerclassfortruetype frames concurrently through a TomClient.
+
+    tomclient : a logged-in TomClient
+
+    inflight : maximum number of requests to have going at once
+
+    retries : how many times to retry a transfer that's cut off part
+      way through, waiting retry_backoff, 2*retry_backoff, ... seconds
+      between tries (see module docs for what the session retries)
+
+    fmt : 'pickle' (smaller and faster) or 'dict'
+
+    errors : 'raise' to stop everything and raise the exception when a
+      request fails for good; 'return' to hand back the exception in
+      place of the DataFrame and keep going
+
+    """
+
+    def __init__( self, tomclient, inflight=8, retries=3, retry_backoff=2., fmt='pickle', errors='raise' ):
+        if fmt not in ( 'pickle', 'dict' ):
+            raise ValueError( f"fmt must be pickle or dict, not {fmt}" )
+        if errors not in ( 'raise', 'return' ):
+            raise ValueError( f"errors must be raise or return, not {errors}" )
+        self.tomclient = tomclient
+        self.inflight = max( int( inflight ), 1 )
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.fmt = fmt
+        self.errors = errors
+        self.logger = logging.getLogger( "tom_bulk" )
+
+    def page( self, key ):
+        what, cfer, truetype = key
+        return f"elasticc2/brokerclassfortruetype/{self.fmt}/{what}/{cfer}/{truetype}"
+
+    def _get_frame( self, key, tmpdir ):
+        """Blocking: get key's frame, by way of a file in tmpdir (runs in a worker thread)."""
+        path = os.path.join( tmpdir, "_".join( str( k ) for k in key ) )
+        kwargs = dict( retries=self.retries, retry_backoff=self.retry_backoff )
+        if self.fmt == 'pickle':
+            return self.tomclient.download_frame( self.page( key ), path=path, **kwargs )
+        self.tomclient.download( self.page( key ), path, **kwargs )
+        try:
+            with open( path ) as ifp:
+                return pandas.DataFrame.from_dict( json.load( ifp ), orient='tight' )
+        finally:
+            os.remove( path )
+
+    async def fetch( self, keys ):
+        """Async iterator of ( key, DataFrame ) for every key in keys, as each arrives.
+
+        With errors='return', a key that failed for good comes back as (
+        key, exception ).
+
+        """
+        keys = list( keys )
+        loop = asyncio.get_running_loop()
+        todo = asyncio.Queue()
+        for key in keys:
+            todo.put_nowait( key )
+        done = asyncio.Queue()
+
+        async def worker():
+            while True:
+                try:
+                    key = todo.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    df = await loop.run_in_executor( executor, self._get_frame, key, tmpdir )
+                    await done.put( ( key, df, None ) )
+                except Exception as ex:
+                    await done.put( ( key, None, ex ) )
+
+        tmpdir = tempfile.mkdtemp( prefix='tom_bulk_' )
+        executor = ThreadPoolExecutor( max_workers=self.inflight, thread_name_prefix='tom_bulk' )
+        workers = [ asyncio.ensure_future( worker() ) for _ in range( min( self.inflight, len( keys ) ) ) ]
+        try:
+            for _ in range( len( keys ) ):
+                key, df, ex = await done.get()
+                if ex is not None:
+                    if self.errors == 'raise':
+                        raise ex
+                    df = ex
+                yield key, df
+        finally:
+            for w in workers:
+                w.cancel()
+            await asyncio.gather( *workers, return_exceptions=True )
+            # Requests already running in threads can't be interrupted; don't wait for them
+            executor.shutdown( wait=False, cancel_futures=True )
+            # Threads still running may yet write here (and then fail, but nobody's waiting for them)
+            shutil.rmtree( tmpdir, ignore_errors=True )
+
+    async def run( self, keys, callback ):
+        """Call callback( key, DataFrame ) for every key in keys as each frame arrives.
+
+        The callback runs in the event loop thread, so a slow callback
+        holds up handing out the next frame (but not the requests in
+        flight).
+
+        """
+        async for key, df in self.fetch( keys ):
+            callback( key, df )
+
+    def fetch_all( self, keys, callback=None ):
+        """Blocking version of run(); without a callback, return { key: DataFrame }.
+
+        Can't be called from inside a running event loop (e.g. a
+        jupyter cell); there, use "await fetcher.run( ... )" or "async
+        for ... in fetcher.fetch( ... )".
+
+        """
+        keys = list( keys )
+        results = {}
+        if callback is None:
+            callback = results.__setitem__
+        t0 = time.perf_counter()
+        asyncio.run( self.run( keys, callback ) )
+        self.logger.info( f"Fetched {len( keys )} frames in {time.perf_counter() - t0:.1f} s" )
+        return results
@@ -0,0 +1,192 @@
+"""A cache of /db/runsqlquery/ results, shared by the clients in this archive.
+
+The clients (TomClient.query_frame, ELAsTiCCMetricsQuerier.run_query*,
+and ConfMatrixClient.query*) look up every query they send in a
+QueryCache before sending it to the TOM.  An entry is keyed on a hash
+of the TOM url, the query with whitespace collapsed, and subdict, so
+the same query sent from two different clients (or two different
+ConfMatrixClients, or after re-running a notebook cell) is only sent to
+the database once.  What's cached is the body of the response (the raw
+JSON bytes), so every hit is decoded afresh, and callers get their own
+copies of the data to mess with.
+
+Only successful responses (HTTP 200, "status": "ok") are cached.
+
+There are two tiers:
+
+  * In memory: a LRU cache holding at most maxbytes bytes of responses
+    (and at most maxentries responses, if that's not None).  A response
+    bigger than maxbytes isn't cached in memory at all.
+
+  * On disk (if you give a cachedir): one file per response, named for
+    its key.  Entries found on disk are promoted to memory.  If
+    maxdiskbytes is not None, the files least recently written are
+    deleted to keep the total under that.
+
+Entries older than ttl seconds (if ttl is not None) are treated as
+missing in both tiers.
+
+By default, all clients use tom_cache.shared, an in-memory-only cache
+(256MiB, one hour ttl).  Give a client querycache=<a QueryCache> to use
+a different cache, or querycache=False to not cache at all; pass
+cache=False to a single query call to bypass the cache for that call
+(neither look it up nor store the result).  Keyset-paged queries
+(run_query_chunked, query_chunked) and get_classifications always
+bypass it: the pages of a big result would all pile up in the cache,
+and classifications change while a long-lived process runs.
+
+"""
+
+import os
+import time
+import json
+import pathlib
+import hashlib
+import logging
+import threading
+import collections
+
+
+class QueryCache:
+    def __init__( self, maxbytes=256*1024*1024, maxentries=None, ttl=None, cachedir=None, maxdiskbytes=None ):
+        """Make a cache; see module docs.
+
+        maxbytes : maximum total size of responses kept in memory
+        maxentries : maximum number of responses kept in memory (None for no limit)
+        ttl : seconds after which an entry is stale (None for never)
+        cachedir : directory for the on-disk tier (None for no disk tier)
+        maxdiskbytes : maximum total size of the on-disk tier (None for no limit)
+
+        """
+        self.maxbytes = maxbytes
+        self.maxentries = maxentries
+        self.ttl = ttl
+        self.cachedir = None if cachedir is None else pathlib.Path( cachedir )
+        self.maxdiskbytes = maxdiskbytes
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger( "tom_cache" )
+        # key -> ( time stored, content )
+        self._mem = collections.OrderedDict()
+        self._membytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key( url, query, subdict=None ):
+        """The cache key for query (with substitutions subdict) sent to the TOM at url."""
+        query = ' '.join( query.split() )
+        subdict = json.dumps( {} if subdict is None else subdict, sort_keys=True, default=str )
+        return hashlib.sha256( '\0'.join( [ url, query, subdict ] ).encode( 'utf-8' ) ).hexdigest()
+
+    def _stale( self, t ):
+        return ( self.ttl is not None ) and ( time.time() - t > self.ttl )
+
+    def _diskpath( self, key ):
+        return self.cachedir / key[:2] / key
+
+    def get( self, key ):
+        """Return the cached response body (bytes) for key, or None."""
+        with self._lock:
+            if key in self._mem:
+                t, content = self._mem[ key ]
+                if not self._stale( t ):
+                    self._mem.move_to_end( key )
+                    self.hits += 1
+                    return content
+                self._drop( key )
+        if self.cachedir is not None:
+            path = self._diskpath( key )
+            try:
+                t = path.stat().st_mtime
+                if not self._stale( t ):
+                    content = path.read_bytes()
+                    with self._lock:
+                        self.hits += 1
+                        self._store( key, t, content )
+                    return content
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put( self, key, content ):
+        """Store the response body content (bytes) for key."""
+        now = time.time()
+        with self._lock:
+            self._store( key, now, content )
+        if self.cachedir is not None:
+            path = self._diskpath( key )
+            try:
+                path.parent.mkdir( parents=True, exist_ok=True )
+                tmppath = path.parent / f'.{key}.{os.getpid()}.{threading.get_ident()}.tmp'
+                tmppath.write_bytes( content )
+                os.replace( tmppath, path )
+                if self.maxdiskbytes is not None:
+                    self._trim_disk()
+            except OSError as ex:
+                self.logger.warning( f"Failed to write query cache file {path}: {ex}" )
+
+    def _store( self, key, t, content ):
+        # Must hold self._lock
+        if key in self._mem:
+            self._drop( key )
+        if len( content ) > self.maxbytes:
+            return
+        self._mem[ key ] = ( t, content )
+        self._membytes += len( content )
+        while ( ( self._membytes > self.maxbytes ) or
+                ( ( self.maxentries is not None ) and ( len( self._mem ) > self.maxentries ) ) ):
+            self._drop( next( iter( self._mem ) ) )
+
+    def _drop( self, key ):
+        # Must hold self._lock
+        t, content = self._mem.pop( key )
+        self._membytes -= len( content )
+
+    def _trim_disk( self ):
+        files = []
+        for path in self.cachedir.glob( '*/*' ):
+            if path.name.startswith( '.' ):
+                continue
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append( ( st.st_mtime, st.st_size, path ) )
+        total = sum( f[1] for f in files )
+        for mtime, size, path in sorted( files ):
+            if total <= self.maxdiskbytes:
+                break
+            path.unlink( missing_ok=True )
+            total -= size
+
+    def clear( self, disk=True ):
+        """Throw away everything in memory, and (if disk is True) on disk."""
+        with self._lock:
+            self._mem.clear()
+            self._membytes = 0
+        if disk and ( self.cachedir is not None ):
+            for path in self.cachedir.glob( '*/*' ):
+                path.unlink( missing_ok=True )
+
+    def __len__( self ):
+        return len( self._mem )
+
+    @property
+    def nbytes( self ):
+        """Total size of the responses held in memory."""
+        return self._membytes
+
+
+# The cache clients use unless told otherwise
+shared = QueryCache( ttl=3600 )
+
+
+def resolve( querycache ):
+    """What a client should use given its querycache= argument: None means shared, False means no cache."""
+    if querycache is None:
+        return shared
+    if querycache is False:
+        return None
+    return querycache
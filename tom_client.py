@@ -1,4 +1,25 @@
+import os
+import re
+import json
+import time
+import zlib
+import tempfile
+
 import requests
+import urllib3
+import pandas
+
+import tom_sql
+import tom_stats
+import tom_cache
+import tom_session
+
+class _Interrupted( Exception ):
+    pass
+
+
+_contentrange = re.compile( r'bytes\s+(\d+)-(\d+)/(\d+|\*)' )
+
 
 class TomClient:
     """A thin class that supports sending requests via "requests" to the DESC tom.
@@ -10,6 +31,11 @@ class TomClient:
       tc = TomClient( username='rknop', passwordfile='/home/raknop/secrets/tom_rknop_passwd' )
 
     (You can give it a url with url=; it defaults to https://desc-tom.lbl.gov.)
+    Instead of a username and password, you can give it an already
+    logged-in tom_session.TomSession with session=.  Otherwise, it uses
+    the tom_session.shared session for the username, so several
+    TomClients (and the other clients here) for the same account only
+    log in once, and share a connection pool; see tom_session.py.
 
     Thereafter, just do something like
 
@@ -22,15 +48,31 @@ class TomClient:
     only reason to use this client rather than the python requests
     module directly is that this class takes care of the stupid fiddly
     bits of getting some headers that django demands set up right in the
-    request object when you log in.
+    request object when you log in (and logging in again if the login
+    expires).
+
+    Every request (and query_frame query) is timed and recorded in
+    tom_stats.stats, or in the tom_stats.CallStats you pass as stats=.
+    query_frame results are cached in tom_cache.shared, or the
+    tom_cache.QueryCache you pass as querycache= (False for no caching).
+
+    For big responses (e.g. the brokerclassfortruetype pickle
+    endpoints), use download() or download_frame() rather than get():
+    they stream the body to a file instead of holding it in memory, and
+    pick up where they left off if the connection drops.
 
     """
 
-    def __init__( self, url="https://desc-tom.lbl.gov", username=None, password=None, passwordfile=None, connect=True ):
-        self._url = url
+    def __init__( self, url="https://desc-tom.lbl.gov", username=None, password=None, passwordfile=None, connect=True,
+                  stats=None, querycache=None, session=None ):
+        self._url = url if session is None else session.url
+        self.querycache = tom_cache.resolve( querycache )
+        self.stats = tom_stats.stats if stats is None else stats
         self._username = username
         self._password = password
-        self._rqs = None
+        self._rqs = session
+        if session is not None:
+            return
         if self._password is None:
             if passwordfile is None:
                 raise RuntimeError( "Must give either password or passwordfile. " )
@@ -41,27 +83,8 @@ class TomClient:
             self.connect()
 
     def connect( self ):
-        self._rqs = requests.session()
-        res = self._rqs.get( f'{self._url}/accounts/login/' )
-        if res.status_code != 200:
-            raise RuntimeError( f"Got status {res.status_code} from first attempt to connect to {self._url}" )
-        res = self._rqs.post( f'{self._url}/accounts/login/',
-                              data={ 'username': self._username,
-                                     'password': self._password,
-                                     'csrfmiddlewaretoken': self._rqs.cookies['csrftoken'] } )
-        if res.status_code != 200:
-            raise RuntimeError( f"Failed to log in; http status: {res.status_code}" )
-        if 'Please enter a correct' in res.text:
-            # This is a very cheesy attempt at checking if the login failed.
-            # I haven't found clean documentation on how to log into a django site
-            # from an app like this using standard authentication stuff.  So, for
-            # now, I'm counting on the HTML that happened to come back when
-            # I ran it with a failed login one time.  One of these days I'll actually
-            # figure out how Django auth works and make a version of /accounts/login/
-            # designed for use in API scripts like this one, rather than desgined
-            # for interactive users.
-            raise RuntimeError( "Failed to log in.  I think.  Put in a debug break and look at res.text" )
-        self._rqs.headers.update( { 'X-CSRFToken': self._rqs.cookies['csrftoken'] } )
+        """Log in, or pick up the already logged-in tom_session.shared session for this url and username."""
+        self._rqs = tom_session.shared( self._url, self._username, self._password )
 
     def request( self, method="GET", page=None, **kwargs ):
         """Send a request to the TOM
@@ -77,8 +100,208 @@ class TomClient:
           requests.request
 
         """
-        return self._rqs.request( method=method, url=f"{self._url}/{page}", **kwargs )
-        
+        with self.stats.record( 'TomClient', 'http', page ) as rec:
+            res = self._rqs.request( method=method, url=f"{self._url}/{page}", **kwargs )
+            rec.response( res )
+            return res
+
+    def download( self, page, path, method="GET", chunksize=1048576, retries=3, retry_backoff=2., **kwargs ):
+        """Stream the response to a request to the file path, resuming after dropped connections.
+
+        page, method, **kwargs : as for request()
+
+        path : file to write the (decompressed) response body to
+
+        chunksize : bytes to read from the network and write at a time
+
+        retries : how many times to pick up again (with backoff
+          retry_backoff, 2*retry_backoff, ...) after the body is cut off
+          part way through.  Failing to connect, and 5xx statuses, are
+          retried by the session (see tom_session.py), not here; if the
+          session gives up, so does this.
+
+        The body is written to path.part as it comes in, and only moved
+        to path once it's all there.  The transfer asks for gzip, and
+        the body is stored as sent (compressed) until it's complete; if
+        the server says it accepts byte ranges, a retry (or a later call
+        with the same path, if an earlier one died) asks for just the
+        bytes after what's already in path.part (with If-Range, so that
+        if the response has changed in the mean time, the server sends
+        it all again; and if a 206 response's Content-Range doesn't start
+        where path.part ends, path.part is thrown away and the whole
+        thing fetched again).  Each attempt is recorded in self.stats as an
+        http call, with nbytes the number of bytes that attempt got.
+
+        Returns path.
+
+        """
+        part = f"{path}.part"
+        partinfo = f"{path}.part.json"
+        url = f"{self._url}/{page}"
+        extraheaders = kwargs.pop( 'headers', {} )
+        attempt = 0
+        while True:
+            info = None
+            offset = 0
+            if os.path.exists( part ) and os.path.exists( partinfo ):
+                with open( partinfo ) as ifp:
+                    info = json.load( ifp )
+                offset = os.path.getsize( part )
+            headers = { **extraheaders, 'Accept-Encoding': 'gzip, deflate' }
+            if ( offset > 0 ) and info['ranges']:
+                headers['Range'] = f"bytes={offset}-"
+                if info['etag'] is not None:
+                    headers['If-Range'] = info['etag']
+            try:
+                with self.stats.record( 'TomClient', 'http', page ) as rec:
+                    res = self._rqs.request( method=method, url=url, headers=headers, stream=True, **kwargs )
+                    rec.response( res )
+                    try:
+                        rec.fields['nbytes'] = self._stream_to_part( res, part, partinfo, chunksize, offset )
+                    finally:
+                        res.close()
+                break
+            # Only things that go wrong while reading the body; errors from sending the request come
+            #  from the session, which has already retried them
+            except ( requests.exceptions.ChunkedEncodingError, urllib3.exceptions.HTTPError, _Interrupted ) as ex:
+                if attempt >= retries:
+                    raise
+                attempt += 1
+                delay = retry_backoff * 2 ** ( attempt - 1 )
+                self.stats.logger.warning( f"download of {page} failed ({ex}); retry {attempt} in {delay} s" )
+                time.sleep( delay )
+
+        with open( partinfo ) as ifp:
+            info = json.load( ifp )
+        if info['encoding'] in ( 'gzip', 'deflate' ):
+            tmp = f"{path}.tmp"
+            # wbits 32+15 accepts either a gzip or a zlib header
+            decomp = zlib.decompressobj( 32 + zlib.MAX_WBITS )
+            with open( part, 'rb' ) as ifp, open( tmp, 'wb' ) as ofp:
+                while True:
+                    chunk = ifp.read( chunksize )
+                    if len( chunk ) == 0:
+                        break
+                    ofp.write( decomp.decompress( chunk ) )
+                ofp.write( decomp.flush() )
+            os.replace( tmp, path )
+            os.remove( part )
+        else:
+            os.replace( part, path )
+        os.remove( partinfo )
+        return path
+
+    @staticmethod
+    def _stream_to_part( res, part, partinfo, chunksize, offset ):
+        """Append (206) or write (200) the body of stream=True response res to part; return bytes written.
+
+        offset is the size of part when the request was sent (what a 206 must start at).
+
+        """
+        if res.status_code == 206:
+            match = _contentrange.fullmatch( res.headers.get( 'Content-Range', '' ).strip() )
+            if ( match is None ) or ( int( match.group( 1 ) ) != offset ):
+                # Not the bytes we asked for (a server or proxy got it wrong); appending would corrupt
+                #  the file, so throw away what we have and get the whole thing
+                os.remove( part )
+                os.remove( partinfo )
+                raise _Interrupted( f"Got Content-Range {res.headers.get( 'Content-Range' )} "
+                                        f"for a request starting at byte {offset}" )
+            mode = 'ab'
+        elif res.status_code == 200:
+            mode = 'wb'
+            with open( partinfo, 'w' ) as ofp:
+                json.dump( { 'etag': res.headers.get( 'ETag' ),
+                             'encoding': res.headers.get( 'Content-Encoding', 'identity' ).lower(),
+                             'ranges': res.headers.get( 'Accept-Ranges', 'none' ).lower() == 'bytes' }, ofp )
+        elif res.status_code == 416:
+            # What's in part doesn't fit what the server has now; start over
+            os.remove( part )
+            raise _Interrupted( "Got status 416 (range not satisfiable)" )
+        else:
+            raise RuntimeError( f"Got status {res.status_code} from {res.url}" )
+        expected = res.headers.get( 'Content-Length' )
+        nbytes = 0
+        with open( part, mode ) as ofp:
+            # decode_content=False: keep the bytes as sent, so that byte ranges line up on a resume
+            for chunk in res.raw.stream( chunksize, decode_content=False ):
+                ofp.write( chunk )
+                nbytes += len( chunk )
+        if ( expected is not None ) and ( nbytes < int( expected ) ):
+            raise requests.exceptions.ChunkedEncodingError( f"Got {nbytes} of {expected} bytes" )
+        return nbytes
+
+    def download_frame( self, page, path=None, keep=False, **kwargs ):
+        """Download a pickled pandas DataFrame (e.g. from a brokerclassfortruetype pickle endpoint) and load it.
+
+        page, **kwargs : as for download()
+
+        path : where to put the downloaded pickle; defaults to a
+          temporary file in the current directory.  Give a path if you
+          want a failed download to be resumable by calling again.
+
+        keep : if False, delete the file once the frame is loaded
+
+        The frame is unpickled straight from the file, so the only big
+        thing in memory is the frame itself (rather than the response
+        body, a BytesIO copy of it, and the frame, as you get with
+        pandas.read_pickle( io.BytesIO( tc.get( page ).content ) ) ).
+
+        """
+        temporary = path is None
+        if temporary:
+            fd, path = tempfile.mkstemp( prefix='tom_download_', suffix='.pkl', dir='.' )
+            os.close( fd )
+            os.remove( path )
+        try:
+            self.download( page, path, **kwargs )
+            return pandas.read_pickle( path )
+        finally:
+            # A partial download to a temporary file can never be resumed, so don't leave it lying around
+            for leftover in ( [ path ] if not keep else [] ) + ( [ f"{path}.part", f"{path}.part.json" ]
+                                                                  if temporary else [] ):
+                if os.path.exists( leftover ):
+                    os.remove( leftover )
+
+    def query_frame( self, query, subdict=None, schema=None, cache=True ):
+        """Send a SQL query to the TOM's db/runsqlquery/ and return the result as a pandas DataFrame.
+
+        query : the SQL query; use %(name)s for substitutions
+
+        subdict : dict of substitutions for query
+
+        schema : optional dict of { column: numpy dtype } for columns
+          of the result; see tom_sql.decode_rows
+
+        cache : if False, don't look in (or store the result in) self.querycache
+
+        """
+        subdict = {} if subdict is None else subdict
+        querycache = self.querycache if cache else None
+        with self.stats.record( 'TomClient', 'sql', query ) as rec:
+            key = None
+            content = None
+            if querycache is not None:
+                key = querycache.key( self._url, query, subdict )
+                content = querycache.get( key )
+            if content is not None:
+                rec.cached( content )
+                key = None
+            else:
+                # Go straight to the session so that this is recorded once, as sql, rather than also as http
+                res = self._rqs.post( f"{self._url}/db/runsqlquery/", json={ 'query': query, 'subdict': subdict } )
+                rec.response( res )
+                if res.status_code != 200:
+                    raise RuntimeError( f"Got status {res.status_code} from db/runsqlquery/" )
+                content = res.content
+            data, df = tom_sql.decode_rows( content, schema=schema, timings=rec.timings )
+            if ( data.get( 'status' ) != 'ok' ) or ( df is None ):
+                raise RuntimeError( f"Query failed: {data.get( 'error', data )}" )
+            if key is not None:
+                querycache.put( key, content )
+            rec.fields['nrows'] = len( df )
+            return df
+
     def post( self, page=None, **kwargs ):
         """Shortand for TomClient.request( "POST", ... )"""
         return self.request( "POST", page, **kwargs )
@@ -0,0 +1,198 @@
+"""One logged-in, pooled, self-healing requests session per TOM account.
+
+TomClient, ELAsTiCCMetricsQuerier, and ConfMatrixClient all talk to the
+TOM through a TomSession (a requests.Session) that:
+
+  * logs in the way Django wants (GET /accounts/login/ for a csrftoken
+    cookie, POST it back as csrfmiddlewaretoken with the username and
+    password, then send it as the X-CSRFToken header on everything)
+
+  * keeps a pool of up to pool_maxsize keep-alive connections to the
+    TOM, so that many threads can have requests going at once without
+    urllib3 opening and throwing away connections
+
+  * retries (with exponential backoff) requests that couldn't connect,
+    and idempotent requests (GET etc., not POST) that fail with a read
+    error / connection reset or a 500, 502, 503 or 504 status.  This is
+    the only retry layer for those; the clients' own retry options
+    (e.g. get_classifications' retries=) only cover what it doesn't: a
+    /db/runsqlquery/ POST that failed after it was sent, or a download
+    cut off part way through the body.  (Retrying a POST here as well
+    would multiply the tries, sending one slow query to the database
+    many times over.)  exhausted( ex ) tells you whether an exception
+    came from this layer giving up.
+
+  * if a request comes back 403, or gets redirected to the login page,
+    because the session or CSRF token expired mid-run, logs in again and
+    re-sends the request once
+
+By default the clients share sessions: shared( url, username, password )
+returns the same TomSession for the same account, so building several
+clients (or one per thread) logs in only once, and they all draw on one
+connection pool.  A TomSession is safe to use from many threads at once.
+A (re-)login is done on a separate, fresh session, and its cookies and
+CSRF token are swapped in together, under a lock that preparing a
+request also takes, so a request never goes out with half of one login
+and half of another.  If several threads find the login expired at the
+same time, only one of them logs in again and the others wait for it
+and then re-send.
+
+  import tom_session
+  session = tom_session.shared( "https://desc-tom.lbl.gov", "rknop", password )
+  tc = TomClient( session=session )
+  q = ELAsTiCCMetricsQuerier( session=session )
+  cmc = ConfMatrixClient( session )
+
+"""
+
+import threading
+
+import requests
+import requests.adapters
+import requests.cookies
+import requests.structures
+import urllib3.exceptions
+import urllib3.util.retry
+
+
+class _LockedCookieJar( requests.cookies.RequestsCookieJar ):
+    # CookieJar takes its own lock to add cookies (e.g. from a response,
+    #  in another thread), but not to iterate over them, which is what
+    #  preparing a request does; iterate over a copy made under the lock.
+    def __iter__( self ):
+        with self._cookies_lock:
+            return iter( list( super().__iter__() ) )
+
+
+class TomSession( requests.Session ):
+    """A requests.Session logged in to the TOM; see module docs.
+
+    url : the TOM's base url (e.g. https://desc-tom.lbl.gov)
+
+    username, password : TOM credentials
+
+    pool_maxsize : number of connections to keep open to the TOM
+
+    retries : times to retry a request that couldn't connect, or an
+      idempotent one that got a read error or a 5xx status (waiting
+      backoff_factor, 2*backoff_factor, ... seconds); after that you get
+      the last 5xx response back
+
+    login : log in now (otherwise, call login() yourself)
+
+    """
+
+    def __init__( self, url, username, password, pool_maxsize=16, retries=3, backoff_factor=0.5, login=True ):
+        super().__init__()
+        self.url = url
+        self._username = username
+        self._password = password
+        # allowed_methods limits read and status retries (not connect retries) to idempotent methods
+        retry = urllib3.util.retry.Retry( total=retries, connect=retries, read=retries, status=retries, other=0,
+                                          status_forcelist=( 500, 502, 503, 504 ), backoff_factor=backoff_factor,
+                                          allowed_methods=urllib3.util.retry.Retry.DEFAULT_ALLOWED_METHODS,
+                                          raise_on_status=False )
+        adapter = requests.adapters.HTTPAdapter( pool_connections=4, pool_maxsize=pool_maxsize, max_retries=retry )
+        self.mount( 'https://', adapter )
+        self.mount( 'http://', adapter )
+        self.cookies = _LockedCookieJar()
+        self._loginlock = threading.Lock()
+        # Held while swapping in a new login, and while preparing a request from the session's cookies and headers
+        self._statelock = threading.Lock()
+        # Bumped on every login, so threads that all saw the same expired login only log in once
+        self._generation = 0
+        if login:
+            self.login()
+
+    def login( self ):
+        """(Re-)log in to the TOM; raises RuntimeError on failure."""
+        with self._loginlock:
+            self._login()
+
+    def _login( self ):
+        # Log in on a fresh session, so that requests going out meanwhile still see the whole old login
+        fresh = requests.Session()
+        try:
+            res = fresh.get( f'{self.url}/accounts/login/' )
+            if res.status_code != 200:
+                raise RuntimeError( f"Got status {res.status_code} from first attempt to connect to {self.url}" )
+            res = fresh.post( f'{self.url}/accounts/login/',
+                              data={ 'username': self._username,
+                                     'password': self._password,
+                                     'csrfmiddlewaretoken': fresh.cookies['csrftoken'] } )
+            if res.status_code != 200:
+                raise RuntimeError( f"Failed to log in; http status: {res.status_code}" )
+            if 'Please enter a correct' in res.text:
+                # This is a very cheesy attempt at checking if the login failed.
+                # I haven't found clean documentation on how to log into a django site
+                # from an app like this using standard authentication stuff.  So, for
+                # now, I'm counting on the HTML that happened to come back when
+                # I ran it with a failed login one time.  One of these days I'll actually
+                # figure out how Django auth works and make a version of /accounts/login/
+                # designed for use in API scripts like this one, rather than desgined
+                # for interactive users.
+                raise RuntimeError( "Failed to log in.  I think.  Put in a debug break and look at res.text" )
+            cookies = _LockedCookieJar()
+            cookies.update( fresh.cookies )
+            headers = requests.structures.CaseInsensitiveDict( self.headers )
+            headers['X-CSRFToken'] = fresh.cookies['csrftoken']
+        finally:
+            fresh.close()
+        # Replace (never modify) cookies and headers, so a thread part way through using the old ones isn't upset
+        with self._statelock:
+            self.cookies = cookies
+            self.headers = headers
+            self._generation += 1
+
+    def prepare_request( self, request ):
+        with self._statelock:
+            return super().prepare_request( request )
+
+    def _relogin( self, generation ):
+        with self._loginlock:
+            # If another thread has logged in since this one sent its request, just use that login
+            if self._generation == generation:
+                self._login()
+
+    @staticmethod
+    def _login_expired( res ):
+        if res.status_code == 403:
+            return True
+        return ( len( res.history ) > 0 ) and ( '/accounts/login/' in res.url )
+
+    def request( self, method, url, *args, **kwargs ):
+        generation = self._generation
+        res = super().request( method, url, *args, **kwargs )
+        if self._login_expired( res ) and ( '/accounts/login/' not in url ):
+            res.close()
+            self._relogin( generation )
+            res = super().request( method, url, *args, **kwargs )
+        return res
+
+
+def exhausted( ex ):
+    """True if the requests exception ex means a TomSession already retried the request as far as it will."""
+    return ( len( getattr( ex, 'args', () ) ) > 0 ) and isinstance( ex.args[0], urllib3.exceptions.MaxRetryError )
+
+
+_shared = {}
+_sharedlock = threading.Lock()
+
+
+def shared( url, username, password, **kwargs ):
+    """The TomSession for this account, logging in (with TomSession( ..., **kwargs )) if there isn't one yet."""
+    key = ( url, username, password )
+    with _sharedlock:
+        session = _shared.get( key )
+        if session is None:
+            session = TomSession( url, username, password, **kwargs )
+            _shared[ key ] = session
+        return session
+
+
+def forget( url=None, username=None ):
+    """Drop shared sessions (all of them, or those for url and/or username), closing their connections."""
+    with _sharedlock:
+        for key in list( _shared ):
+            if ( ( url is None ) or ( key[0] == url ) ) and ( ( username is None ) or ( key[1] == username ) ):
+                _shared.pop( key ).close()
@@ -0,0 +1,174 @@
+"""Helpers shared by the clients that send SQL to the TOM's /db/runsqlquery/ endpoint.
+
+decode_rows turns a /db/runsqlquery/ response into a DataFrame one
+column at a time; see the comments above it.
+
+The TOM runs the query you send it and gives back every row in one JSON
+document.  For big pulls that means the whole result has to sit in
+memory (several times over, while it's being parsed).  The functions
+here let a client page through a result instead, using keyset
+pagination: the query is wrapped so that it's ordered on a key the
+caller names, and each page asks for rows whose key is past the last
+key of the previous page.  This only works if the key is unique across
+the result (e.g. a primary key, or a tuple of columns that together are
+unique); otherwise rows sharing a key value across a page boundary will
+be dropped.
+
+"""
+
+import json
+import time
+import operator
+
+import numpy
+import pandas
+
+
+def _key_columns( key ):
+    return [ key ] if isinstance( key, str ) else list( key )
+
+
+def keyset_page_query( query, key, chunksize, after=None ):
+    """Wrap query so that it returns one page of at most chunksize rows ordered by key.
+
+    query : the SQL query to page through.  It's used as a subquery, so
+      it must not end in a semicolon.  Any ORDER BY or LIMIT in it will
+      be ignored.
+
+    key : column name (as it comes out of query), or a list of column
+      names, to page on.
+
+    chunksize : number of rows per page
+
+    after : None for the first page, otherwise a list of the key values
+      of the last row of the previous page.
+
+    Returns ( query, subdict ); subdict has the substitutions for the
+    keyset condition, and should be merged into the caller's subdict.
+
+    """
+    cols = _key_columns( key )
+    quoted = ', '.join( f'_keyset_q."{col}"' for col in cols )
+    subdict = {}
+    where = ''
+    if after is not None:
+        params = []
+        for i, val in enumerate( after ):
+            subdict[ f'_keyset_{i}' ] = val
+            params.append( f'%(_keyset_{i})s' )
+        where = f'WHERE ( {quoted} ) > ( {", ".join( params )} ) '
+    return ( f'SELECT * FROM ( {query} ) _keyset_q {where}ORDER BY {quoted} LIMIT {int(chunksize)}',
+             subdict )
+
+
+def iter_frames( send_frame, query, key, subdict=None, chunksize=100000, asrecords=False, schema=None ):
+    """Generator yielding pandas DataFrames (or numpy record arrays) of at most chunksize rows.
+
+    send_frame : a function send_frame( query, subdict, schema=schema )
+      that runs a query and returns a DataFrame (e.g. built with
+      decode_rows), or None if the query failed
+
+    schema : passed on to send_frame
+
+    See keyset_page_query for the other parameters.  If asrecords is
+    True, yields numpy record arrays instead of DataFrames.
+
+    """
+    if chunksize < 1:
+        raise ValueError( f"chunksize must be positive, not {chunksize}" )
+    cols = _key_columns( key )
+    subdict = {} if subdict is None else dict( subdict )
+    after = None
+    while True:
+        pagequery, keysubdict = keyset_page_query( query, cols, chunksize, after )
+        df = send_frame( pagequery, { **subdict, **keysubdict }, schema=schema )
+        if df is None:
+            raise RuntimeError( "Query failed while paging through results" )
+        if len( df ) == 0:
+            return
+        missing = [ col for col in cols if col not in df.columns ]
+        if len( missing ) > 0:
+            raise KeyError( f"Paging key column(s) {missing} are not in the query result" )
+        # .tolist() so that the values are plain python and will go into JSON
+        after = df[ cols ].iloc[ -1 ].tolist()
+        nrows = len( df )
+        yield df.to_records( index=False ) if asrecords else df
+        if nrows < chunksize:
+            return
+
+
+# ======================================================================
+# Decoding /db/runsqlquery/ responses
+#
+# The response is a JSON document { "status": "ok", "rows": [ {...}, {...}, ... ] }
+# where each row is a dict of column: value.  The obvious way to turn that
+# into a DataFrame (json.loads( result.text ), then pandas.DataFrame( rows ))
+# decodes the whole body to a str first, and then has pandas walk every
+# row dict working out columns and dtypes.  decode_rows parses the bytes
+# directly (with orjson if it's installed, which is several times faster
+# than the json module), and then pulls each column out of the rows with
+# a C-level itemgetter into a single numpy array of the requested dtype.
+# (Having the json parser itself build columns, via an object_pairs_hook,
+# would avoid the per-row dicts, but a python-level hook is called once
+# per row and ends up slower than just letting the C parser make dicts.)
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+
+def _column_array( name, values, schema ):
+    dtype = None if schema is None else schema.get( name )
+    if dtype is not None:
+        try:
+            return numpy.array( values, dtype=dtype )
+        except ( TypeError, ValueError, OverflowError ):
+            # Probably NULLs in a column hinted as an integer type (or,
+            #  with numpy 2, values that don't fit the hinted type);
+            #  let pandas figure out what to do.
+            pass
+    return pandas.Series( values, name=name ).array
+
+
+def decode_rows( content, schema=None, timings=None ):
+    """Parse the body of a /db/runsqlquery/ response.
+
+    content : the response body, as bytes (e.g. requests' result.content)
+
+    schema : optional dict of { column: dtype } giving the numpy dtype to
+      use for columns of the result (e.g. { 'tbin': numpy.int16 }).
+      Columns not in schema, or whose values won't convert to the given
+      dtype (e.g. because there are NULLs in an integer column), get
+      whatever dtype pandas infers.
+
+    timings : optional dict; if given, decode_s and frame_s are set in it
+      to the seconds spent parsing the JSON and building the DataFrame
+      (see tom_stats).
+
+    Returns ( data, df ).  data is the top-level dict of the response
+    with 'rows' removed (so you can check data['status'] and
+    data['error']); df is a DataFrame of the rows, or None if the
+    response had no rows list.
+
+    """
+    t0 = time.perf_counter()
+    data = _json_loads( content )
+    t1 = time.perf_counter()
+    if timings is not None:
+        timings['decode_s'] = t1 - t0
+    rows = data.pop( 'rows', None ) if isinstance( data, dict ) else None
+    if rows is None:
+        return data, None
+    if len( rows ) == 0:
+        columns = [] if schema is None else list( schema.keys() )
+        df = pandas.DataFrame( { col: _column_array( col, [], schema ) for col in columns } )
+    else:
+        columns = { col: _column_array( col, list( map( operator.itemgetter( col ), rows ) ), schema )
+                    for col in rows[0].keys() }
+        del rows
+        df = pandas.DataFrame( columns, copy=False )
+    if timings is not None:
+        timings['frame_s'] = time.perf_counter() - t1
+    return data, df
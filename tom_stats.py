@@ -0,0 +1,263 @@
+"""Per-call timing and size records for everything the clients send to the TOM.
+
+TomClient, ELAsTiCCMetricsQuerier, and ConfMatrixClient record every
+call they make in a CallStats object (by default the module-level one,
+tom_stats.stats; pass stats= to a client's constructor to use a
+different one).  For each call you get:
+
+  client     : which client class made the call
+  kind       : 'http' (TomClient.request) or 'sql' (a /db/runsqlquery/ query)
+  what       : for http, the page with numeric path components replaced
+               by '?'; for sql, a fingerprint of the query (see fingerprint())
+  latency_s  : time from sending the request until the whole response was in
+  nbytes     : size of the response body
+  decode_s   : time spent parsing the response (JSON)
+  frame_s    : time spent building the DataFrame (if the call builds one)
+  nrows      : number of rows returned (sql only)
+  total_s    : wall-clock time of the whole call
+  status     : HTTP status code (None if the response came from tom_cache)
+  cached     : True if the response came from tom_cache rather than the TOM
+  error      : repr of the exception, if the call raised one
+
+Usage:
+
+  import tom_stats
+  tom_stats.stats.add_hook( lambda rec: print( rec['what'], rec['total_s'] ) )
+  ... run your report ...
+  print( tom_stats.stats.summary() )
+  tom_stats.stats.dump( 'tom_calls.json' )
+
+tom_stats.stats keeps only the last 20000 calls; see CallStats.
+
+summary() groups calls by (client, kind, what) and gives the count,
+p50 and p95 of total_s and latency_s, and totals of everything else,
+sorted so that the groups that took the most time come first.
+
+"""
+
+import re
+import sys
+import json
+import time
+import hashlib
+import collections
+import logging
+import threading
+
+import numpy
+import pandas
+
+
+_whitespace = re.compile( r'\s+' )
+_strings = re.compile( r"'(?:[^']|'')*'" )
+_numbers = re.compile( r'(?<![\w"])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?(?![\w"])' )
+_numericpath = re.compile( r'/\d+(?=/|$)' )
+
+
+def normalize_query( query ):
+    """Collapse whitespace and replace literal strings and numbers with ?."""
+    query = _strings.sub( '?', query )
+    query = _numbers.sub( '?', query )
+    return _whitespace.sub( ' ', query ).strip()
+
+
+def fingerprint( query ):
+    """A short id for a query that's the same for queries differing only in literal values."""
+    return hashlib.sha1( normalize_query( query ).encode( 'utf-8' ) ).hexdigest()[:12]
+
+
+def normalize_page( page ):
+    """Replace numeric path components of a TOM page with ?, e.g. for elasticc2/ppdbdiaobject/55772173."""
+    page = ( page or '' ).split( '?' )[0]
+    return _numericpath.sub( '/?', '/' + page.strip( '/' ) )[1:]
+
+
+def _sum( x ):
+    # NaN rather than 0 for a group where nothing had a value (e.g. nrows for http calls)
+    return x.sum( min_count=1 )
+
+
+class CallRecord:
+    """One call in progress; use via CallStats.record()."""
+
+    def __init__( self, stats, client, kind, what, text ):
+        self._stats = stats
+        self.fields = { 'client': client, 'kind': kind, 'what': what, 'start': time.time(),
+                        'latency_s': None, 'nbytes': None, 'decode_s': None, 'frame_s': None,
+                        'nrows': None, 'total_s': None, 'status': None, 'cached': False, 'error': None }
+        self.text = text
+        self._t0 = time.perf_counter()
+        self._tlap = self._t0
+        # Passed to tom_sql.decode_rows to fill in decode_s and frame_s
+        self.timings = {}
+
+    def lap( self, name ):
+        """Set field name to the time since the last lap (or the start of the call)."""
+        now = time.perf_counter()
+        self.fields[ name ] = now - self._tlap
+        self._tlap = now
+
+    def response( self, res ):
+        """Record the latency (up to now), status, and size of a requests response."""
+        self.lap( 'latency_s' )
+        self.fields['status'] = res.status_code
+        # Don't read the body of a stream=True response out from under the caller
+        if getattr( res, '_content_consumed', True ):
+            self.fields['nbytes'] = len( res.content )
+
+    def cached( self, content ):
+        """Record that the response body content came from a cache (so latency_s is the cache lookup time)."""
+        self.lap( 'latency_s' )
+        self.fields['cached'] = True
+        self.fields['nbytes'] = len( content )
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, exc_type, exc, tb ):
+        self.fields['total_s'] = time.perf_counter() - self._t0
+        for k, v in self.timings.items():
+            self.fields[ k ] = v
+        if exc is not None:
+            self.fields['error'] = repr( exc )
+        self._stats._finish( self )
+        return False
+
+
+class CallStats:
+    """Collects CallRecords, calls hooks, and summarizes.
+
+    Thread-safe; several clients (or threads) can share one.  Records
+    are kept in memory; call reset() to throw them away, or pass
+    keep=False to only call hooks.  With maxrecords, only the most
+    recent maxrecords calls are kept (and so summarized); dropped counts
+    the ones thrown away to make room.
+
+    """
+
+    def __init__( self, keep=True, maxrecords=None ):
+        self.keep = keep
+        self.maxrecords = maxrecords
+        self.dropped = 0
+        self._records = collections.deque( maxlen=maxrecords )
+        self._queries = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger( "tom_stats" )
+
+    def record( self, client, kind, what ):
+        """Start recording a call; use as a context manager.
+
+        client : name of the client class
+        kind : 'http' or 'sql'
+        what : the page (for http) or the SQL query (for sql)
+
+        """
+        if kind == 'sql':
+            return CallRecord( self, client, kind, fingerprint( what ), normalize_query( what ) )
+        return CallRecord( self, client, kind, normalize_page( what ), None )
+
+    def add_hook( self, hook ):
+        """Call hook( fields ) after every call, where fields is a dict (see module docs).
+
+        Hooks are called in the thread that made the call.  An exception
+        from a hook is logged and otherwise ignored.
+
+        """
+        with self._lock:
+            self._hooks.append( hook )
+
+    def remove_hook( self, hook ):
+        with self._lock:
+            self._hooks.remove( hook )
+
+    def _finish( self, rec ):
+        with self._lock:
+            if self.keep:
+                if len( self._records ) == self.maxrecords:
+                    self.dropped += 1
+                self._records.append( rec.fields )
+                if rec.text is not None:
+                    self._queries[ rec.fields['what'] ] = rec.text
+            hooks = list( self._hooks )
+        for hook in hooks:
+            try:
+                hook( dict( rec.fields ) )
+            except Exception as ex:
+                self.logger.exception( f"tom_stats hook {hook} raised {ex}" )
+
+    def reset( self ):
+        with self._lock:
+            self._records.clear()
+            self._queries = {}
+            self.dropped = 0
+
+    @property
+    def queries( self ):
+        """{ fingerprint: normalized query text } for all sql calls recorded."""
+        with self._lock:
+            return dict( self._queries )
+
+    def records( self ):
+        """All recorded calls as a DataFrame, one row per call."""
+        with self._lock:
+            records = list( self._records )
+        return pandas.DataFrame( records, columns=[ 'client', 'kind', 'what', 'start', 'latency_s', 'nbytes',
+                                                    'decode_s', 'frame_s', 'nrows', 'total_s',
+                                                    'status', 'cached', 'error' ] )
+
+    def summary( self ):
+        """Aggregate stats per (client, kind, what), most total time first."""
+        df = self.records()
+        if len( df ) == 0:
+            return pandas.DataFrame()
+        for col in [ 'latency_s', 'nbytes', 'decode_s', 'frame_s', 'nrows', 'total_s' ]:
+            df[ col ] = df[ col ].astype( numpy.float64 )
+        df['failed'] = df['error'].notna()
+        grouped = df.groupby( [ 'client', 'kind', 'what' ] )
+        summ = grouped.agg( count=( 'total_s', 'size' ),
+                            failed=( 'failed', 'sum' ),
+                            cached=( 'cached', 'sum' ),
+                            total_s=( 'total_s', 'sum' ),
+                            p50_s=( 'total_s', 'median' ),
+                            p95_s=( 'total_s', lambda x: x.quantile( 0.95 ) ),
+                            latency_s=( 'latency_s', 'sum' ),
+                            p50_latency_s=( 'latency_s', 'median' ),
+                            p95_latency_s=( 'latency_s', lambda x: x.quantile( 0.95 ) ),
+                            decode_s=( 'decode_s', _sum ),
+                            frame_s=( 'frame_s', _sum ),
+                            nbytes=( 'nbytes', _sum ),
+                            nrows=( 'nrows', _sum ) )
+        summ = summ.sort_values( 'total_s', ascending=False )
+        queries = self.queries
+        summ['query'] = [ queries.get( what ) for what in summ.index.get_level_values( 'what' ) ]
+        return summ
+
+    def dump( self, dest=None ):
+        """Write summary() (and the text of each query) as JSON to dest (a filename or file; default stdout).
+
+        If dest is a filename ending in .csv, write summary() as CSV instead.
+
+        """
+        summ = self.summary()
+        if self.dropped > 0:
+            self.logger.warning( f"Summary covers only the last {self.maxrecords} calls; "
+                                 f"{self.dropped} earlier ones were dropped" )
+        if isinstance( dest, str ) and dest.endswith( '.csv' ):
+            summ.to_csv( dest )
+            return
+        out = json.loads( summ.reset_index().to_json( orient='records' ) ) if len( summ ) > 0 else []
+        if dest is None:
+            json.dump( out, sys.stdout, indent=2 )
+        elif isinstance( dest, str ):
+            with open( dest, 'w' ) as ofp:
+                json.dump( out, ofp, indent=2 )
+        else:
+            json.dump( out, dest, indent=2 )
+
+
+# The default CallStats that the clients record into.  Bounded, so that a
+#  long session (paged queries, bulk REST pulls) doesn't grow without
+#  limit; make your own CallStats( maxrecords=None ) and pass it as stats=
+#  to the clients if you want every call.
+stats = CallStats( maxrecords=20000 )